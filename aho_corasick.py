@@ -0,0 +1,87 @@
+from collections import deque
+
+# Below this many patterns, one 'in' scan per pattern beats the automaton in CPython
+AHO_CORASICK_MIN_PATTERNS = 256
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton that finds every pattern occurring in a text in one scan.
+
+    Patterns are identified by their position in the list given to the constructor.
+    """
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.output = [()]
+        for pattern_id, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.output.append(())
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state] += (pattern_id,)
+        self.fail = [0] * len(self.goto)
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def search(self, text):
+        """
+        Find the patterns that occur in a text.
+
+        Args:
+            text (str): Text to scan.
+
+        Returns:
+            set: IDs of the patterns found.
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        # The empty pattern, if any, is in every text
+        found = set(output[0])
+        state = 0
+        for char in text:
+            next_state = goto[state].get(char)
+            while next_state is None:
+                if not state:
+                    next_state = 0
+                    break
+                state = fail[state]
+                next_state = goto[state].get(char)
+            state = next_state
+            if output[state]:
+                found.update(output[state])
+        return found
+
+def build_substring_matcher(patterns, min_automaton_patterns=AHO_CORASICK_MIN_PATTERNS):
+    """
+    Build a function returning the IDs of the patterns a text contains.
+
+    Large pattern sets use an Aho-Corasick automaton; small ones test each pattern
+    with 'in', which runs in C and is faster until there are a few hundred patterns.
+
+    Args:
+        patterns (list): Distinct patterns, identified by position.
+        min_automaton_patterns (int): Pattern count from which the automaton is used.
+
+    Returns:
+        function: Takes a text and returns a set of pattern IDs.
+    """
+    if len(patterns) >= min_automaton_patterns:
+        return AhoCorasick(patterns).search
+    indexed_patterns = tuple(enumerate(patterns))
+    return lambda text: {pattern_id for pattern_id, pattern in indexed_patterns if pattern in text}
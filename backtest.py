@@ -0,0 +1,435 @@
+import os
+import sys
+import json
+import mmap
+import math
+import shutil
+import bisect
+import logging
+import argparse
+import datetime
+from array import array
+from psycopg2 import sql
+from database import stream_emails, email_table_version
+from rule_engine import RULES_FILE, load_rules, validate_rules, parse_rule_date, to_datetime
+from logging_config import configure_logging, add_logging_arguments
+
+# Directory the snapshot of the stored emails is cached in between backtests
+SNAPSHOT_DIR = '.backtest_snapshot'
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_META_FILE = 'snapshot.json'
+
+# Column layout of the rows a snapshot is built from
+SNAPSHOT_COLUMNS = ('date', 'sender', 'receiver', 'subject', 'message')
+
+# Few distinct values: stored once each, rows hold a code
+INTERNED_FIELDS = ('sender', 'receiver')
+# Mostly distinct values: one UTF-8 blob per field, rows hold an offset
+BLOB_FIELDS = ('subject', 'message')
+
+# Row masks hold one byte per row, 1 for the rows a condition matches
+INVERT_MASK = bytes.maketrans(b'\x00\x01', b'\x01\x00')
+
+logger = logging.getLogger(__name__)
+
+def map_file(path):
+    """
+    Memory-map a snapshot file read-only.
+
+    Returns:
+        mmap.mmap: Mapped file, or empty bytes for an empty file, which cannot be mapped.
+    """
+    with open(path, 'rb') as snapshot_file:
+        if os.fstat(snapshot_file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def typecode_for(distinct_values):
+    """
+    Pick the smallest array typecode able to hold a code for every distinct value.
+    """
+    if distinct_values <= 1 << 8:
+        return 'B'
+    if distinct_values <= 1 << 16:
+        return 'H'
+    return 'I'
+
+def write_snapshot(path, rows, source=None):
+    """
+    Write a columnar snapshot of emails.
+
+    Dates are stored as epoch seconds, sender and receiver as codes into their
+    distinct values, and subject and message as one UTF-8 blob each with an array of
+    row offsets. The snapshot is written next to path and renamed into place, so a
+    reader never sees a partial one.
+
+    Args:
+        path (str): Directory of the snapshot.
+        rows (iterable): (date, sender, receiver, subject, message) tuples, emails without a date first,
+            then by ascending date.
+        source (list): Identifies the stored emails the rows were read from, to detect a stale snapshot.
+
+    Returns:
+        int: Number of rows written.
+
+    Raises:
+        ValueError: If the rows are not in date order.
+    """
+    temp_path = f'{path}.tmp'
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+
+    dates = array('d')
+    null_dates = 0
+    interned = {field: {} for field in INTERNED_FIELDS}
+    codes = {field: array('I') for field in INTERNED_FIELDS}
+    offsets = {field: array('Q', [0]) for field in BLOB_FIELDS}
+    blobs = {field: open(os.path.join(temp_path, f'{field}.blob'), 'wb') for field in BLOB_FIELDS}
+    try:
+        for date, sender, receiver, subject, message in rows:
+            if date is None:
+                if dates and not math.isnan(dates[-1]):
+                    raise ValueError('Snapshot rows must start with the emails without a date')
+                null_dates += 1
+                dates.append(math.nan)
+            else:
+                timestamp = to_datetime(date).timestamp()
+                if len(dates) > null_dates and timestamp < dates[-1]:
+                    raise ValueError('Snapshot rows must be in ascending date order')
+                dates.append(timestamp)
+            for field, value in (('sender', sender), ('receiver', receiver)):
+                values = interned[field]
+                codes[field].append(values.setdefault(value or '', len(values)))
+            for field, value in (('subject', subject), ('message', message)):
+                encoded = (value or '').encode('utf-8')
+                blobs[field].write(encoded)
+                offsets[field].append(offsets[field][-1] + len(encoded))
+    finally:
+        for blob in blobs.values():
+            blob.close()
+
+    with open(os.path.join(temp_path, 'date.bin'), 'wb') as date_file:
+        dates.tofile(date_file)
+    for field in INTERNED_FIELDS:
+        with open(os.path.join(temp_path, f'{field}.codes'), 'wb') as codes_file:
+            array(typecode_for(len(interned[field])), codes[field]).tofile(codes_file)
+    for field in BLOB_FIELDS:
+        with open(os.path.join(temp_path, f'{field}.offsets'), 'wb') as offsets_file:
+            offsets[field].tofile(offsets_file)
+    meta = {
+        'format': SNAPSHOT_FORMAT_VERSION,
+        'rows': len(dates),
+        'null_dates': null_dates,
+        'source': source,
+        'built_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'values': {field: list(interned[field]) for field in INTERNED_FIELDS},
+    }
+    with open(os.path.join(temp_path, SNAPSHOT_META_FILE), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temp_path, path)
+    return len(dates)
+
+class EmailSnapshot:
+    """
+    Read-only columnar view of the stored emails, memory-mapped from a snapshot directory.
+
+    Conditions are answered for every row at once, as row masks: bytes with one
+    byte per row, 1 where the condition holds. Rows are sorted by date, so a date
+    comparison is a binary search and a slice. A condition on sender or receiver
+    is decided once per distinct value and spread to the rows by code. A condition
+    on subject or message scans the field's blob once, jumping to the next row
+    after each match. Masks are combined as integers, so All, Any and negation run
+    in C. Missing text counts as empty, and an email without a date matches no
+    date condition.
+    """
+
+    def __init__(self, path):
+        """
+        Open a snapshot written by write_snapshot.
+
+        Raises:
+            OSError: If the snapshot is missing or incomplete.
+            ValueError: If it was written in another format.
+        """
+        with open(os.path.join(path, SNAPSHOT_META_FILE), 'r') as meta_file:
+            meta = json.load(meta_file)
+        if meta.get('format') != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format {meta.get('format')!r}")
+        self.path = path
+        self.rows = meta['rows']
+        self.null_dates = meta['null_dates']
+        self.source = meta['source']
+        self.built_at = meta['built_at']
+        self.values = meta['values']
+        self.mapped = {}
+
+        def column(name, typecode):
+            self.mapped[name] = map_file(os.path.join(path, name))
+            return memoryview(self.mapped[name]).cast(typecode)
+
+        self.dates = column('date.bin', 'd')
+        self.codes = {field: column(f'{field}.codes', typecode_for(len(self.values[field]))) for field in INTERNED_FIELDS}
+        self.offsets = {field: column(f'{field}.offsets', 'Q') for field in BLOB_FIELDS}
+        self.blobs = {}
+        for field in BLOB_FIELDS:
+            self.blobs[field] = self.mapped[f'{field}.blob'] = map_file(os.path.join(path, f'{field}.blob'))
+        self.mask_cache = {}
+
+    def close(self):
+        self.dates.release()
+        for view in list(self.codes.values()) + list(self.offsets.values()):
+            view.release()
+        for mapped in self.mapped.values():
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+    def range_mask(self, start, end):
+        """
+        Mask of the rows from start to end; start is included, end is not.
+        """
+        end = max(start, end)
+        return b'\x00' * start + b'\x01' * (end - start) + b'\x00' * (self.rows - end)
+
+    def date_mask(self, predicate, rule_date):
+        """
+        Mask of the emails dated after ('greater than') or before ('lesser than') a rule date.
+        """
+        timestamp = rule_date.timestamp()
+        if predicate == 'greater than':
+            return self.range_mask(bisect.bisect_right(self.dates, timestamp, self.null_dates), self.rows)
+        return self.range_mask(self.null_dates, bisect.bisect_left(self.dates, timestamp, self.null_dates))
+
+    def interned_mask(self, field, value):
+        """
+        Mask of the emails whose interned field contains value.
+        """
+        hits = bytes(value in distinct_value for distinct_value in self.values[field])
+        if 1 not in hits:
+            return bytes(self.rows)
+        codes = self.codes[field]
+        if codes.format == 'B':
+            return codes.tobytes().translate(hits.ljust(256, b'\x00'))
+        return bytes(map(hits.__getitem__, codes))
+
+    def blob_mask(self, field, value):
+        """
+        Mask of the emails whose blob field contains value.
+        """
+        if not value:
+            return b'\x01' * self.rows
+        pattern = value.encode('utf-8')
+        blob = self.blobs[field]
+        offsets = self.offsets[field]
+        mask = bytearray(self.rows)
+        position = blob.find(pattern)
+        while position != -1:
+            row = bisect.bisect_right(offsets, position) - 1
+            row_end = offsets[row + 1]
+            if position + len(pattern) <= row_end:
+                mask[row] = 1
+                position = blob.find(pattern, row_end)
+            else:
+                # The occurrence spans two rows
+                position = blob.find(pattern, position + 1)
+        return bytes(mask)
+
+    def condition_mask(self, condition):
+        """
+        Mask of the emails a rule condition matches.
+
+        Args:
+            condition (dict): Condition with 'field', 'predicate' and 'value' keys.
+
+        Returns:
+            bytes: One byte per row, 1 where the condition holds.
+        """
+        field, predicate, value = condition['field'], condition['predicate'], condition['value']
+        key = (field, predicate, value)
+        if key not in self.mask_cache:
+            if field == 'date':
+                self.mask_cache[key] = self.date_mask(predicate, parse_rule_date(value))
+            elif predicate == 'does not contain':
+                self.mask_cache[key] = self.condition_mask(dict(condition, predicate='contains')).translate(INVERT_MASK)
+            elif field in INTERNED_FIELDS:
+                self.mask_cache[key] = self.interned_mask(field, value)
+            else:
+                self.mask_cache[key] = self.blob_mask(field, value)
+        return self.mask_cache[key]
+
+def combine_masks(masks, rows, match_all):
+    """
+    Combine row masks with AND (match_all) or OR.
+
+    Returns:
+        bytes: Combined mask; every row for an empty AND, none for an empty OR.
+    """
+    combined = None
+    for mask in masks:
+        value = int.from_bytes(mask, 'little')
+        if combined is None:
+            combined = value
+        elif match_all:
+            combined &= value
+        else:
+            combined |= value
+    if combined is None:
+        return b'\x01' * rows if match_all else bytes(rows)
+    return combined.to_bytes(rows, 'little')
+
+def backtest_rules(snapshot, rules_data):
+    """
+    Count the stored emails each active rule and each of its conditions matches.
+
+    Nothing is sent to Gmail and nothing is recorded as processed.
+
+    Args:
+        snapshot (EmailSnapshot): Snapshot of the stored emails.
+        rules_data (list): Candidate rule definitions in the rules.json format.
+
+    Returns:
+        dict: 'emails' (number of emails), 'matched' (emails matched by at least one rule) and
+            'rules', a list of {'rule', 'matches', 'conditions'} in rule order, where 'conditions'
+            lists {'field', 'predicate', 'value', 'matches'}.
+
+    Raises:
+        ValueError: If the rules are invalid.
+    """
+    validate_rules(rules_data)
+    results = []
+    rule_masks = []
+    for rule in rules_data:
+        for rule_name, rule_data in rule.items():
+            if rule_data.get('active') != 1:
+                continue
+            conditions = rule_data.get('conditions', [])
+            condition_masks = [snapshot.condition_mask(condition) for condition in conditions]
+            rule_mask = combine_masks(condition_masks, snapshot.rows, rule_data['collective_predicate'] == 'All')
+            rule_masks.append(rule_mask)
+            results.append({
+                'rule': rule_name,
+                'matches': rule_mask.count(1),
+                'conditions': [dict(condition, matches=mask.count(1)) for condition, mask in zip(conditions, condition_masks)],
+            })
+    matched = combine_masks(rule_masks, snapshot.rows, False).count(1)
+    return {'emails': snapshot.rows, 'matched': matched, 'rules': results}
+
+def open_snapshot(path=SNAPSHOT_DIR):
+    """
+    Open the cached snapshot.
+
+    Returns:
+        EmailSnapshot: The snapshot, or None if there is none or it cannot be read.
+    """
+    try:
+        return EmailSnapshot(path)
+    except (OSError, ValueError, KeyError) as e:
+        if os.path.exists(path):
+            logger.warning("Ignoring unreadable snapshot in %s: %s", path, e)
+        return None
+
+def load_snapshot(path=SNAPSHOT_DIR, rebuild=False):
+    """
+    Open the cached snapshot of the stored emails, building it first if it is missing or stale.
+
+    The snapshot is considered current while email_table_version is unchanged, that is
+    while no email was added, removed or updated; rebuild forces a new one regardless.
+
+    Args:
+        path (str): Directory of the snapshot.
+        rebuild (bool): Build a new snapshot even if the cached one looks current.
+
+    Returns:
+        EmailSnapshot: Snapshot of the stored emails.
+    """
+    source = email_table_version()
+    snapshot = None if rebuild else open_snapshot(path)
+    if snapshot is not None and snapshot.source == source:
+        logger.info("Using the snapshot of %d emails built at %s", snapshot.rows, snapshot.built_at)
+        return snapshot
+    if snapshot is not None:
+        snapshot.close()
+    logger.info("Building a snapshot of the stored emails in %s", path)
+    rows = stream_emails(SNAPSHOT_COLUMNS, order_by=sql.SQL('date NULLS FIRST, id'))
+    written = write_snapshot(path, rows, source)
+    logger.info("Snapshot of %d emails written", written)
+    return EmailSnapshot(path)
+
+def format_report(report):
+    """
+    Render a backtest report as text.
+
+    Args:
+        report (dict): Result of backtest_rules.
+
+    Returns:
+        str: One line per rule followed by one indented line per condition.
+    """
+    emails = report['emails']
+
+    def share(matches):
+        return f'{matches:>10,} {100 * matches / emails if emails else 0:6.2f}%'
+
+    lines = [f"{'rule / condition':<60} {'matches':>10} {'share':>7}"]
+    for rule in report['rules']:
+        lines.append(f"{rule['rule']:<60} {share(rule['matches'])}")
+        for condition in rule['conditions']:
+            description = f"  {condition['field']} {condition['predicate']} {condition['value']!r}"
+            lines.append(f"{description[:60]:<60} {share(condition['matches'])}")
+    lines.append(f"{'matched by any rule':<60} {share(report['matched'])}")
+    lines.append(f"{'emails in snapshot':<60} {emails:>10,}")
+    return '\n'.join(lines)
+
+def main(rules_path=RULES_FILE, snapshot_path=SNAPSHOT_DIR, rebuild=False, as_json=False):
+    """
+    Backtest a rules file against the stored emails and print the match counts.
+
+    Args:
+        rules_path (str): Candidate rules file, in the rules.json format.
+        snapshot_path (str): Directory the snapshot is cached in.
+        rebuild (bool): Build a new snapshot even if the cached one looks current.
+        as_json (bool): Print the report as JSON instead of a table.
+
+    Returns:
+        None
+    """
+    rules_data = load_rules(rules_path)
+    validate_rules(rules_data)
+    snapshot = load_snapshot(snapshot_path, rebuild)
+    try:
+        report = backtest_rules(snapshot, rules_data)
+    finally:
+        snapshot.close()
+    print(json.dumps(report, indent=2) if as_json else format_report(report))
+
+def parse_args(argv=None):
+    """
+    Parse command line options for the backtest script.
+
+    Args:
+        argv (list): Arguments to parse; defaults to sys.argv.
+
+    Returns:
+        argparse.Namespace: Parsed options.
+    """
+    parser = argparse.ArgumentParser(description='Count the stored emails a rules file would match, without changing any email.')
+    parser.add_argument('--rules', default=RULES_FILE,
+                        help='Candidate rules file, in the rules.json format.')
+    parser.add_argument('--snapshot', default=SNAPSHOT_DIR,
+                        help='Directory the snapshot of the stored emails is cached in.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Build a new snapshot even if the cached one looks current.')
+    parser.add_argument('--json', dest='as_json', action='store_true',
+                        help='Print the report as JSON.')
+    add_logging_arguments(parser)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    configure_logging(args.log_level, args.log_rate_limit)
+    try:
+        main(args.rules, args.snapshot, args.rebuild, args.as_json)
+    except (OSError, ValueError) as e:
+        logger.error("Backtest failed: %s", e)
+        sys.exit(1)
@@ -0,0 +1,134 @@
+"""
+Benchmark of backtest.EmailSnapshot against evaluating rules over email tuples held in memory.
+
+The tuple baseline is what a dry run of process_emails would do: load every row
+like fetch_all_emails, run the compiled rules through RuleIndex, and check every
+condition to count its matches. The snapshot is built once from the same
+synthetic mailbox, then reopened from disk as a later backtest would. Each
+variant runs in a fresh process, so peak RSS belongs to it alone.
+
+Run from the repository root (generating 1M synthetic emails takes a few minutes):
+
+    python -m benchmarks.bench_backtest --sizes 100000 1000000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from backtest import SNAPSHOT_COLUMNS, write_snapshot, EmailSnapshot, backtest_rules
+from rule_engine import compile_condition, RuleIndex
+from benchmarks.bench_pipeline import run_isolated, peak_rss_mb
+from benchmarks.synthetic_mailbox import SyntheticMailbox
+
+DEFAULT_SIZES = (100000,)
+
+# A candidate ruleset mixing interned, text and date conditions
+CANDIDATE_RULES = [
+    {'food_orders': {'collective_predicate': 'All', 'active': 1, 'actions': {'mark_as_read': True}, 'conditions': [
+        {'field': 'sender', 'predicate': 'contains', 'value': 'swiggy.in'},
+        {'field': 'message', 'predicate': 'contains', 'value': "Don't want"},
+        {'field': 'date', 'predicate': 'greater than', 'value': '2023-01-01'},
+    ]}},
+    {'bank': {'collective_predicate': 'Any', 'active': 1, 'actions': {'mark_as_read': False, 'move_to_folder': 'Bank'}, 'conditions': [
+        {'field': 'sender', 'predicate': 'contains', 'value': 'hdfcbank'},
+        {'field': 'subject', 'predicate': 'contains', 'value': 'statement'},
+    ]}},
+    {'old_newsletters': {'collective_predicate': 'All', 'active': 1, 'actions': {'mark_as_read': True}, 'conditions': [
+        {'field': 'sender', 'predicate': 'contains', 'value': 'newsletter@'},
+        {'field': 'date', 'predicate': 'lesser than', 'value': '2022-07-01'},
+    ]}},
+    {'invoices': {'collective_predicate': 'All', 'active': 1, 'actions': {'mark_as_read': False, 'move_to_folder': 'Invoices'}, 'conditions': [
+        {'field': 'message', 'predicate': 'contains', 'value': 'invoice'},
+        {'field': 'message', 'predicate': 'contains', 'value': 'payment'},
+        {'field': 'sender', 'predicate': 'does not contain', 'value': 'github.com'},
+    ]}},
+    {'rare_phrase': {'collective_predicate': 'Any', 'active': 1, 'actions': {'mark_as_read': True}, 'conditions': [
+        {'field': 'message', 'predicate': 'contains', 'value': 'naïve café'},
+        {'field': 'subject', 'predicate': 'contains', 'value': 'infra'},
+    ]}},
+]
+
+def snapshot_rows(size, seed):
+    # Synthetic mailboxes list the newest message first; a snapshot wants ascending dates
+    mailbox = SyntheticMailbox(size, seed)
+    for position in reversed(range(size)):
+        _, _, subject, sender, receiver, date, message = mailbox.email_row(position)
+        yield date, sender, receiver, subject, message
+
+def rule_counts(report):
+    return [(rule['matches'], [condition['matches'] for condition in rule['conditions']]) for rule in report['rules']]
+
+def run_tuples(size, options):
+    started_at = time.perf_counter()
+    rows = list(snapshot_rows(size, options.seed))
+    load_seconds = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    rule_index = RuleIndex(CANDIDATE_RULES, SNAPSHOT_COLUMNS)
+    conditions = [[compile_condition(condition, SNAPSHOT_COLUMNS) for condition in rule_data['conditions']]
+                  for rule in CANDIDATE_RULES for rule_data in rule.values()]
+    rule_matches = [0] * len(conditions)
+    condition_matches = [[0] * len(rule_conditions) for rule_conditions in conditions]
+    for row in rows:
+        for position in rule_index.matching_positions(row):
+            rule_matches[position] += 1
+        for position, rule_conditions in enumerate(conditions):
+            counts = condition_matches[position]
+            for number, condition in enumerate(rule_conditions):
+                if condition(row):
+                    counts[number] += 1
+    evaluate_seconds = time.perf_counter() - started_at
+    return {'variant': 'tuples', 'emails': size, 'load': load_seconds, 'evaluate': evaluate_seconds, 'rss_mb': peak_rss_mb()[0],
+            'counts': list(zip(rule_matches, condition_matches))}
+
+def run_snapshot_build(size, options):
+    started_at = time.perf_counter()
+    write_snapshot(options.snapshot_path, snapshot_rows(size, options.seed))
+    return {'seconds': time.perf_counter() - started_at, 'rss_mb': peak_rss_mb()[0]}
+
+def run_snapshot(size, options):
+    started_at = time.perf_counter()
+    snapshot = EmailSnapshot(options.snapshot_path)
+    load_seconds = time.perf_counter() - started_at
+    started_at = time.perf_counter()
+    report = backtest_rules(snapshot, CANDIDATE_RULES)
+    evaluate_seconds = time.perf_counter() - started_at
+    snapshot.close()
+    return {'variant': 'snapshot', 'emails': size, 'load': load_seconds, 'evaluate': evaluate_seconds, 'rss_mb': peak_rss_mb()[0],
+            'counts': rule_counts(report)}
+
+def snapshot_size_mb(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 1024 / 1024
+
+def print_result(result):
+    print(f"{result['variant']:<9} {result['emails']:>9,} emails  load {result['load']:8.3f}s  evaluate {result['evaluate']:8.3f}s  "
+          f"{result['emails'] / max(result['evaluate'], 1e-9):12.0f} emails/s  peak RSS {result['rss_mb']:6.0f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='Mailbox sizes to run.')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_backtest')
+    options.snapshot_path = os.path.join(directory, 'snapshot')
+    try:
+        for size in options.sizes:
+            build = run_isolated(run_snapshot_build, size, options)
+            print(f"build     {size:>9,} emails  {build['seconds']:8.2f}s  {snapshot_size_mb(options.snapshot_path):8.1f} MB on disk  "
+                  f"peak RSS {build['rss_mb']:6.0f} MB")
+            tuples = run_isolated(run_tuples, size, options)
+            snapshot = run_isolated(run_snapshot, size, options)
+            print_result(tuples)
+            print_result(snapshot)
+            assert tuples['counts'] == snapshot['counts'], (tuples['counts'], snapshot['counts'])
+            for rule, (matches, _) in zip(CANDIDATE_RULES, snapshot['counts']):
+                print(f"    {next(iter(rule)):<16} {matches:>9,} matches")
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
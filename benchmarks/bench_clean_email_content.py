@@ -0,0 +1,55 @@
+"""
+Micro-benchmark of fetch_and_save_emails.clean_email_content on large HTML newsletters.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_clean_email_content --size-kb 512 --repeat 5
+"""
+import re
+import html
+import string
+import random
+import argparse
+import timeit
+from fetch_and_save_emails import clean_email_content
+
+def legacy_clean_email_content(content):
+    """The previous implementation: unescape, non-greedy tag regex, per-character filter."""
+    cleaned_content = html.unescape(content)
+    cleaned_content = re.sub(r'<.*?>', '', cleaned_content)
+    return ''.join(filter(lambda x: x in string.printable, cleaned_content))
+
+def make_newsletter(size_kb, seed=0):
+    """
+    Build a deterministic HTML newsletter of roughly size_kb kilobytes.
+
+    Returns:
+        str: HTML document with styles, scripts, tables, links, entities and non-ASCII text.
+    """
+    rng = random.Random(seed)
+    words = ['offer', 'sale', 'café', 'naïve', 'price', '&amp;', '&nbsp;', 'discount', 'order', '€20']
+    parts = ['<html><head><style>body {font-family: Arial} td {padding: 4px}</style>',
+             '<script>window.dataLayer = [];</script></head><body><table>']
+    size = 0
+    while size < size_kb * 1024:
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(5, 30)))
+        row = (f'<tr><td class="c{rng.randint(0, 9)}"><a href="https://example.com/{rng.randint(0, 10 ** 6)}">'
+               f'<span style="color:#333">{text}</span></a></td></tr>')
+        parts.append(row)
+        size += len(row)
+    parts.append('</table></body></html>')
+    return ''.join(parts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-kb', type=int, default=512, help='Size of the synthetic newsletter.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs per implementation.')
+    args = parser.parse_args()
+
+    newsletter = make_newsletter(args.size_kb)
+    for name, function in (('legacy', legacy_clean_email_content), ('current', clean_email_content)):
+        best = min(timeit.repeat(lambda: function(newsletter), number=1, repeat=args.repeat))
+        print(f"{name:>8}: {best * 1000:8.2f} ms  ({len(newsletter) / best / 1e6:7.1f} MB/s)")
+
+if __name__ == '__main__':
+    main()
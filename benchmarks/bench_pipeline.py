@@ -0,0 +1,207 @@
+"""
+Offline throughput benchmark of fetch_and_save_emails.main and process_emails.fetch_emails_from_database.
+
+Gmail is replaced by benchmarks.fake_gmail serving a deterministic synthetic mailbox,
+and the database by benchmarks.fake_database unless --postgres is given. Each phase
+runs in a fresh process. The benchmark reports emails per second, the peak RSS of
+that process, and p50/p99 latency of every stage.
+
+Run from the repository root (1M emails takes several minutes per phase):
+
+    python -m benchmarks.bench_pipeline --sizes 1000 100000 1000000
+"""
+import io
+import sys
+import time
+import argparse
+import resource
+import contextlib
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from unittest.mock import patch
+import fetch_and_save_emails
+import process_emails
+from rule_engine import load_rules
+from benchmarks.synthetic_mailbox import SyntheticMailbox
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.fake_database import FakeEmailStore
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+
+class StageTimer:
+    """
+    Collects the duration of every call to the functions it wraps, by stage name.
+    """
+
+    def __init__(self):
+        self.timings = collections.defaultdict(list)
+
+    def wrap(self, name, function):
+        durations = self.timings[name]
+
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                durations.append(time.perf_counter() - started_at)
+        return timed
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def summarize(timings):
+    """
+    Reduce per-call durations to (calls, p50, p99, total) per stage.
+
+    Returns:
+        dict: Summary tuple keyed by stage name, in seconds.
+    """
+    summary = {}
+    for name, durations in timings.items():
+        if durations:
+            ordered = sorted(durations)
+            summary[name] = (len(ordered), percentile(ordered, 0.5), percentile(ordered, 0.99), sum(ordered))
+    return summary
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; child processes (rule workers) are reported separately
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+def database_patches(module, store, names):
+    return [patch(f'{module.__name__}.{name}', getattr(store, attribute)) for name, attribute in names]
+
+def run_fetch(size, options):
+    """
+    Ingest a synthetic mailbox with fetch_and_save_emails.main.
+
+    Returns:
+        dict: Results of the run.
+    """
+    mailbox = SyntheticMailbox(size, options.seed)
+    store = FakeEmailStore(mailbox, options.db_latency)
+    services = []
+    timer = StageTimer()
+
+    def build_service(credentials):
+        service = FakeGmailService(mailbox, options.gmail_latency, options.quota_error_rate, seed=options.seed + len(services))
+        services.append(service)
+        return service
+
+    patches = [
+        patch('fetch_and_save_emails.authenticate_gmail', return_value=object()),
+        patch('fetch_and_save_emails.build_gmail_service', side_effect=build_service),
+        patch('fetch_and_save_emails.email_row_from_message', timer.wrap('parse + clean', fetch_and_save_emails.email_row_from_message)),
+    ]
+    if not options.postgres:
+        patches += database_patches(fetch_and_save_emails, store, [
+            ('create_email_table', 'create_table'), ('create_sync_state_table', 'create_table'),
+            ('get_sync_state', 'get_sync_state'), ('save_sync_state', 'save_sync_state'), ('insert_emails', 'insert_emails')])
+    else:
+        patches.append(patch('fetch_and_save_emails.insert_emails', timer.wrap('db.insert', fetch_and_save_emails.insert_emails)))
+
+    with contextlib.ExitStack() as stack:
+        for patcher in patches:
+            stack.enter_context(patcher)
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        started_at = time.perf_counter()
+        fetch_and_save_emails.main(page_size=500, buffer_size=options.buffer_size, full_sync=True, workers=options.fetch_workers,
+                                   quota_units_per_second=options.quota_units_per_second)
+        elapsed = time.perf_counter() - started_at
+
+    timings = collections.defaultdict(list, timer.timings)
+    for service in services:
+        timings['gmail messages.list'] += service.timings['messages.list']
+        timings['gmail batch get'] += service.timings['batch']
+    for name, durations in store.timings.items():
+        timings[name] += durations
+    return {'phase': 'fetch', 'emails': size, 'seconds': elapsed, 'stages': summarize(timings), 'rss_mb': peak_rss_mb()}
+
+def run_process(size, options):
+    """
+    Apply the rules to a stored synthetic mailbox with process_emails.fetch_emails_from_database.
+
+    Returns:
+        dict: Results of the run.
+    """
+    mailbox = SyntheticMailbox(size, options.seed)
+    store = FakeEmailStore(mailbox, options.db_latency)
+    gmail_service = FakeGmailService(mailbox, options.gmail_latency, seed=options.seed)
+    timer = StageTimer()
+    rules_data = load_rules(options.rules)
+
+    patches = [
+        patch.dict(process_emails.rules_cache, {'rules_data': rules_data, 'compiled_rules': None}),
+        patch('process_emails.email_label_delta', timer.wrap('rule evaluation', process_emails.email_label_delta)),
+    ]
+    if not options.postgres:
+        patches += database_patches(process_emails, store, [
+            ('stream_emails', 'stream_emails'), ('email_id_bounds', 'email_id_bounds'), ('mark_emails_processed', 'mark_emails_processed'),
+            ('get_sync_state', 'get_sync_state'), ('save_sync_state', 'save_sync_state')])
+        patches.append(patch('process_emails.close_pool'))
+
+    process_emails.configure_label_cache(None)
+    with contextlib.ExitStack() as stack:
+        for patcher in patches:
+            stack.enter_context(patcher)
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        started_at = time.perf_counter()
+        process_emails.fetch_emails_from_database(gmail_service, False, options.process_workers, full=True)
+        elapsed = time.perf_counter() - started_at
+
+    timings = collections.defaultdict(list, timer.timings)
+    timings['gmail batchModify'] = gmail_service.timings['messages.batchModify']
+    for name, durations in store.timings.items():
+        timings[name] += durations
+    return {'phase': 'process', 'emails': size, 'seconds': elapsed, 'stages': summarize(timings), 'rss_mb': peak_rss_mb(),
+            'modified': gmail_service.modified}
+
+def run_isolated(function, size, options):
+    # A fresh process per run, so peak RSS belongs to that run alone
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as executor:
+        return executor.submit(function, size, options).result()
+
+def print_result(result):
+    rss_self, rss_children = result['rss_mb']
+    line = (f"{result['phase']:<8} {result['emails']:>9,} emails  {result['seconds']:8.2f}s  "
+            f"{result['emails'] / max(result['seconds'], 1e-9):10.0f} emails/s  peak RSS {rss_self:6.0f} MB")
+    if rss_children:
+        line += f" (workers {rss_children:.0f} MB)"
+    if 'modified' in result:
+        line += f"  modified {result['modified']:,}"
+    print(line)
+    if not result['stages']:
+        print("    (stages ran in worker processes and were not timed)")
+        return
+    print(f"    {'stage':<20} {'calls':>9} {'p50 ms':>9} {'p99 ms':>9} {'total s':>9}")
+    for name, (calls, p50, p99, total) in sorted(result['stages'].items()):
+        print(f"    {name:<20} {calls:>9,} {p50 * 1000:>9.3f} {p99 * 1000:>9.3f} {total:>9.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='Mailbox sizes to run.')
+    parser.add_argument('--phases', nargs='+', choices=['fetch', 'process'], default=['fetch', 'process'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gmail-latency', type=float, default=0.0, help='Seconds each Gmail call or HTTP batch takes.')
+    parser.add_argument('--quota-error-rate', type=float, default=0.0, help='Share of batch sub-requests answered with HTTP 429.')
+    parser.add_argument('--db-latency', type=float, default=0.0, help='Seconds each fake database round trip takes.')
+    parser.add_argument('--fetch-workers', type=int, default=fetch_and_save_emails.DEFAULT_FETCH_WORKERS)
+    parser.add_argument('--process-workers', type=int, default=process_emails.DEFAULT_RULE_WORKERS)
+    parser.add_argument('--quota-units-per-second', type=float, default=10 ** 9,
+                        help='Quota limiter rate of the fetch workers; unlimited by default.')
+    parser.add_argument('--buffer-size', type=int, default=fetch_and_save_emails.EMAIL_BUFFER_SIZE)
+    parser.add_argument('--rules', default=process_emails.load_rules.__defaults__[0], help='Rules file evaluated by the process phase.')
+    parser.add_argument('--postgres', action='store_true',
+                        help='Use the database configured in database.py instead of the in-memory stand-in.')
+    options = parser.parse_args()
+
+    runners = {'fetch': run_fetch, 'process': run_process}
+    for size in options.sizes:
+        for phase in options.phases:
+            print_result(run_isolated(runners[phase], size, options))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark of rule_engine.RuleIndex against evaluating each compiled rule in turn.
+
+Run from the repository root (the defaults are the 1k rules x 100k emails workload):
+
+    python -m benchmarks.bench_rule_index --rules 1000 --emails 100000
+"""
+import random
+import argparse
+import datetime
+import time
+from rule_engine import compile_rules, RuleIndex
+
+WORDS = ['invoice', 'order', 'shipped', 'meeting', 'invitation', 'urgent', 'newsletter', 'sale', 'receipt',
+         'password', 'reset', 'weekly', 'report', 'offer', 'delivery', 'payment', 'account', 'update']
+DOMAINS = ['gmail.com', 'swiggy.in', 'amazon.in', 'github.com', 'example.com', 'bank.co.in', 'news.io']
+
+def make_rules(count, rng):
+    """
+    Build count active rules over a few thousand distinct literal values.
+
+    Returns:
+        list: Rule definitions in the rules.json format.
+    """
+    vocabulary = [f'{rng.choice(WORDS)}-{number}' for number in range(count * 2)]
+    rules_data = []
+    for number in range(count):
+        conditions = []
+        for _ in range(rng.randint(1, 3)):
+            field = rng.choice(['subject', 'sender', 'message', 'message'])
+            conditions.append({'field': field, 'predicate': 'contains', 'value': rng.choice(vocabulary)})
+        if rng.random() < 0.3:
+            conditions.append({'field': 'date', 'predicate': 'greater than', 'value': '2023-06-01'})
+        rules_data.append({f'rule{number}': {
+            'collective_predicate': rng.choice(['All', 'All', 'Any']),
+            'conditions': conditions,
+            'actions': {'mark_as_read': True},
+            'active': 1,
+        }})
+    return rules_data, vocabulary
+
+def make_emails(count, vocabulary, rng):
+    """
+    Yield count synthetic email rows with a sprinkling of rule values.
+    """
+    start = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    for number in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(20, 80))]
+        for _ in range(rng.randint(0, 3)):
+            words.insert(rng.randrange(len(words) + 1), rng.choice(vocabulary))
+        yield (
+            number, f'email{number}', ' '.join(words[:6]), f'{rng.choice(WORDS)}@{rng.choice(DOMAINS)}',
+            'me@gmail.com', start + datetime.timedelta(minutes=number), ' '.join(words),
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rules', type=int, default=1000)
+    parser.add_argument('--emails', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rules_data, vocabulary = make_rules(args.rules, rng)
+    emails = list(make_emails(args.emails, vocabulary, rng))
+
+    started_at = time.perf_counter()
+    compiled_rules = compile_rules(rules_data)
+    rule_index = RuleIndex(rules_data)
+    print(f"compile: {time.perf_counter() - started_at:.2f}s for {args.rules} rules")
+
+    started_at = time.perf_counter()
+    naive_matches = sum(1 for email in emails for rule in compiled_rules if rule.matches(email))
+    naive_elapsed = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    index_matches = sum(len(rule_index.matching_positions(email)) for email in emails)
+    index_elapsed = time.perf_counter() - started_at
+
+    assert naive_matches == index_matches, (naive_matches, index_matches)
+    for name, elapsed in (('per-rule', naive_elapsed), ('RuleIndex', index_elapsed)):
+        print(f"{name:>10}: {elapsed:8.2f}s  ({args.emails / elapsed:10.0f} emails/s)")
+    print(f"matches: {index_matches}, speed-up: {naive_elapsed / index_elapsed:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+Query latency of the email_details layouts on a synthetic table in PostgreSQL.
+
+"before" is the plain table used until partitioning: a SERIAL key, a unique
+index on emailid, a btree on date and pg_trgm indexes. "after" is the layout
+database.create_email_table builds now: monthly range partitions, a generated
+tsvector column and its GIN index. Both hold the same generated rows, in the
+schemas bench_before and bench_after of the database configured in database.py.
+The tables are kept between runs; pass --rebuild to generate them again.
+
+Run from the repository root (loading 10M rows takes a while and several GB):
+
+    python -m benchmarks.bench_storage --rows 10000000
+"""
+import time
+import argparse
+import datetime
+import statistics
+from psycopg2 import sql
+import database
+from benchmarks.synthetic_mailbox import WORDS, SENDER_DOMAINS, SENDER_NAMES
+
+LOAD_CHUNK_ROWS = 1000000
+MAILBOX_START = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+MAILBOX_SPAN_DAYS = 4 * 365
+
+# One email in RARE_WORD_EVERY mentions RARE_WORD, so selective searches have something to find
+RARE_WORD = 'chargeback'
+RARE_WORD_EVERY = 1000
+
+BEFORE_SCHEMA = 'bench_before'
+AFTER_SCHEMA = 'bench_after'
+
+BEFORE_TABLE_DDL = '''
+    CREATE TABLE email_details (
+        id SERIAL PRIMARY KEY,
+        emailid VARCHAR,
+        subject TEXT,
+        sender TEXT,
+        receiver TEXT,
+        date TIMESTAMPTZ,
+        message TEXT
+    )
+'''
+BEFORE_INDEXES = [
+    'CREATE UNIQUE INDEX email_details_emailid_key ON email_details (emailid)',
+    'CREATE INDEX email_details_date_idx ON email_details (date)',
+    'CREATE INDEX email_details_subject_trgm_idx ON email_details USING GIN (subject gin_trgm_ops)',
+    'CREATE INDEX email_details_message_trgm_idx ON email_details USING GIN (message gin_trgm_ops)',
+]
+
+# Messages of 20 to 59 words; the generate_series bound refers to g so every row draws its own words
+GENERATE_ROWS = '''
+    INSERT INTO email_details (id, emailid, subject, sender, receiver, date, message)
+    SELECT g, 'bench' || g,
+           words[1 + (g * 7) %% cardinality(words)] || ' ' || words[1 + (g * 13) %% cardinality(words)],
+           senders[1 + (g * 31) %% cardinality(senders)],
+           'me@gmail.com',
+           %(start)s::timestamptz + (g::bigint * %(span_seconds)s / %(rows)s) * interval '1 second',
+           array_to_string(ARRAY(SELECT words[1 + floor(random() * cardinality(words))::int]
+                                 FROM generate_series(1, 20 + g %% 40)), ' ')
+           || CASE WHEN g %% %(rare_every)s = 0 THEN ' ' || %(rare_word)s ELSE '' END
+    FROM generate_series(%(first)s, %(last)s) g, (SELECT %(words)s::text[] AS words, %(senders)s::text[] AS senders) vocabulary
+'''
+
+def use_schema(cursor, schema):
+    cursor.execute(sql.SQL('SET search_path TO {}, public').format(sql.Identifier(schema)))
+
+def schema_rows(cursor, schema):
+    cursor.execute('SELECT to_regclass(%s)', (f'{schema}.email_details',))
+    if cursor.fetchone()[0] is None:
+        return None
+    cursor.execute(sql.SQL('SELECT count(*) FROM {}.email_details').format(sql.Identifier(schema)))
+    return cursor.fetchone()[0]
+
+def build_tables(conn, rows):
+    """
+    Generate `rows` emails into the before layout and copy them into the after layout.
+    """
+    senders = [f'{name}@{domain}' for name in SENDER_NAMES for domain in SENDER_DOMAINS]
+    span_seconds = MAILBOX_SPAN_DAYS * 24 * 3600
+    with conn.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for schema in (BEFORE_SCHEMA, AFTER_SCHEMA):
+            cursor.execute(sql.SQL('DROP SCHEMA IF EXISTS {} CASCADE').format(sql.Identifier(schema)))
+            cursor.execute(sql.SQL('CREATE SCHEMA {}').format(sql.Identifier(schema)))
+        conn.commit()
+
+        use_schema(cursor, BEFORE_SCHEMA)
+        cursor.execute(BEFORE_TABLE_DDL)
+        started_at = time.perf_counter()
+        for first in range(1, rows + 1, LOAD_CHUNK_ROWS):
+            last = min(first + LOAD_CHUNK_ROWS - 1, rows)
+            cursor.execute(GENERATE_ROWS, {
+                'start': MAILBOX_START, 'span_seconds': span_seconds, 'rows': rows, 'first': first, 'last': last,
+                'words': WORDS, 'senders': senders, 'rare_every': RARE_WORD_EVERY, 'rare_word': RARE_WORD})
+            conn.commit()
+            print(f"generated {last:,} rows ({time.perf_counter() - started_at:.0f}s)", flush=True)
+        cursor.execute("SELECT setval(pg_get_serial_sequence('email_details', 'id'), %s)", (rows,))
+        for statement in BEFORE_INDEXES:
+            cursor.execute(statement)
+        conn.commit()
+        print(f"before: indexed ({time.perf_counter() - started_at:.0f}s)", flush=True)
+
+        use_schema(cursor, AFTER_SCHEMA)
+        database.create_partitioned_email_table(cursor)
+        end = MAILBOX_START + datetime.timedelta(days=MAILBOX_SPAN_DAYS)
+        for month in database.months_between(MAILBOX_START, end):
+            database.create_month_partition(cursor, month)
+        cursor.execute(sql.SQL('''
+            INSERT INTO email_details (id, emailid, subject, sender, receiver, date, message)
+            SELECT id, emailid, subject, sender, receiver, date, message FROM {}.email_details
+        ''').format(sql.Identifier(BEFORE_SCHEMA)))
+        conn.commit()
+        print(f"after: copied ({time.perf_counter() - started_at:.0f}s)", flush=True)
+        database.create_email_indexes(cursor)
+        conn.commit()
+        print(f"after: indexed ({time.perf_counter() - started_at:.0f}s)", flush=True)
+
+    # VACUUM cannot run inside a transaction block
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        for schema in (BEFORE_SCHEMA, AFTER_SCHEMA):
+            use_schema(cursor, schema)
+            cursor.execute('VACUUM ANALYZE email_details')
+    conn.autocommit = False
+
+def benchmark_queries(rows):
+    """
+    The compared queries: name -> (before (sql, params), after (sql, params)).
+    """
+    end = MAILBOX_START + datetime.timedelta(days=MAILBOX_SPAN_DAYS)
+    last_month = database.month_start(end - datetime.timedelta(days=31))
+    last_quarter = end - datetime.timedelta(days=90)
+    oldest_month_end = database.next_month(database.month_start(MAILBOX_START))
+    email_id = f'bench{rows // 2}'
+
+    search_sql, search_params = database.search_query(RARE_WORD, limit=20)
+    recent_search_sql, recent_search_params = database.search_query(RARE_WORD, limit=20, since=last_quarter)
+    common_search_sql, common_search_params = database.search_query('invoice deadline', limit=20)
+    return {
+        'rare word, top 20': (
+            ('SELECT id, emailid, subject, sender, date FROM email_details WHERE message LIKE %s ORDER BY date DESC LIMIT 20',
+             [f'%{RARE_WORD}%']),
+            (search_sql, search_params)),
+        'rare word, last 90 days': (
+            ('SELECT id, emailid, subject, sender, date FROM email_details WHERE message LIKE %s AND date >= %s '
+             'ORDER BY date DESC LIMIT 20', [f'%{RARE_WORD}%', last_quarter]),
+            (recent_search_sql, recent_search_params)),
+        'two common words, top 20': (
+            ('SELECT id, emailid, subject, sender, date FROM email_details WHERE message LIKE %s AND message LIKE %s '
+             'ORDER BY date DESC LIMIT 20', ['%invoice%', '%deadline%']),
+            (common_search_sql, common_search_params)),
+        'count of last month': (
+            ('SELECT count(*) FROM email_details WHERE date >= %s AND date < %s', [last_month, database.next_month(last_month)]),
+            ('SELECT count(*) FROM email_details WHERE date >= %s AND date < %s', [last_month, database.next_month(last_month)])),
+        'lookup by emailid': (
+            ('SELECT id FROM email_details WHERE emailid = %s', [email_id]),
+            ('SELECT id FROM email_details WHERE emailid = %s', [email_id])),
+        'archive oldest month': (
+            ('DELETE FROM email_details WHERE date < %s', [oldest_month_end]),
+            (sql.SQL('ALTER TABLE email_details DETACH PARTITION {}').format(
+                sql.Identifier(database.partition_name(database.month_start(MAILBOX_START)))), [])),
+    }
+
+def time_query(conn, schema, query, params, repeat):
+    """
+    Run a query `repeat` times in transactions that are rolled back.
+
+    Returns:
+        list: Seconds per run.
+    """
+    durations = []
+    with conn.cursor() as cursor:
+        for _ in range(repeat):
+            use_schema(cursor, schema)
+            started_at = time.perf_counter()
+            cursor.execute(query, params)
+            if cursor.description is not None:
+                cursor.fetchall()
+            durations.append(time.perf_counter() - started_at)
+            conn.rollback()
+    return durations
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000000, help='Emails generated into each layout.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per query; the median and the slowest are reported.')
+    parser.add_argument('--rebuild', action='store_true', help='Generate the tables again even if they hold --rows rows.')
+    args = parser.parse_args()
+
+    with database.connect() as conn:
+        with conn.cursor() as cursor:
+            existing = [schema_rows(cursor, schema) for schema in (BEFORE_SCHEMA, AFTER_SCHEMA)]
+        conn.rollback()
+        if args.rebuild or existing != [args.rows, args.rows]:
+            build_tables(conn, args.rows)
+
+        print(f"{'query':<26} {'before ms':>10} {'max':>9} {'after ms':>10} {'max':>9} {'speed-up':>9}")
+        for name, (before, after) in benchmark_queries(args.rows).items():
+            before_times = time_query(conn, BEFORE_SCHEMA, *before, args.repeat)
+            after_times = time_query(conn, AFTER_SCHEMA, *after, args.repeat)
+            before_ms, after_ms = statistics.median(before_times) * 1000, statistics.median(after_times) * 1000
+            print(f"{name:<26} {before_ms:>10.1f} {max(before_times) * 1000:>9.1f} {after_ms:>10.1f} "
+                  f"{max(after_times) * 1000:>9.1f} {before_ms / max(after_ms, 1e-9):>8.1f}x", flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Cold-start check of the entry point modules, based on python -X importtime.
+
+Each module is imported in a fresh interpreter. The script prints the cumulative
+import time and the slowest imports it pulls in. It fails if a module exceeds the
+budget, or if it imports a Google client library that should only be loaded on first use.
+
+Run from the repository root:
+
+    python -m benchmarks.check_import_time --budget-ms 250
+"""
+import re
+import sys
+import argparse
+import statistics
+import subprocess
+
+ENTRY_POINTS = ('fetch_and_save_emails', 'process_emails', 'email_daemon')
+
+# Heavy packages the entry points only need once they talk to Gmail
+DEFERRED_PACKAGES = ('googleapiclient', 'google_auth_oauthlib', 'google.oauth2')
+
+# Daemon startup is dominated by work done once, so only the cron scripts are held to the budget
+BUDGETED_ENTRY_POINTS = ('fetch_and_save_emails', 'process_emails')
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)$')
+
+def measure_import(module_name):
+    """
+    Import a module in a fresh interpreter with -X importtime.
+
+    Args:
+        module_name (str): Module to import.
+
+    Returns:
+        list: (module, self microseconds, cumulative microseconds, depth) for every import.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module_name}'],
+                            capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append((name, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return imports
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=250.0,
+                        help='Maximum median cumulative import time of the cron entry points.')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Fresh interpreters started per module; the median is reported.')
+    parser.add_argument('--top', type=int, default=5,
+                        help='Number of slowest direct imports listed per module.')
+    args = parser.parse_args()
+
+    # Modules the interpreter loads at startup (site hooks and the like) are not part of the entry points
+    startup_modules = {name for name, _, _, _ in measure_import('sys')}
+    failures = []
+    for module_name in ENTRY_POINTS:
+        runs = [measure_import(module_name) for _ in range(args.runs)]
+        totals_ms = [next(cumulative for name, _, cumulative, _ in imports if name == module_name) / 1000 for imports in runs]
+        total_ms = statistics.median(totals_ms)
+        print(f"{module_name}: {total_ms:.1f} ms (median of {args.runs})")
+
+        imports = runs[-1]
+        direct_imports = [entry for entry in imports if entry[3] == 1 and entry[0] not in startup_modules]
+        for name, _, cumulative, _ in sorted(direct_imports, key=lambda entry: entry[2], reverse=True)[:args.top]:
+            print(f"    {cumulative / 1000:8.1f} ms  {name}")
+
+        loaded = {name for name, _, _, _ in imports}
+        eager = sorted(name for name in loaded if name.startswith(DEFERRED_PACKAGES))
+        if eager:
+            failures.append(f"{module_name} imports {', '.join(eager[:3])} at module load")
+        if module_name in BUDGETED_ENTRY_POINTS and total_ms > args.budget_ms:
+            failures.append(f"{module_name} takes {total_ms:.1f} ms to import, budget is {args.budget_ms:.0f} ms")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+In-memory stand-in for the database functions used by the scripts, for the offline benchmarks.
+
+Inserted rows are counted and dropped, so a million-email run stays small. Rows
+to process are served from a pool of pre-generated synthetic rows, given the id
+and emailid of the row requested, so generating them does not count as database time.
+"""
+import time
+import collections
+from database import EMAIL_COLUMNS, STREAM_ITERSIZE, INSERT_BATCH_SIZE
+
+# Distinct synthetic rows kept in memory and reused for larger mailboxes
+ROW_POOL_SIZE = 10000
+
+class FakeEmailStore:
+    """
+    Fake of the 'email_details', 'sync_state' and 'email_processing_state' tables.
+
+    Args:
+        mailbox (SyntheticMailbox): Source of the stored rows.
+        latency_seconds (float): Round-trip time of each statement or cursor fetch.
+    """
+
+    def __init__(self, mailbox, latency_seconds=0.0):
+        self.mailbox = mailbox
+        self.latency_seconds = latency_seconds
+        self.sync_state = {}
+        self.inserted = 0
+        self.marked = 0
+        self.timings = collections.defaultdict(list)
+        self.row_pool = [mailbox.email_row(position)[2:] for position in range(min(mailbox.size, ROW_POOL_SIZE))]
+
+    def round_trip(self):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def create_table(self):
+        pass
+
+    def get_sync_state(self, sync_key):
+        return self.sync_state.get(sync_key)
+
+    def save_sync_state(self, sync_key, value):
+        self.sync_state[sync_key] = str(value)
+
+    def insert_emails(self, rows, batch_size=INSERT_BATCH_SIZE):
+        started_at = time.perf_counter()
+        rows = list({row[0]: row for row in rows}.values())
+        for _ in range(0, len(rows), batch_size):
+            self.round_trip()
+        self.inserted += len(rows)
+        self.timings['db.insert'].append(time.perf_counter() - started_at)
+        return len(rows)
+
+    def mark_emails_processed(self, email_ids, ruleset_hash, batch_size=INSERT_BATCH_SIZE):
+        email_ids = list(dict.fromkeys(email_ids))
+        if email_ids:
+            self.round_trip()
+        self.marked += len(email_ids)
+        return len(email_ids)
+
+    def email_id_bounds(self, where_clause=None, params=None):
+        self.round_trip()
+        return (1, self.mailbox.size) if self.mailbox.size else (None, None)
+
+    def stream_emails(self, columns=EMAIL_COLUMNS, where_clause=None, params=None, itersize=STREAM_ITERSIZE, id_range=None):
+        # The SQL filter only narrows the candidates, so serving every row gives the same rule results
+        positions = [EMAIL_COLUMNS.index(column) for column in columns]
+        start, end = id_range if id_range is not None else (1, self.mailbox.size + 1)
+        for chunk_start in range(start, end, itersize):
+            started_at = time.perf_counter()
+            self.round_trip()
+            chunk = []
+            for row_id in range(chunk_start, min(chunk_start + itersize, end)):
+                row = (row_id, self.mailbox.message_id(row_id - 1)) + self.row_pool[(row_id - 1) % len(self.row_pool)]
+                chunk.append(tuple(row[position] for position in positions))
+            self.timings['db.fetch'].append(time.perf_counter() - started_at)
+            yield from chunk
@@ -0,0 +1,180 @@
+"""
+In-process fake of the parts of the Gmail API the scripts use, for the offline benchmarks.
+
+Supports users().messages() list/get/modify/batchModify, users().labels() list/create,
+users().history().list, users().getProfile and HTTP batches, with a configurable
+per-call latency and a configurable share of sub-requests failing with HTTP 429.
+"""
+import json
+import time
+import random
+import threading
+import collections
+import httplib2
+from googleapiclient.errors import HttpError
+
+# Distinct synthetic messages generated; larger mailboxes reuse them under their own IDs,
+# so building messages does not dominate the time measured for Gmail calls
+MESSAGE_POOL_SIZE = 2000
+
+class FakeRequest:
+    """
+    Deferred call, executed on .execute() like googleapiclient.http.HttpRequest.
+    """
+
+    def __init__(self, service, method, handler, kwargs):
+        self.service = service
+        self.method = method
+        self.handler = handler
+        self.kwargs = kwargs
+
+    def execute(self):
+        started_at = time.perf_counter()
+        self.service.wait(self.method)
+        try:
+            return self.handler(**self.kwargs)
+        finally:
+            self.service.record(self.method, time.perf_counter() - started_at)
+
+class FakeBatch:
+    """
+    HTTP batch: one round trip for up to 100 sub-requests, each answered through the callback.
+    """
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        started_at = time.perf_counter()
+        self.service.wait('batch')
+        responses = []
+        for request, request_id in self.requests:
+            if self.service.throttled():
+                responses.append((request_id, None, quota_error()))
+            else:
+                self.service.count(request.method)
+                responses.append((request_id, request.handler(**request.kwargs), None))
+        self.service.record('batch', time.perf_counter() - started_at)
+        for response in responses:
+            self.callback(*response)
+
+def quota_error():
+    content = json.dumps({'error': {'code': 429, 'message': 'Rate Limit Exceeded',
+                                    'errors': [{'reason': 'rateLimitExceeded'}]}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': 429}), content)
+
+class Resource:
+    """
+    Attribute bag that makes service.users().messages().get(...) style chains work.
+    """
+
+    def __init__(self, **methods):
+        for name, method in methods.items():
+            setattr(self, name, method)
+
+class FakeGmailService:
+    """
+    Fake Gmail API service backed by a SyntheticMailbox.
+
+    Args:
+        mailbox (SyntheticMailbox): Messages served by the fake.
+        latency_seconds (float): Time each call or HTTP batch takes.
+        quota_error_rate (float): Share of batch sub-requests answered with HTTP 429.
+        seed (int): Seed of the quota error draws.
+    """
+
+    def __init__(self, mailbox, latency_seconds=0.0, quota_error_rate=0.0, seed=0):
+        self.mailbox = mailbox
+        self.latency_seconds = latency_seconds
+        self.quota_error_rate = quota_error_rate
+        self.rng = random.Random(seed)
+        self.labels = {'INBOX': 'INBOX', 'UNREAD': 'UNREAD', 'SPAM': 'SPAM'}
+        self.calls = collections.Counter()
+        self.timings = collections.defaultdict(list)
+        self.modified = 0
+        self.lock = threading.Lock()
+        self.message_pool = {}
+
+    def wait(self, method):
+        self.count(method)
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def count(self, method):
+        with self.lock:
+            self.calls[method] += 1
+
+    def record(self, method, seconds):
+        with self.lock:
+            self.timings[method].append(seconds)
+
+    def throttled(self):
+        with self.lock:
+            return self.rng.random() < self.quota_error_rate
+
+    def _request(self, method, handler):
+        return lambda **kwargs: FakeRequest(self, method, handler, kwargs)
+
+    def users(self):
+        return Resource(
+            messages=lambda: Resource(
+                list=self._request('messages.list', self._list_messages),
+                get=self._request('messages.get', self._get_message),
+                modify=self._request('messages.modify', self._modify_message),
+                batchModify=self._request('messages.batchModify', self._batch_modify),
+            ),
+            labels=lambda: Resource(
+                list=self._request('labels.list', self._list_labels),
+                create=self._request('labels.create', self._create_label),
+            ),
+            history=lambda: Resource(list=self._request('history.list', self._list_history)),
+            getProfile=self._request('getProfile', lambda userId: {'emailAddress': self.mailbox.owner, 'historyId': str(self.mailbox.size)}),
+        )
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def _list_messages(self, userId, labelIds=None, maxResults=100, pageToken=None, **kwargs):
+        start = int(pageToken) if pageToken else 0
+        end = min(start + maxResults, self.mailbox.size)
+        response = {'messages': [{'id': self.mailbox.message_id(position), 'threadId': self.mailbox.message_id(position)}
+                                 for position in range(start, end)],
+                    'resultSizeEstimate': self.mailbox.size}
+        if end < self.mailbox.size:
+            response['nextPageToken'] = str(end)
+        return response
+
+    def _get_message(self, userId, id, format='full', metadataHeaders=None):
+        headers_only = format == 'metadata'
+        key = (self.mailbox.position(id) % MESSAGE_POOL_SIZE, headers_only)
+        message = self.message_pool.get(key)
+        if message is None:
+            message = self.message_pool[key] = self.mailbox.message(self.mailbox.message_id(key[0]), headers_only)
+        return dict(message, id=id, threadId=id)
+
+    def _modify_message(self, userId, id, body):
+        with self.lock:
+            self.modified += 1
+        return {'id': id}
+
+    def _batch_modify(self, userId, body):
+        with self.lock:
+            self.modified += len(body['ids'])
+        return {}
+
+    def _list_labels(self, userId):
+        return {'labels': [{'id': label_id, 'name': name} for name, label_id in self.labels.items()]}
+
+    def _create_label(self, userId, body):
+        label_id = f'Label_{len(self.labels)}'
+        self.labels[body['name']] = label_id
+        return {'id': label_id, 'name': body['name']}
+
+    def _list_history(self, userId, startHistoryId, **kwargs):
+        # The synthetic mailbox never changes, so there is no history after the current id
+        return {'history': [], 'historyId': str(self.mailbox.size)}
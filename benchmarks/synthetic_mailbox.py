@@ -0,0 +1,159 @@
+"""
+Deterministic synthetic mailbox for the offline benchmarks.
+
+Every message is derived from the mailbox seed and its position alone, so a
+mailbox of a million messages costs no memory until a message is requested and
+the same message is produced on every run.
+"""
+import base64
+import random
+import datetime
+
+# Sender domains with Zipf-like weights: a few senders account for most mail
+SENDER_DOMAINS = ['amazon.in', 'swiggy.in', 'github.com', 'linkedin.com', 'gmail.com', 'zomato.com', 'hdfcbank.net',
+                  'medium.com', 'google.com', 'flipkart.com', 'substack.com', 'slack.com', 'uber.com', 'irctc.co.in',
+                  'example.org', 'news.ycombinator.com', 'atlassian.net', 'notion.so', 'spotify.com', 'netflix.com']
+SENDER_WEIGHTS = [1 / (rank + 1) for rank in range(len(SENDER_DOMAINS))]
+SENDER_NAMES = ['no-reply', 'notifications', 'orders', 'alerts', 'newsletter', 'support', 'team', 'billing', 'priya', 'rahul']
+
+SUBJECT_TEMPLATES = [
+    'Your order #{number} has been shipped',
+    'Invoice for {month} is ready',
+    'Re: {topic} review',
+    '[{topic}] Weekly digest',
+    '{name} mentioned you in {topic}',
+    'Your OTP is {number}',
+    "Don't want these emails? Update preferences",
+    'Payment of Rs. {number} received',
+    'Meeting invitation: {topic} sync',
+    'Security alert for your account',
+]
+TOPICS = ['backend', 'billing', 'design', 'infra', 'payments', 'search', 'mobile', 'growth', 'data', 'release']
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
+WORDS = ['order', 'delivery', 'account', 'update', 'payment', 'meeting', 'please', 'review', 'thanks', 'schedule',
+         'invoice', 'offer', 'discount', 'team', 'project', 'deadline', 'report', 'summary', 'café', 'naïve', '€20']
+
+# Message body structure: share of multipart/alternative, HTML-only and plain-only messages
+BODY_STRUCTURES = ['alternative', 'html', 'plain']
+BODY_STRUCTURE_WEIGHTS = [0.6, 0.3, 0.1]
+ATTACHMENT_RATE = 0.15
+
+# Body lengths are log-normal around about 1.5K characters, capped at 256K
+BODY_LENGTH_MU = 7.3
+BODY_LENGTH_SIGMA = 1.0
+MAX_BODY_LENGTH = 256 * 1024
+
+MAILBOX_START = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+MAILBOX_SPAN_SECONDS = 2 * 365 * 24 * 3600
+
+def encode_body(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+class SyntheticMailbox:
+    """
+    Mailbox of `size` messages, newest first, with realistic headers and bodies.
+    """
+
+    def __init__(self, size, seed=0, owner='me@gmail.com'):
+        self.size = size
+        self.seed = seed
+        self.owner = owner
+
+    def message_id(self, position):
+        return f'{self.seed:04x}{position:012x}'
+
+    def position(self, message_id):
+        return int(message_id[4:], 16)
+
+    def message_ids(self):
+        return (self.message_id(position) for position in range(self.size))
+
+    def _rng(self, position):
+        return random.Random(self.seed * 1_000_003 + position)
+
+    def _fields(self, position):
+        rng = self._rng(position)
+        domain = rng.choices(SENDER_DOMAINS, SENDER_WEIGHTS)[0]
+        sender = f'{rng.choice(SENDER_NAMES)}@{domain}'
+        subject = rng.choice(SUBJECT_TEMPLATES).format(
+            number=rng.randint(1000, 999999), month=rng.choice(MONTHS), topic=rng.choice(TOPICS), name=rng.choice(SENDER_NAMES).title())
+        # Newest message first, like messages.list
+        date = MAILBOX_START + datetime.timedelta(seconds=MAILBOX_SPAN_SECONDS * (self.size - position) // max(self.size, 1))
+        length = min(MAX_BODY_LENGTH, int(rng.lognormvariate(BODY_LENGTH_MU, BODY_LENGTH_SIGMA)))
+        words = []
+        total = 0
+        while total < length:
+            word = rng.choice(WORDS)
+            words.append(word)
+            total += len(word) + 1
+        text = ' '.join(words)
+        if sender.startswith(('no-reply', 'newsletter')):
+            text += " Don't want these emails? Unsubscribe."
+        structure = rng.choices(BODY_STRUCTURES, BODY_STRUCTURE_WEIGHTS)[0]
+        has_attachment = rng.random() < ATTACHMENT_RATE
+        return sender, subject, date, text, structure, has_attachment
+
+    def email_row(self, position):
+        """
+        Row of the message as fetch_and_save_emails stores it, without building the Gmail resource.
+
+        Returns:
+            tuple: (id, emailid, subject, sender, receiver, date, message).
+        """
+        sender, subject, date, text, _, _ = self._fields(position)
+        return (position + 1, self.message_id(position), subject, sender, self.owner, date, text)
+
+    def message(self, message_id, headers_only=False):
+        """
+        Gmail message resource as returned by messages.get.
+
+        Args:
+            message_id (str): ID of the message.
+            headers_only (bool): Return the format='metadata' resource.
+
+        Returns:
+            dict: Message resource.
+        """
+        position = self.position(message_id)
+        sender, subject, date, text, structure, has_attachment = self._fields(position)
+        headers = [
+            {'name': 'Subject', 'value': subject},
+            {'name': 'From', 'value': sender},
+            {'name': 'To', 'value': self.owner},
+            {'name': 'Date', 'value': date.strftime('%a, %d %b %Y %H:%M:%S %z')},
+            {'name': 'Message-ID', 'value': f'<{message_id}@mail.example.com>'},
+            {'name': 'Content-Type', 'value': 'multipart/mixed'},
+        ]
+        resource = {
+            'id': message_id,
+            'threadId': message_id,
+            'labelIds': ['INBOX', 'UNREAD'],
+            'snippet': text[:200],
+            'internalDate': str(int(date.timestamp() * 1000)),
+            'sizeEstimate': len(text) * 2,
+        }
+        if headers_only:
+            resource['payload'] = {'mimeType': 'multipart/mixed', 'headers': headers[:4]}
+            return resource
+
+        html_body = f'<html><head><style>p {{margin: 0}}</style></head><body><p>{text.replace(" ", " &nbsp;<b>", 20)}</p></body></html>'
+        parts = []
+        if structure == 'alternative':
+            parts.append({'mimeType': 'multipart/alternative', 'headers': [], 'body': {'size': 0}, 'parts': [
+                {'mimeType': 'text/plain', 'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset=UTF-8'}],
+                 'body': {'data': encode_body(text)}},
+                {'mimeType': 'text/html', 'headers': [{'name': 'Content-Type', 'value': 'text/html; charset=UTF-8'}],
+                 'body': {'data': encode_body(html_body)}},
+            ]})
+        elif structure == 'html':
+            parts.append({'mimeType': 'text/html', 'headers': [{'name': 'Content-Type', 'value': 'text/html; charset=UTF-8'}],
+                          'body': {'data': encode_body(html_body)}})
+        else:
+            parts.append({'mimeType': 'text/plain', 'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset=UTF-8'}],
+                          'body': {'data': encode_body(text)}})
+        if has_attachment:
+            parts.append({'mimeType': 'application/pdf', 'filename': 'invoice.pdf',
+                          'headers': [{'name': 'Content-Disposition', 'value': 'attachment; filename="invoice.pdf"'}],
+                          'body': {'attachmentId': f'att-{message_id}', 'size': 48213}})
+        resource['payload'] = {'mimeType': 'multipart/mixed', 'headers': headers, 'body': {'size': 0}, 'parts': parts}
+        return resource
@@ -1,6 +1,13 @@
+import logging
+import datetime
+import itertools
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+import psycopg2.errors
 from psycopg2 import sql
 from contextlib import contextmanager
+from metrics import timed, DB_QUERY_SECONDS, DB_ROWS
 
 # PostgreSQL credentials
 DB_HOST = 'localhost'
@@ -8,6 +15,48 @@ DB_NAME = 'postgres'
 DB_USER = 'sanjeev'
 DB_PASSWORD = 'sanjeevemail'
 
+# Connection pool settings
+DB_POOL_MIN_CONNECTIONS = 1
+DB_POOL_MAX_CONNECTIONS = 10
+
+# Number of rows sent to the server per INSERT statement
+INSERT_BATCH_SIZE = 500
+
+EMAIL_INSERT_COLUMNS = ('emailid', 'subject', 'sender', 'receiver', 'date', 'message')
+
+# Column layout of a full 'email_details' row
+EMAIL_COLUMNS = ('id',) + EMAIL_INSERT_COLUMNS
+
+# Rows transferred per round trip by server-side cursors
+STREAM_ITERSIZE = 2000
+
+# Partitioned tables can only enforce keys that include the partition column
+EMAIL_UNIQUE_KEY = 'email_details_emailid_date_key'
+
+# email_details is range partitioned by month of 'date': email_details_y2024m01 and so on
+PARTITION_PREFIX = 'email_details_y'
+DEFAULT_PARTITION = 'email_details_default'
+# Detached partitions are renamed so their month's partition can be created again
+ARCHIVED_SUFFIX = '_archived'
+
+# Text search configuration of the 'search_vector' column and of search queries
+TEXT_SEARCH_CONFIG = 'english'
+DEFAULT_SEARCH_LIMIT = 20
+SEARCH_RESULT_COLUMNS = ('id', 'emailid', 'subject', 'sender', 'date')
+
+# Text columns searched by rule 'contains' conditions
+TRIGRAM_INDEXED_COLUMNS = ('subject', 'sender', 'receiver', 'message')
+
+# sync_state key counting the writes to 'email_details', so copies of its rows can tell they are stale
+EMAIL_CHANGES_STATE_KEY = 'email_details_changes'
+
+_pool = None
+
+# Months whose partition this process has already created or found
+partition_cache = {'months': set()}
+
+logger = logging.getLogger(__name__)
+
 @contextmanager
 def connect():
     """
@@ -22,48 +71,608 @@ def connect():
     finally:
         conn.close()
 
+def get_pool():
+    """
+    Return the process-wide connection pool, creating it on first use.
+
+    Returns:
+        psycopg2.pool.ThreadedConnectionPool: Shared connection pool.
+    """
+    global _pool
+    if _pool is None or _pool.closed:
+        _pool = psycopg2.pool.ThreadedConnectionPool(
+            DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS,
+            host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD
+        )
+    return _pool
+
+def close_pool():
+    """
+    Close every connection held by the shared pool.
+    """
+    global _pool
+    if _pool is not None and not _pool.closed:
+        _pool.closeall()
+    _pool = None
+
+@contextmanager
+def pooled_connection():
+    """
+    Borrow a connection from the shared pool and return it when done.
+
+    Uncommitted work is rolled back before the connection goes back to the pool.
+
+    Yields:
+        psycopg2.extensions.connection: Pooled connection to the PostgreSQL database.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
 def create_email_table():
     """
-    Create the 'email_details' table if it does not exist.
+    Create the 'email_details' table if it does not exist, migrating an older layout.
+
+    The table is range partitioned by month of 'date'. A table created by an earlier
+    version, without partitions, is converted in place.
     """
-    print("Checking if 'email_details' table exists and creating if not...")
+    logger.info("Checking if 'email_details' table exists and creating if not...")
     with connect() as conn:
         with conn.cursor() as cursor:
-            # Create the 'email_details' table if it does not exist
+            table_kind = email_table_kind(cursor)
+            if table_kind is None:
+                create_partitioned_email_table(cursor)
+            elif table_kind == 'r':
+                migrate_date_to_timestamptz(cursor)
+                migrate_to_partitioned(cursor)
+            create_email_indexes(cursor)
+            # Writes to 'email_details' are counted in 'sync_state'
+            cursor.execute(SYNC_STATE_TABLE_QUERY)
+            conn.commit()
+
+def email_table_kind(cursor):
+    """
+    Look up how 'email_details' is stored.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Cursor of the open transaction.
+
+    Returns:
+        str: 'p' for a partitioned table, 'r' for a plain table, or None if it does not exist.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('email_details')")
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def create_partitioned_email_table(cursor):
+    """
+    Create 'email_details' partitioned by 'date', with its default partition.
+
+    A partitioned table can only enforce uniqueness on keys that include the partition
+    column, so emails are unique by (emailid, date). NULLS NOT DISTINCT (PostgreSQL 15)
+    keeps emails without a date unique as well; they are stored in the default partition.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Cursor of the open transaction.
+    """
+    cursor.execute(sql.SQL('''
+        CREATE TABLE IF NOT EXISTS email_details (
+            id BIGSERIAL NOT NULL,
+            emailid VARCHAR NOT NULL,
+            subject TEXT,
+            sender TEXT,
+            receiver TEXT,
+            date TIMESTAMPTZ,
+            message TEXT,
+            search_vector TSVECTOR GENERATED ALWAYS AS (
+                setweight(to_tsvector({config}, coalesce(subject, '')), 'A') ||
+                setweight(to_tsvector({config}, coalesce(sender, '')), 'B') ||
+                setweight(to_tsvector({config}, coalesce(message, '')), 'D')
+            ) STORED,
+            CONSTRAINT {unique_key} UNIQUE NULLS NOT DISTINCT (emailid, date)
+        ) PARTITION BY RANGE (date)
+    ''').format(config=sql.Literal(TEXT_SEARCH_CONFIG), unique_key=sql.Identifier(EMAIL_UNIQUE_KEY)))
+    cursor.execute(sql.SQL('CREATE TABLE IF NOT EXISTS {} PARTITION OF email_details DEFAULT').format(
+        sql.Identifier(DEFAULT_PARTITION)
+    ))
+
+def migrate_to_partitioned(cursor):
+    """
+    Convert a plain 'email_details' table into the partitioned layout.
+
+    Runs inside the caller's transaction: the old table is renamed, every month that
+    holds emails gets a partition, the rows are copied with their ids, and the old table
+    is dropped. Duplicate emails are dropped on the way, keeping the oldest row of
+    each emailid.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Cursor of the open transaction.
+
+    Returns:
+        int: Number of rows copied.
+    """
+    cursor.execute('ALTER TABLE email_details RENAME TO email_details_unpartitioned')
+    # Index and constraint names are schema-wide, so free them for the new table
+    cursor.execute('''
+        SELECT conname FROM pg_constraint WHERE conrelid = 'email_details_unpartitioned'::regclass AND contype IN ('p', 'u')
+    ''')
+    for (constraint_name,) in cursor.fetchall():
+        cursor.execute(sql.SQL('ALTER TABLE email_details_unpartitioned DROP CONSTRAINT {}').format(sql.Identifier(constraint_name)))
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'email_details_unpartitioned'")
+    for (index_name,) in cursor.fetchall():
+        cursor.execute(sql.SQL('DROP INDEX {}').format(sql.Identifier(index_name)))
+
+    create_partitioned_email_table(cursor)
+    cursor.execute("SELECT count(*) FROM email_details_unpartitioned")
+    old_rows = cursor.fetchone()[0]
+    # Only months holding mail get a partition, so a few stray dates decades apart cost a few partitions
+    cursor.execute('''
+        SELECT DISTINCT date_trunc('month', date AT TIME ZONE 'UTC') FROM email_details_unpartitioned
+        WHERE date IS NOT NULL ORDER BY 1
+    ''')
+    for (month,) in cursor.fetchall():
+        create_month_partition(cursor, month.replace(tzinfo=datetime.timezone.utc))
+    cursor.execute('''
+        INSERT INTO email_details (id, emailid, subject, sender, receiver, date, message)
+        SELECT DISTINCT ON (emailid) id, emailid, subject, sender, receiver, date, message
+        FROM email_details_unpartitioned
+        WHERE emailid IS NOT NULL
+        ORDER BY emailid, id
+    ''')
+    copied = cursor.rowcount
+    cursor.execute("SELECT setval(pg_get_serial_sequence('email_details', 'id'), coalesce(max(id), 0) + 1, false) FROM email_details")
+    cursor.execute('DROP TABLE email_details_unpartitioned')
+    if old_rows != copied:
+        logger.warning("Removed %d duplicate emails from 'email_details'", old_rows - copied)
+    logger.info("Moved %d emails into the partitioned 'email_details' table", copied)
+    return copied
+
+def migrate_date_to_timestamptz(cursor):
+    """
+    Convert a 'date' column created as TIMESTAMP to TIMESTAMPTZ.
+
+    Earlier versions stored dates without their offset, so existing values are
+    interpreted as UTC.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Cursor of the open transaction.
+
+    Returns:
+        bool: True if the column was converted.
+    """
+    cursor.execute('''
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'email_details' AND column_name = 'date'
+    ''')
+    row = cursor.fetchone()
+    if not row or row[0] != 'timestamp without time zone':
+        return False
+    cursor.execute("ALTER TABLE email_details ALTER COLUMN date TYPE TIMESTAMPTZ USING date AT TIME ZONE 'UTC'")
+    return True
+
+def create_email_indexes(cursor):
+    """
+    Create the indexes that serve rule conditions pushed down to SQL and full-text search.
+
+    A btree on 'date' serves the date range predicates, pg_trgm GIN indexes serve
+    the substring (LIKE) predicates on the text fields, a GIN index on
+    'search_vector' serves search_emails, and a btree on 'id' serves the id range
+    scans of the rule workers. Indexes created on the partitioned table are created
+    on every partition, present and future.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Cursor of the open transaction.
+    """
+    cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    cursor.execute('CREATE INDEX IF NOT EXISTS email_details_id_idx ON email_details (id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS email_details_date_idx ON email_details (date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS email_details_search_idx ON email_details USING GIN (search_vector)')
+    for column in TRIGRAM_INDEXED_COLUMNS:
+        cursor.execute(sql.SQL('CREATE INDEX IF NOT EXISTS {} ON email_details USING GIN ({} gin_trgm_ops)').format(
+            sql.Identifier(f'email_details_{column}_trgm_idx'), sql.Identifier(column)
+        ))
+
+def month_start(value):
+    """
+    First instant of the UTC month containing a timezone-aware datetime.
+    """
+    value = value.astimezone(datetime.timezone.utc)
+    return datetime.datetime(value.year, value.month, 1, tzinfo=datetime.timezone.utc)
+
+def next_month(month):
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+def months_between(first_date, last_date):
+    """
+    List the UTC months from the one containing first_date to the one containing last_date.
+
+    Returns:
+        list: First instant of each month.
+    """
+    months = []
+    month = month_start(first_date)
+    last_month = month_start(last_date)
+    while month <= last_month:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+def partition_name(month):
+    return f'{PARTITION_PREFIX}{month.year:04d}m{month.month:02d}'
+
+def create_month_partition(cursor, month):
+    """
+    Create the partition of 'email_details' holding one month of email, if it is not attached yet.
+
+    The catalog is checked rather than relying on CREATE TABLE IF NOT EXISTS, which
+    would accept a detached table of the same name. Such a table is renamed with
+    ARCHIVED_SUFFIX first. Rows of the month that already landed in the default
+    partition would make the new partition fail its check, so they are moved into it.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Cursor of the open transaction.
+        month (datetime.datetime): First instant of the UTC month.
+
+    Returns:
+        str: Name of the partition.
+    """
+    name = partition_name(month)
+    bounds = {'name': name, 'start': month, 'end': next_month(month)}
+    cursor.execute(sql.SQL('''
+        SELECT
+            EXISTS (SELECT 1 FROM pg_inherits WHERE inhparent = 'email_details'::regclass AND inhrelid = to_regclass(%(name)s)),
+            to_regclass(%(name)s) IS NOT NULL,
+            (SELECT count(*) FROM {default} WHERE date >= %(start)s AND date < %(end)s)
+    ''').format(default=sql.Identifier(DEFAULT_PARTITION)), bounds)
+    attached, exists, default_rows = cursor.fetchone()
+    if attached:
+        return name
+    if exists:
+        logger.warning("Renaming table %s, which is not a partition of 'email_details', to %s", name, name + ARCHIVED_SUFFIX)
+        cursor.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(sql.Identifier(name), sql.Identifier(name + ARCHIVED_SUFFIX)))
+    if default_rows:
+        logger.warning("Moving %d emails from the default partition into %s", default_rows, name)
+        cursor.execute(sql.SQL('''
+            CREATE TEMPORARY TABLE email_details_moved AS
+            WITH moved AS (
+                DELETE FROM {default} WHERE date >= %(start)s AND date < %(end)s
+                RETURNING id, emailid, subject, sender, receiver, date, message
+            )
+            SELECT * FROM moved
+        ''').format(default=sql.Identifier(DEFAULT_PARTITION)), bounds)
+    cursor.execute(sql.SQL('CREATE TABLE {} PARTITION OF email_details FOR VALUES FROM ({}) TO ({})').format(
+        sql.Identifier(name), sql.Literal(month.isoformat()), sql.Literal(next_month(month).isoformat())
+    ))
+    if default_rows:
+        cursor.execute('''
+            INSERT INTO email_details (id, emailid, subject, sender, receiver, date, message)
+            SELECT id, emailid, subject, sender, receiver, date, message FROM email_details_moved
+        ''')
+        cursor.execute('DROP TABLE email_details_moved')
+    return name
+
+def ensure_partitions(dates):
+    """
+    Make sure every month of the given dates has its partition before rows are inserted.
+
+    A row of a month without a partition would land in the default partition and
+    have to be moved later. Months already seen by this process are skipped without
+    a round trip.
+
+    Args:
+        dates (iterable): Timezone-aware email dates; None is ignored.
+
+    Returns:
+        list: Names of the partitions checked.
+    """
+    months = {month_start(date) for date in dates if date is not None} - partition_cache['months']
+    if not months:
+        return []
+    names = []
+    with pooled_connection() as conn:
+        for month in sorted(months):
+            try:
+                with conn.cursor() as cursor:
+                    names.append(create_month_partition(cursor, month))
+                conn.commit()
+            except (psycopg2.errors.DuplicateTable, psycopg2.errors.UniqueViolation):
+                # Another process created the same partition first; the next call finds it attached
+                conn.rollback()
+                continue
+            partition_cache['months'].add(month)
+    return names
+
+def list_month_partitions():
+    """
+    List the monthly partitions of 'email_details'.
+
+    Returns:
+        list: (partition name, first instant of its month), oldest first.
+    """
+    with pooled_connection() as conn:
+        with conn.cursor() as cursor:
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS email_details (
-                    id SERIAL PRIMARY KEY,
-                    emailid VARCHAR,
-                    subject TEXT,
-                    sender TEXT,
-                    receiver TEXT,
-                    date TIMESTAMP,
-                    message TEXT
+                SELECT child.relname FROM pg_inherits
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE pg_inherits.inhparent = 'email_details'::regclass
+            ''')
+            names = [row[0] for row in cursor.fetchall()]
+        conn.rollback()
+    partitions = []
+    for name in names:
+        if name.startswith(PARTITION_PREFIX):
+            year, month = name[len(PARTITION_PREFIX):].split('m')
+            partitions.append((name, datetime.datetime(int(year), int(month), 1, tzinfo=datetime.timezone.utc)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+def detach_partitions_before(cutoff):
+    """
+    Detach the monthly partitions that end on or before a cutoff date.
+
+    Detaching only changes the catalog, so old mail leaves 'email_details' without
+    deleting rows one by one. The detached tables keep their data under a name ending
+    in ARCHIVED_SUFFIX, so a late email of the month gets a new partition instead of
+    being mistaken for the archive. They can be dumped and dropped, or attached again.
+
+    Args:
+        cutoff (datetime.datetime): Timezone-aware date; months entirely before it are detached.
+
+    Returns:
+        list: Names of the archived tables.
+    """
+    detached = [name for name, month in list_month_partitions() if next_month(month) <= cutoff]
+    with pooled_connection() as conn:
+        with conn.cursor() as cursor:
+            for name in detached:
+                cursor.execute(sql.SQL('ALTER TABLE email_details DETACH PARTITION {}').format(sql.Identifier(name)))
+                cursor.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(sql.Identifier(name), sql.Identifier(name + ARCHIVED_SUFFIX)))
+            if detached:
+                count_email_changes(cursor)
+        conn.commit()
+    partition_cache['months'].clear()
+    return [name + ARCHIVED_SUFFIX for name in detached]
+
+SYNC_STATE_TABLE_QUERY = '''
+    CREATE TABLE IF NOT EXISTS sync_state (
+        sync_key VARCHAR PRIMARY KEY,
+        value TEXT NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+'''
+
+def create_sync_state_table():
+    """
+    Create the 'sync_state' table, which stores sync checkpoints by key, if it does not exist.
+    """
+    with connect() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(SYNC_STATE_TABLE_QUERY)
+            conn.commit()
+
+def count_email_changes(cursor):
+    """
+    Add one to the count of writes to 'email_details', in the caller's transaction.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): Cursor of the transaction that changed the emails.
+    """
+    cursor.execute('''
+        INSERT INTO sync_state (sync_key, value) VALUES (%s, '1')
+        ON CONFLICT (sync_key) DO UPDATE SET value = (sync_state.value::bigint + 1)::text, updated_at = NOW()
+    ''', (EMAIL_CHANGES_STATE_KEY,))
+
+def get_sync_state(sync_key):
+    """
+    Read a checkpoint from the 'sync_state' table.
+
+    Args:
+        sync_key (str): Name of the checkpoint.
+
+    Returns:
+        str: Stored value, or None if the checkpoint has never been saved.
+    """
+    with pooled_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT value FROM sync_state WHERE sync_key = %s', (sync_key,))
+            row = cursor.fetchone()
+    return row[0] if row else None
+
+def save_sync_state(sync_key, value):
+    """
+    Create or update a checkpoint in the 'sync_state' table.
+
+    Args:
+        sync_key (str): Name of the checkpoint.
+        value (str): Value to store.
+    """
+    with pooled_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO sync_state (sync_key, value) VALUES (%s, %s)
+                ON CONFLICT (sync_key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
+            ''', (sync_key, str(value)))
+            conn.commit()
+
+def create_processing_state_table():
+    """
+    Create the 'email_processing_state' table, which records the ruleset each email was last processed with.
+    """
+    with connect() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS email_processing_state (
+                    emailid VARCHAR PRIMARY KEY,
+                    ruleset_hash VARCHAR NOT NULL,
+                    processed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
                 )
             ''')
             conn.commit()
 
+def unprocessed_email_filter(ruleset_hash):
+    """
+    Build a condition matching the emails not yet processed with a ruleset.
+
+    Emails never processed and emails processed with another version of the rules both match.
+
+    Args:
+        ruleset_hash (str): Hash of the current ruleset.
+
+    Returns:
+        tuple: (psycopg2.sql.Composable, list of parameters).
+    """
+    return sql.SQL('''NOT EXISTS (
+        SELECT 1 FROM email_processing_state
+        WHERE email_processing_state.emailid = email_details.emailid
+        AND email_processing_state.ruleset_hash = %s
+    )'''), [ruleset_hash]
+
+def processed_email_filter(ruleset_hash):
+    """
+    Build a condition matching the emails last processed with a ruleset.
+
+    Args:
+        ruleset_hash (str): Hash of the ruleset.
+
+    Returns:
+        tuple: (psycopg2.sql.Composable, list of parameters).
+    """
+    return sql.SQL('''EXISTS (
+        SELECT 1 FROM email_processing_state
+        WHERE email_processing_state.emailid = email_details.emailid
+        AND email_processing_state.ruleset_hash = %s
+    )'''), [ruleset_hash]
+
+def advance_processed_emails(previous_ruleset_hash, ruleset_hash, excluded_email_ids=()):
+    """
+    Record the emails processed with one ruleset as processed with another, without evaluating them again.
+
+    Args:
+        previous_ruleset_hash (str): Hash of the ruleset the emails were processed with.
+        ruleset_hash (str): Hash of the ruleset they are now recorded with.
+        excluded_email_ids (iterable): IDs of emails left as they are.
+
+    Returns:
+        int: Number of emails recorded.
+    """
+    with timed(DB_QUERY_SECONDS, operation='mark_processed'), pooled_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                UPDATE email_processing_state SET ruleset_hash = %s
+                WHERE ruleset_hash = %s AND NOT (emailid = ANY(%s))
+            ''', (ruleset_hash, previous_ruleset_hash, list(excluded_email_ids)))
+            advanced = cursor.rowcount
+            conn.commit()
+    DB_ROWS.inc(advanced, operation='mark_processed')
+    return advanced
+
+def mark_emails_processed(email_ids, ruleset_hash, batch_size=INSERT_BATCH_SIZE):
+    """
+    Record that emails have been processed with a ruleset.
+
+    Args:
+        email_ids (iterable): IDs of the processed emails.
+        ruleset_hash (str): Hash of the ruleset they were processed with.
+        batch_size (int): Number of rows sent to the server per statement.
+
+    Returns:
+        int: Number of distinct emails recorded.
+    """
+    rows = [(email_id, ruleset_hash) for email_id in dict.fromkeys(email_ids)]
+    if not rows:
+        return 0
+    with timed(DB_QUERY_SECONDS, operation='mark_processed'), pooled_connection() as conn:
+        with conn.cursor() as cursor:
+            psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO email_processing_state (emailid, ruleset_hash) VALUES %s
+                ON CONFLICT (emailid) DO UPDATE SET ruleset_hash = EXCLUDED.ruleset_hash, processed_at = NOW()
+            ''', rows, page_size=batch_size)
+            conn.commit()
+    DB_ROWS.inc(len(rows), operation='mark_processed')
+    return len(rows)
+
+# Moves a stored email to the date it is being written with, so the upsert below finds it.
+# Dates can differ for the same email: rows migrated from TIMESTAMP kept the sender's wall
+# time as UTC. Updating the partition key moves the row to its new partition, keeping its id.
+MOVE_CHANGED_DATES_QUERY = '''
+    UPDATE email_details AS stored SET date = incoming.date
+    FROM (VALUES %s) AS incoming (emailid, date)
+    WHERE stored.emailid = incoming.emailid AND stored.date IS DISTINCT FROM incoming.date
+'''
+MOVE_CHANGED_DATES_TEMPLATE = '(%s, %s::timestamptz)'
+
+# The conflict target is the partitioned table's unique key; a conflict implies the same date
+UPSERT_CONFLICT_CLAUSE = '''
+    ON CONFLICT (emailid, date) DO UPDATE SET
+        subject = EXCLUDED.subject,
+        sender = EXCLUDED.sender,
+        receiver = EXCLUDED.receiver,
+        message = EXCLUDED.message
+'''
+
 def insert_email(email_id, subject, sender, receiver, date, message):
     """
-    Insert email details into the 'email_details' table.
+    Insert email details into the 'email_details' table, updating the row if the email is already stored.
 
     Args:
         email_id (str): Email ID.
         subject (str): Email subject.
         sender (str): Sender's email address.
         receiver (str): Receiver's email address.
-        date (str): Email date.
+        date (datetime.datetime): Timezone-aware email date.
         message (str): Email message.
     """
-    with connect() as conn:
+    ensure_partitions([date])
+    with pooled_connection() as conn:
         with conn.cursor() as cursor:
+            cursor.execute(MOVE_CHANGED_DATES_QUERY % MOVE_CHANGED_DATES_TEMPLATE, (email_id, date))
             # Insert email details into the 'email_details' table
             query = sql.SQL('''
                 INSERT INTO email_details (emailid, subject, sender, receiver, date, message)
                 VALUES (%s, %s, %s, %s, %s, %s)
-            ''')
+            ''' + UPSERT_CONFLICT_CLAUSE)
             cursor.execute(query, (email_id, subject, sender, receiver, date, message))
+            count_email_changes(cursor)
+            conn.commit()
+
+def insert_emails(rows, batch_size=INSERT_BATCH_SIZE):
+    """
+    Upsert many emails into the 'email_details' table with multi-row INSERTs.
+
+    Emails that are already stored are updated in place, so re-running the fetch
+    never adds duplicate rows. A stored email whose date differs is first moved to
+    the new date in the same transaction, so 'emailid' stays unique even though the
+    table's key is (emailid, date).
+
+    Args:
+        rows (iterable): Tuples of (email_id, subject, sender, receiver, date, message).
+        batch_size (int): Number of rows sent to the server per statement.
+
+    Returns:
+        int: Number of distinct emails written.
+    """
+    # One statement may not update the same row twice, so keep the last copy of each email
+    rows = list({row[0]: row for row in rows}.values())
+    if not rows:
+        return 0
+    ensure_partitions(row[4] for row in rows)
+    with timed(DB_QUERY_SECONDS, operation='insert'), pooled_connection() as conn:
+        with conn.cursor() as cursor:
+            psycopg2.extras.execute_values(cursor, MOVE_CHANGED_DATES_QUERY, [(row[0], row[4]) for row in rows],
+                                           template=MOVE_CHANGED_DATES_TEMPLATE, page_size=batch_size)
+            query = sql.SQL('INSERT INTO email_details ({}) VALUES %s' + UPSERT_CONFLICT_CLAUSE).format(
+                sql.SQL(', ').join(map(sql.Identifier, EMAIL_INSERT_COLUMNS))
+            )
+            psycopg2.extras.execute_values(cursor, query, rows, page_size=batch_size)
+            count_email_changes(cursor)
             conn.commit()
+    DB_ROWS.inc(len(rows), operation='insert')
+    return len(rows)
 
 def fetch_all_emails():
     """
@@ -75,5 +684,178 @@ def fetch_all_emails():
     with connect() as conn:
         with conn.cursor() as cursor:
             # Fetch all emails from the 'email_details' table
-            cursor.execute('SELECT * FROM email_details')
+            cursor.execute(sql.SQL('SELECT {} FROM email_details').format(sql.SQL(', ').join(map(sql.Identifier, EMAIL_COLUMNS))))
             return cursor.fetchall()
+
+def email_filter(where_clause=None, params=None, id_range=None):
+    """
+    Combine an optional condition with an optional id range into one WHERE clause.
+
+    Args:
+        where_clause (psycopg2.sql.Composable): Optional condition restricting the rows.
+        params (list): Parameters referenced by where_clause.
+        id_range (tuple): Optional (start, end) range of ids; start is included, end is not.
+
+    Returns:
+        tuple: (psycopg2.sql.Composable or None, list of parameters).
+    """
+    clauses = []
+    params = list(params or [])
+    if where_clause is not None:
+        clauses.append(sql.SQL('({})').format(where_clause))
+    if id_range is not None:
+        clauses.append(sql.SQL('id >= %s AND id < %s'))
+        params.extend(id_range)
+    if not clauses:
+        return None, params
+    return sql.SQL(' AND ').join(clauses), params
+
+def email_id_bounds(where_clause=None, params=None):
+    """
+    Find the smallest and largest id of the emails matching a condition.
+
+    Args:
+        where_clause (psycopg2.sql.Composable): Optional condition restricting the rows.
+        params (list): Parameters referenced by where_clause.
+
+    Returns:
+        tuple: (min id, max id), or (None, None) if no email matches.
+    """
+    query = sql.SQL('SELECT min(id), max(id) FROM email_details')
+    if where_clause is not None:
+        query = sql.SQL('{} WHERE {}').format(query, where_clause)
+    with pooled_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query, params)
+            bounds = cursor.fetchone()
+        conn.rollback()
+    return bounds
+
+def email_table_version():
+    """
+    Describe the current contents of 'email_details' cheaply enough to tell whether a copy is stale.
+
+    The id bounds and row count catch rows added or deleted by any client; the write
+    count kept by insert_emails, insert_email and detach_partitions_before catches
+    emails updated in place.
+
+    Returns:
+        list: [min id, max id, number of rows, number of writes].
+    """
+    with pooled_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT min(id), max(id), count(*), (SELECT value::bigint FROM sync_state WHERE sync_key = %s)
+                FROM email_details
+            ''', (EMAIL_CHANGES_STATE_KEY,))
+            version = cursor.fetchone()
+        conn.rollback()
+    return list(version)
+
+def stream_emails(columns=EMAIL_COLUMNS, where_clause=None, params=None, itersize=STREAM_ITERSIZE, id_range=None, order_by=sql.SQL('id')):
+    """
+    Stream emails from the 'email_details' table through a server-side cursor.
+
+    Only itersize rows are transferred and held in memory at a time, and the
+    connection stays open until the generator is exhausted or closed.
+
+    Args:
+        columns (tuple): Columns to select, in the order they appear in each row.
+        where_clause (psycopg2.sql.Composable): Optional condition restricting the rows.
+        params (list): Parameters referenced by where_clause.
+        itersize (int): Number of rows fetched from the server per round trip.
+        id_range (tuple): Optional (start, end) range of ids; start is included, end is not.
+        order_by (psycopg2.sql.Composable): ORDER BY expression of the rows.
+
+    Yields:
+        tuple: Email details in the order of columns.
+    """
+    where_clause, params = email_filter(where_clause, params, id_range)
+    query = sql.SQL('SELECT {} FROM email_details').format(sql.SQL(', ').join(map(sql.Identifier, columns)))
+    if where_clause is not None:
+        query = sql.SQL('{} WHERE {}').format(query, where_clause)
+    query = sql.SQL('{} ORDER BY {}').format(query, order_by)
+    with pooled_connection() as conn:
+        # A named cursor lives on the server and is fetched in itersize chunks
+        with conn.cursor(name='stream_emails') as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, params)
+            rows = iter(cursor)
+            while True:
+                # Only the first row of each chunk waits for a round trip
+                with timed(DB_QUERY_SECONDS, operation='fetch'):
+                    chunk = list(itertools.islice(rows, itersize))
+                if not chunk:
+                    break
+                DB_ROWS.inc(len(chunk), operation='fetch')
+                yield from chunk
+        conn.rollback()
+
+def text_search_filter(query):
+    """
+    Build a condition matching the emails whose subject, sender or message match a full-text query.
+
+    The query uses web search syntax: words must all appear, "quoted phrases" must
+    appear in order, 'or' separates alternatives and a leading '-' excludes a word.
+    Words are stemmed, so 'invoices' also finds 'invoice'. The condition is served by
+    the GIN index on 'search_vector' and can be passed to stream_emails.
+
+    Args:
+        query (str): Search text.
+
+    Returns:
+        tuple: (psycopg2.sql.Composable, list of parameters).
+    """
+    return sql.SQL('search_vector @@ websearch_to_tsquery({}, %s)').format(sql.Literal(TEXT_SEARCH_CONFIG)), [query]
+
+def search_query(query, limit=DEFAULT_SEARCH_LIMIT, since=None, until=None, columns=SEARCH_RESULT_COLUMNS):
+    """
+    Build the ranked full-text search run by search_emails.
+
+    Returns:
+        tuple: (psycopg2.sql.Composable, list of parameters).
+    """
+    search_clause, params = text_search_filter(query)
+    clauses = [search_clause]
+    if since is not None:
+        clauses.append(sql.SQL('date >= %s'))
+        params.append(since)
+    if until is not None:
+        clauses.append(sql.SQL('date < %s'))
+        params.append(until)
+    query_sql = sql.SQL('''
+        SELECT {columns}, ts_rank_cd(search_vector, websearch_to_tsquery({config}, %s)) AS rank
+        FROM email_details WHERE {where}
+        ORDER BY rank DESC, date DESC LIMIT %s
+    ''').format(
+        columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+        config=sql.Literal(TEXT_SEARCH_CONFIG),
+        where=sql.SQL(' AND ').join(clauses),
+    )
+    return query_sql, [query] + params + [limit]
+
+def search_emails(query, limit=DEFAULT_SEARCH_LIMIT, since=None, until=None, columns=SEARCH_RESULT_COLUMNS):
+    """
+    Find the emails best matching a full-text query.
+
+    Matches in the subject rank above matches in the sender, which rank above
+    matches in the message. Giving since or until limits the search to the
+    partitions of those months.
+
+    Args:
+        query (str): Search text, in the syntax described in text_search_filter.
+        limit (int): Maximum number of results.
+        since (datetime.datetime): Only emails dated on or after this time.
+        until (datetime.datetime): Only emails dated before this time.
+        columns (tuple): Columns returned for each email.
+
+    Returns:
+        list: Tuples of the columns followed by the rank, best match first.
+    """
+    query_sql, params = search_query(query, limit, since, until, columns)
+    with timed(DB_QUERY_SECONDS, operation='search'), pooled_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query_sql, params)
+            results = cursor.fetchall()
+        conn.rollback()
+    return results
@@ -0,0 +1,398 @@
+import json
+import queue
+import signal
+import threading
+import time
+import logging
+import argparse
+from database import (create_email_table, create_sync_state_table, create_processing_state_table, get_sync_state, save_sync_state, insert_emails,
+                      mark_emails_processed, close_pool, EMAIL_INSERT_COLUMNS)
+from fetch_and_save_emails import (authenticate_gmail, build_gmail_service, is_history_expired_error, history_checkpoint_key, get_current_history_id, list_history_message_ids, list_message_ids,
+                                   retryable_failure_count, batched, fetch_stage, clean_stage, DEFAULT_LABEL_IDS, DEFAULT_PAGE_SIZE, EMAIL_BUFFER_SIZE)
+from process_emails import (use_rules, fetch_emails_from_database, resolve_folder_label_ids, actions_to_label_delta, email_label_delta, batch_modify_emails,
+                            configure_label_cache, LABEL_CACHE_FILE)
+from rule_watcher import RuleWatcher
+from metrics import add_metrics_arguments, exporting_metrics, EMAILS_EVALUATED
+from logging_config import configure_logging, add_logging_arguments
+
+# Seconds between two history checks when no push notifications are used
+DEFAULT_POLL_INTERVAL_SECONDS = 10
+# Gmail stops push notifications after 7 days unless users().watch is called again
+WATCH_RENEW_SECONDS = 24 * 60 * 60
+# Wait after a failed sync before trying again, doubled up to the maximum
+SYNC_RETRY_SECONDS = 5
+SYNC_RETRY_MAX_SECONDS = 300
+
+# Returned by a notification source whose wait ended without news, so the daemon can check the rules file
+IDLE = object()
+
+logger = logging.getLogger(__name__)
+
+class HistoryPollSource:
+    """
+    Notification source that asks Gmail for the mailbox's historyId at a fixed interval.
+
+    getProfile costs one quota unit, so an idle mailbox is cheap to watch.
+    """
+
+    def __init__(self, gmail_service, interval_seconds=DEFAULT_POLL_INTERVAL_SECONDS):
+        self.gmail_service = gmail_service
+        self.interval_seconds = interval_seconds
+        self.stopped = threading.Event()
+
+    def next_notification(self):
+        """
+        Wait for the next poll.
+
+        Returns:
+            str: Current historyId of the mailbox, or None once the source is stopped.
+        """
+        if self.stopped.wait(self.interval_seconds):
+            return None
+        return get_current_history_id(self.gmail_service)
+
+    def stop(self):
+        self.stopped.set()
+
+class PubSubSource:
+    """
+    Notification source fed by Gmail push notifications through a Cloud Pub/Sub subscription.
+
+    Needs the optional google-cloud-pubsub package. Gmail is asked to publish mailbox
+    changes to topic_name, and the notifications are pulled from subscription_name.
+    A wait for a notification ends after wait_seconds, so a quiet mailbox does not
+    keep the daemon from noticing an edited rules file.
+    """
+
+    def __init__(self, gmail_service, topic_name, subscription_name, label_ids=None, renew_seconds=WATCH_RENEW_SECONDS,
+                 wait_seconds=DEFAULT_POLL_INTERVAL_SECONDS):
+        try:
+            from google.cloud import pubsub_v1
+        except ImportError as e:
+            raise ImportError('Push notifications need the google-cloud-pubsub package: pip install google-cloud-pubsub') from e
+        self.gmail_service = gmail_service
+        self.topic_name = topic_name
+        self.label_ids = label_ids if label_ids is not None else DEFAULT_LABEL_IDS
+        self.renew_seconds = renew_seconds
+        self.wait_seconds = wait_seconds
+        self.notifications = queue.Queue()
+        self.watched_at = 0.0
+        self.subscriber = pubsub_v1.SubscriberClient()
+        self.streaming_pull = self.subscriber.subscribe(subscription_name, callback=self.on_message)
+
+    def watch(self):
+        """
+        Ask Gmail to publish changes of the watched labels, renewing the watch when it gets old.
+
+        Returns:
+            None
+        """
+        if time.time() - self.watched_at < self.renew_seconds:
+            return
+        self.gmail_service.users().watch(userId='me', body={
+            'topicName': self.topic_name,
+            'labelIds': self.label_ids,
+            'labelFilterBehavior': 'include',
+        }).execute()
+        self.watched_at = time.time()
+
+    def on_message(self, message):
+        try:
+            self.notifications.put(parse_push_notification(message.data))
+        except ValueError as e:
+            logger.warning("Ignoring malformed push notification: %s", e)
+        message.ack()
+
+    def next_notification(self):
+        """
+        Wait up to wait_seconds for the next push notification.
+
+        Returns:
+            str: historyId carried by the notification, IDLE if none arrived in time, or None once the source is stopped.
+        """
+        self.watch()
+        try:
+            return self.notifications.get(timeout=self.wait_seconds)
+        except queue.Empty:
+            return IDLE
+
+    def stop(self):
+        self.streaming_pull.cancel()
+        self.subscriber.close()
+        self.notifications.put(None)
+
+def parse_push_notification(data):
+    """
+    Read the historyId from the payload of a Gmail push notification.
+
+    Args:
+        data (bytes): Message data, a JSON object with 'emailAddress' and 'historyId'.
+
+    Returns:
+        str: historyId of the change.
+
+    Raises:
+        ValueError: The payload is not a Gmail notification.
+    """
+    try:
+        return str(json.loads(data)['historyId'])
+    except (TypeError, KeyError, json.JSONDecodeError) as e:
+        raise ValueError(f"Unexpected notification payload: {data!r}") from e
+
+class EmailDaemon:
+    """
+    Long-running service that fetches and processes new mail as soon as Gmail reports it.
+
+    The Gmail service, database pool and compiled rules are created once and reused
+    for every notification. Each sync reads the history checkpoint shared with
+    fetch_and_save_emails.py, fetches the new messages, stores them, evaluates the
+    rules against the new rows in memory and applies the label changes in batches.
+
+    The rules file is checked before every sync, after every notification and
+    whenever a wait for a notification times out. A
+    changed file is reloaded without a restart, and the new or changed rules are
+    applied to the stored emails as process_emails.py would.
+    """
+
+    def __init__(self, gmail_service, source, label_ids=None, page_size=DEFAULT_PAGE_SIZE, buffer_size=EMAIL_BUFFER_SIZE,
+                 create_missing_labels=False, sleep=time.sleep):
+        self.gmail_service = gmail_service
+        self.source = source
+        self.label_ids = label_ids if label_ids is not None else DEFAULT_LABEL_IDS
+        self.page_size = page_size
+        self.buffer_size = buffer_size
+        self.sleep = sleep
+        self.checkpoint_key = history_checkpoint_key(self.label_ids)
+        self.checkpoint = None
+        self.stopped = threading.Event()
+        self.create_missing_labels = create_missing_labels
+
+        self.rule_watcher = RuleWatcher(columns=EMAIL_INSERT_COLUMNS, on_change=self.rules_changed)
+        self.use_ruleset(self.rule_watcher.ruleset)
+
+    def use_ruleset(self, ruleset):
+        """
+        Evaluate new mail with a loaded version of the rules from now on.
+
+        Args:
+            ruleset (rule_watcher.RuleSet): Rules compiled for rows in EMAIL_INSERT_COLUMNS order.
+
+        Returns:
+            None
+        """
+        folder_label_ids = resolve_folder_label_ids(self.gmail_service, ruleset.rule_index.rules, self.create_missing_labels)
+        self.label_deltas = [actions_to_label_delta(rule.actions, folder_label_ids) for rule in ruleset.rule_index.rules]
+        self.rule_index = ruleset.rule_index
+        self.ruleset_hash = ruleset.ruleset_hash
+        use_rules(ruleset.rules_data)
+
+    def rules_changed(self, previous, ruleset):
+        """
+        Switch to reloaded rules and apply the rules that changed to the stored emails.
+
+        Args:
+            previous (rule_watcher.RuleSet): Rules in use until now.
+            ruleset (rule_watcher.RuleSet): Reloaded rules.
+
+        Returns:
+            None
+        """
+        self.use_ruleset(ruleset)
+        fetch_emails_from_database(self.gmail_service, self.create_missing_labels)
+
+    def sync_once(self):
+        """
+        Fetch, store and process the mail added since the checkpoint.
+
+        The first run without a checkpoint only records the current historyId;
+        backfilling the mailbox is left to fetch_and_save_emails.py. An expired
+        checkpoint falls back to listing the whole mailbox; those emails are only
+        stored, and the rules are then applied by fetch_emails_from_database, which
+        skips the emails already processed with the current rules. The checkpoint
+        only advances when every message was fetched and stored.
+
+        Returns:
+            int: Number of emails stored.
+
+        Raises:
+            RuntimeError: If some messages could not be fetched; the checkpoint is kept so the retry picks them up.
+        """
+        if self.checkpoint is None:
+            self.checkpoint = get_sync_state(self.checkpoint_key)
+        if self.checkpoint is None:
+            self.checkpoint = get_current_history_id(self.gmail_service)
+            save_sync_state(self.checkpoint_key, self.checkpoint)
+            logger.info("No history checkpoint found, watching for mail after history %s", self.checkpoint)
+            return 0
+
+        full_sync = False
+        try:
+            message_ids, new_history_id = list_history_message_ids(self.gmail_service, self.checkpoint, self.label_ids, self.page_size)
+        except Exception as e:
+            if not is_history_expired_error(e):
+                raise
+            logger.warning("History checkpoint %s has expired, running a full sync", self.checkpoint)
+            full_sync = True
+            new_history_id = get_current_history_id(self.gmail_service)
+            message_ids = list_message_ids(self.gmail_service, self.label_ids, self.page_size)
+
+        failures_before = retryable_failure_count()
+        stored = 0
+        for message_id_batch in batched(message_ids, self.buffer_size):
+            stored += self.ingest_and_process(message_id_batch, apply_rules=not full_sync)
+        if full_sync:
+            fetch_emails_from_database(self.gmail_service, self.create_missing_labels)
+        failed = retryable_failure_count() - failures_before
+        if failed:
+            raise RuntimeError(f"{failed:g} emails could not be fetched, keeping history checkpoint {self.checkpoint}")
+        save_sync_state(self.checkpoint_key, new_history_id)
+        self.checkpoint = new_history_id
+        return stored
+
+    def ingest_and_process(self, message_ids, apply_rules=True):
+        """
+        Fetch a batch of messages, store them and apply the rules to them.
+
+        Args:
+            message_ids (list): IDs of new messages.
+            apply_rules (bool): Apply the rules as well; False only stores the emails.
+
+        Returns:
+            int: Number of emails stored.
+        """
+        email_rows = list(clean_stage(fetch_stage(message_ids, self.gmail_service)))
+        if not email_rows:
+            return 0
+        insert_emails(email_rows)
+        if not apply_rules:
+            logger.info("Stored %d emails", len(email_rows))
+            return len(email_rows)
+
+        pending_modifications = {}
+        unmatched_ids = []
+        for email_row in email_rows:
+            label_delta = email_label_delta(email_row, self.rule_index, self.label_deltas)
+            if label_delta is None:
+                unmatched_ids.append(email_row[0])
+            else:
+                pending_modifications.setdefault(label_delta, []).append(email_row[0])
+        for label_delta, email_ids in pending_modifications.items():
+            batch_modify_emails(self.gmail_service, email_ids, label_delta, self.ruleset_hash)
+        mark_emails_processed(unmatched_ids, self.ruleset_hash)
+        EMAILS_EVALUATED.inc(len(email_rows))
+        logger.info("Stored %d new emails, modified %d", len(email_rows), len(email_rows) - len(unmatched_ids))
+        return len(email_rows)
+
+    def run(self):
+        """
+        Sync once, then sync again after every notification until stopped.
+
+        Failed syncs are retried with exponential backoff instead of ending the service.
+
+        Returns:
+            None
+        """
+        retry_seconds = SYNC_RETRY_SECONDS
+        needs_sync = True
+        while not self.stopped.is_set():
+            self.rule_watcher.check()
+            if needs_sync:
+                try:
+                    self.sync_once()
+                    needs_sync = False
+                    retry_seconds = SYNC_RETRY_SECONDS
+                except Exception as e:
+                    logger.error("Error syncing new emails, retrying in %ss: %s", retry_seconds, e)
+                    self.sleep(retry_seconds)
+                    retry_seconds = min(retry_seconds * 2, SYNC_RETRY_MAX_SECONDS)
+                    continue
+            try:
+                history_id = self.source.next_notification()
+            except Exception as e:
+                logger.error("Error waiting for notifications: %s", e)
+                self.sleep(retry_seconds)
+                needs_sync = True
+                continue
+            if history_id is None:
+                break
+            if history_id is IDLE:
+                continue
+            # Notifications for changes already synced carry an older or equal historyId
+            needs_sync = self.checkpoint is None or int(history_id) > int(self.checkpoint)
+
+    def stop(self):
+        """
+        Ask the service to stop after the current sync.
+        """
+        self.stopped.set()
+        self.source.stop()
+
+def main(label_ids=None, poll_interval=DEFAULT_POLL_INTERVAL_SECONDS, topic_name=None, subscription_name=None,
+         label_cache_file=LABEL_CACHE_FILE, create_missing_labels=False):
+    """
+    Run the daemon until it receives SIGINT or SIGTERM.
+
+    Args:
+        label_ids (list): Labels the ingested messages must carry; defaults to INBOX.
+        poll_interval (float): Seconds between history checks when polling, and the longest
+            wait for a push notification before the rules file is checked.
+        topic_name (str): Pub/Sub topic Gmail publishes to; None polls instead.
+        subscription_name (str): Pub/Sub subscription the notifications are pulled from.
+        label_cache_file (str): File the label cache is persisted to; None keeps it in memory.
+        create_missing_labels (bool): Create 'move_to_folder' labels that do not exist yet.
+
+    Returns:
+        None
+    """
+    create_email_table()
+    create_sync_state_table()
+    create_processing_state_table()
+    configure_label_cache(label_cache_file)
+    gmail_service = build_gmail_service(authenticate_gmail(background_refresh=True))
+    if topic_name:
+        source = PubSubSource(gmail_service, topic_name, subscription_name, label_ids, wait_seconds=poll_interval)
+    else:
+        source = HistoryPollSource(gmail_service, poll_interval)
+    daemon = EmailDaemon(gmail_service, source, label_ids, create_missing_labels=create_missing_labels)
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: daemon.stop())
+    daemon.run()
+
+def parse_args(argv=None):
+    """
+    Parse command line options for the daemon.
+
+    Args:
+        argv (list): Arguments to parse; defaults to sys.argv.
+
+    Returns:
+        argparse.Namespace: Parsed options.
+    """
+    parser = argparse.ArgumentParser(description='Fetch and process new emails as they arrive.')
+    parser.add_argument('--label', dest='label_ids', action='append',
+                        help='Only ingest messages with this label ID (repeatable, default: INBOX).')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL_SECONDS,
+                        help='Seconds between history checks when polling, or between rules file checks with push notifications.')
+    parser.add_argument('--topic',
+                        help='Pub/Sub topic Gmail publishes mailbox changes to (enables push notifications).')
+    parser.add_argument('--subscription',
+                        help='Pub/Sub subscription the push notifications are pulled from.')
+    parser.add_argument('--label-cache', default=LABEL_CACHE_FILE,
+                        help='File the Gmail label cache is persisted to.')
+    parser.add_argument('--create-missing-labels', action='store_true',
+                        help="Create 'move_to_folder' labels that do not exist yet.")
+    add_logging_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    if bool(args.topic) != bool(args.subscription):
+        parser.error('--topic and --subscription must be given together')
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    configure_logging(args.log_level, args.log_rate_limit)
+    try:
+        with exporting_metrics(args.metrics_port, args.metrics_file, args.metrics_interval):
+            main(args.label_ids, args.poll_interval, args.topic, args.subscription, args.label_cache, args.create_missing_labels)
+    finally:
+        close_pool()
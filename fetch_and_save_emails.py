@@ -1,28 +1,117 @@
-import string
 import re
-import os
 import datetime
 import email.utils
 import json
 import html
-from google.oauth2 import credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from database import create_email_table, insert_email, fetch_all_emails
-
-# Constants
-CLIENT_SECRET_FILE = 'auth/credentials.json'
-GMAIL_SCOPES = [
-    'https://www.googleapis.com/auth/gmail.readonly',
-    'https://www.googleapis.com/auth/gmail.modify',
-    'https://www.googleapis.com/auth/gmail.labels'
-]
+import base64
+import codecs
+import queue
+import threading
+import argparse
+import itertools
+import random
+import time
+import logging
+from rate_limit import TokenBucket, GMAIL_QUOTA_UNITS_PER_SECOND, MESSAGES_GET_QUOTA_UNITS
+from gmail_auth import get_credential_provider
+from database import create_email_table, create_sync_state_table, get_sync_state, save_sync_state, insert_email, insert_emails, close_pool
+from metrics import (timed, add_metrics_arguments, exporting_metrics, GMAIL_REQUEST_SECONDS, GMAIL_BATCH_ERRORS, EMAIL_PARSE_SECONDS,
+                     EMAILS_INGESTED, EMAILS_FAILED)
+from logging_config import configure_logging, add_logging_arguments
+
+# The Google client libraries take a few hundred milliseconds to import, so they are
+# imported inside the functions that need them rather than at module import
+
+# Opening script/style tags, comment openers, then any other tag. No branch can match across
+# a stray '<'; the end of a script, style or comment is searched for once by strip_html_tags,
+# so stripping stays linear on malformed HTML.
+HTML_TAG_PATTERN = re.compile(r'<(?:(script|style)\b[^<>]*>|(!--)|[^<>]*>)', re.IGNORECASE)
+HTML_ELEMENT_END_PATTERNS = {
+    'script': re.compile(r'</script\s*>', re.IGNORECASE),
+    'style': re.compile(r'</style\s*>', re.IGNORECASE),
+}
+HTML_COMMENT_END = '-->'
+
+# Control characters except tab, newline and carriage return. A character class is much
+# faster than str.translate once the text contains any non-ASCII character.
+CONTROL_CHARACTER_PATTERN = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f]')
+
+# Upper bound on the stored body of an email, in characters; longer bodies are truncated
+MAX_BODY_CHARS = 64 * 1024
+# base64url characters decoded per step (a multiple of 4)
+BODY_DECODE_CHUNK = 16 * 1024
+
+# Headers requested when only metadata is fetched
+METADATA_HEADERS = ['Subject', 'From', 'To', 'Date']
+
+# Number of parsed emails buffered in memory before they are written to the database
+EMAIL_BUFFER_SIZE = 100
+
+# messages().list paging; Gmail returns at most 500 IDs per page
+DEFAULT_LABEL_IDS = ['INBOX']
+DEFAULT_PAGE_SIZE = 500
+
+# sync_state key prefix of the last Gmail historyId that was fully ingested
+HISTORY_CHECKPOINT_PREFIX = 'gmail_history_id'
+
+# Gmail accepts at most 100 sub-requests per HTTP batch
+GMAIL_BATCH_SIZE = 100
+BATCH_MAX_RETRIES = 5
+BATCH_BACKOFF_SECONDS = 1.0
+
+# Concurrent ingest: fetch workers each own a Gmail client, since httplib2 is not thread-safe
+DEFAULT_FETCH_WORKERS = 1
+QUEUE_BATCHES_PER_WORKER = 2
+
+# EMAILS_FAILED stages a later run can recover from. A message that cannot be parsed, or
+# that Gmail no longer has, fails the same way every time, so it must not hold back the
+# history checkpoint.
+RETRYABLE_FAILURE_STAGES = ('list', 'fetch', 'insert')
+
+# Gmail discovery document, read once per process by gmail_discovery_document
+gmail_discovery = {'document': None}
+
+logger = logging.getLogger(__name__)
+
+def strip_html_tags(content):
+    """
+    Remove HTML tags, comments and script/style elements with their bodies.
+
+    A script, style or comment that is never closed runs to the end of the text.
+
+    Args:
+        content (str): HTML or plain text.
+
+    Returns:
+        str: Text outside the tags.
+    """
+    parts = []
+    position = 0
+    while True:
+        match = HTML_TAG_PATTERN.search(content, position)
+        if match is None:
+            parts.append(content[position:])
+            break
+        parts.append(content[position:match.start()])
+        element, comment = match.group(1), match.group(2)
+        if element:
+            end = HTML_ELEMENT_END_PATTERNS[element.lower()].search(content, match.end())
+            position = end.end() if end else len(content)
+        elif comment:
+            end = content.find(HTML_COMMENT_END, match.end())
+            position = end + len(HTML_COMMENT_END) if end != -1 else len(content)
+        else:
+            position = match.end()
+    return ''.join(parts)
 
 def clean_email_content(content):
     """
     Remove HTML tags and non-printable characters from the email content.
 
+    Tags are stripped before entities are decoded, so escaped text such as
+    '&lt;b&gt;' survives as '<b>'. Script and style elements are dropped with
+    their bodies. Non-ASCII text is kept; only control characters are removed.
+
     Args:
         content (str): Email content to be cleaned.
 
@@ -30,13 +119,64 @@ def clean_email_content(content):
         str: Cleaned email content.
     """
     # Remove HTML tags
-    cleaned_content = html.unescape(content)
-    cleaned_content = re.sub(r'<.*?>', '', cleaned_content)
+    cleaned_content = strip_html_tags(content)
+    if '&' in cleaned_content:
+        cleaned_content = html.unescape(cleaned_content)
 
     # Remove non-printable characters
-    cleaned_content = ''.join(filter(lambda x: x in string.printable, cleaned_content))
+    return CONTROL_CHARACTER_PATTERN.sub('', cleaned_content)
+
+def email_row_from_details(response):
+    """
+    Clean parsed email details into a database row.
+
+    Args:
+        response (dict): Email details as returned by parse_email_details.
 
-    return cleaned_content
+    Returns:
+        tuple: Row of (email_id, subject, sender, receiver, date, message).
+    """
+    cleaned_email = clean_email_content(response['message'])[:MAX_BODY_CHARS]
+    return (response['email_id'], response['subject'], response['sender'], response['receiver'], response['date'], cleaned_email)
+
+def email_row_from_message(msg):
+    """
+    Parse a Gmail message resource and clean its content into a database row.
+
+    Args:
+        msg (dict): Message resource returned by the Gmail API.
+
+    Returns:
+        tuple: Row of (email_id, subject, sender, receiver, date, message), or None on error.
+    """
+    try:
+        with timed(EMAIL_PARSE_SECONDS):
+            email_row = email_row_from_details(parse_email_details(msg))
+        EMAILS_INGESTED.inc()
+        return email_row
+
+    except Exception as e:
+        EMAILS_FAILED.inc(stage='parse')
+        logger.error("Error parsing email details: %s", e)
+        return None
+
+def retrieve_email_details(message_id, gmail_service):
+    """
+    Fetch email details using the Gmail API and clean the content.
+
+    Args:
+        message_id (str): The ID of the Gmail message.
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+
+    Returns:
+        tuple: Row of (email_id, subject, sender, receiver, date, message), or None on error.
+    """
+    try:
+        return email_row_from_details(get_email_details(message_id, gmail_service))
+
+    except Exception as e:
+        logger.error("Error fetching email details: %s", e)
+        return None
 
 def retrieve_and_insert_email_details(message_id, gmail_service):
     """
@@ -49,17 +189,198 @@ def retrieve_and_insert_email_details(message_id, gmail_service):
     Returns:
         None
     """
+    email_row = retrieve_email_details(message_id, gmail_service)
+    if email_row is None:
+        return
     try:
-        response = get_email_details(message_id, gmail_service)
+        insert_email(*email_row)
+    except Exception as e:
+        logger.error("Error inserting email details: %s", e)
 
-        cleaned_email = clean_email_content(response['message'])
-        insert_email(response['email_id'], response['subject'], response['sender'], response['receiver'], response['date'], cleaned_email)
+def flush_email_buffer(email_buffer):
+    """
+    Write the buffered email rows to the database in one batch and empty the buffer.
 
+    Args:
+        email_buffer (list): Buffered rows as returned by retrieve_email_details.
+
+    Returns:
+        int: Number of rows written.
+    """
+    if not email_buffer:
+        return 0
+    try:
+        inserted = insert_emails(email_buffer)
     except Exception as e:
-        print(f"Error fetching email details: {str(e)}")
+        EMAILS_FAILED.inc(len(email_buffer), stage='insert')
+        logger.error("Error inserting email batch of %d emails: %s", len(email_buffer), e)
+        inserted = 0
+    email_buffer.clear()
+    return inserted
+
+def message_get_request(gmail_service, message_id, headers_only=False):
+    """
+    Build a messages().get request for the full message or for its headers only.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        message_id (str): The ID of the Gmail message.
+        headers_only (bool): Request format='metadata' with METADATA_HEADERS instead of the full payload.
+
+    Returns:
+        googleapiclient.http.HttpRequest: Request ready to execute or add to a batch.
+    """
+    if headers_only:
+        return gmail_service.users().messages().get(userId='me', id=message_id, format='metadata', metadataHeaders=METADATA_HEADERS)
+    return gmail_service.users().messages().get(userId='me', id=message_id, format='full')
+
+def fetch_detailed_email(message_id, gmail_service, headers_only=False):
+    with timed(GMAIL_REQUEST_SECONDS, method='messages.get'):
+        return message_get_request(gmail_service, message_id, headers_only).execute()
+
+def is_quota_error(exception):
+    """
+    Check whether a Gmail API error is a rate-limit or quota error worth retrying.
+
+    Args:
+        exception (Exception): Error reported for a request.
+
+    Returns:
+        bool: True if the request should be retried after a backoff.
+    """
+    from googleapiclient.errors import HttpError
+    if not isinstance(exception, HttpError):
+        return False
+    status = exception.resp.status
+    if status == 429:
+        return True
+    if status == 403:
+        reasons = {detail.get('reason') for detail in (exception.error_details or []) if isinstance(detail, dict)}
+        return bool(reasons & {'rateLimitExceeded', 'userRateLimitExceeded'})
+    return False
 
-def fetch_detailed_email(message_id, gmail_service):
-    return gmail_service.users().messages().get(userId='me', id=message_id, format='full').execute()
+def is_transient_error(exception):
+    """
+    Check whether a failed request is worth retrying: quota errors, server errors and network errors.
+
+    Args:
+        exception (Exception): Error raised by a request.
+
+    Returns:
+        bool: True if the request should be retried after a backoff.
+    """
+    import httplib2
+    from googleapiclient.errors import HttpError
+    if isinstance(exception, HttpError):
+        return is_quota_error(exception) or exception.resp.status >= 500
+    return isinstance(exception, (OSError, httplib2.HttpLib2Error))
+
+def fetch_failure_stage(exception):
+    """
+    Name the EMAILS_FAILED stage of a sub-request that failed with something other than a quota error.
+
+    A message deleted after its history record was written answers 404 on every
+    later run, so 4xx errors other than timeouts and expired authorization are
+    counted as 'missing', a stage that does not hold back the history checkpoint.
+
+    Args:
+        exception (Exception): Error reported for a request.
+
+    Returns:
+        str: 'missing' for a permanent client error, otherwise 'fetch'.
+    """
+    from googleapiclient.errors import HttpError
+    if isinstance(exception, HttpError) and 400 <= exception.resp.status < 500 and exception.resp.status not in (401, 408, 429):
+        return 'missing'
+    return 'fetch'
+
+def execute_email_batch(message_ids, gmail_service, max_retries=BATCH_MAX_RETRIES, backoff_seconds=BATCH_BACKOFF_SECONDS, rate_limiter=None,
+                        headers_only=False):
+    """
+    Fetch up to GMAIL_BATCH_SIZE messages in a single HTTP batch request.
+
+    Sub-requests that fail with a quota error are retried in a new batch with
+    exponential backoff; other failures are reported and skipped. A batch request
+    that fails as a whole with a quota, server or network error is retried the same
+    way. When the retries run out, or the error is not transient, the messages still
+    pending are counted as failed instead of raising.
+
+    Args:
+        message_ids (list): IDs of the Gmail messages.
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        max_retries (int): Number of times quota-limited sub-requests are retried.
+        backoff_seconds (float): Initial delay between retries.
+        rate_limiter (rate_limit.TokenBucket): Shared quota limiter; each sub-request costs
+            MESSAGES_GET_QUOTA_UNITS.
+        headers_only (bool): Fetch only the metadata headers.
+
+    Returns:
+        dict: Message resources keyed by message ID.
+    """
+    messages = {}
+    pending = list(message_ids)
+    for attempt in range(max_retries + 1):
+        throttled = []
+
+        def handle_response(request_id, response, exception):
+            if exception is None:
+                messages[request_id] = response
+            elif is_quota_error(exception):
+                GMAIL_BATCH_ERRORS.inc(kind='quota')
+                throttled.append(request_id)
+            else:
+                GMAIL_BATCH_ERRORS.inc(kind='other')
+                EMAILS_FAILED.inc(stage=fetch_failure_stage(exception))
+                logger.error("Error fetching email %s: %s", request_id, exception)
+
+        batch = gmail_service.new_batch_http_request(callback=handle_response)
+        for message_id in pending:
+            batch.add(message_get_request(gmail_service, message_id, headers_only), request_id=message_id)
+        if rate_limiter is not None:
+            rate_limiter.acquire(len(pending) * MESSAGES_GET_QUOTA_UNITS)
+        try:
+            with timed(GMAIL_REQUEST_SECONDS, method='batch.messages.get'):
+                batch.execute()
+        except Exception as e:
+            if not is_transient_error(e):
+                EMAILS_FAILED.inc(len(pending), stage='fetch')
+                logger.error("Error fetching a batch of %d emails: %s", len(pending), e)
+                return messages
+            GMAIL_BATCH_ERRORS.inc(kind='batch')
+            logger.warning("Batch request for %d emails failed, retrying: %s", len(pending), e)
+            throttled = [message_id for message_id in pending if message_id not in messages]
+
+        if not throttled:
+            break
+        pending = throttled
+        if attempt < max_retries:
+            time.sleep(backoff_seconds * (2 ** attempt) + random.uniform(0, backoff_seconds))
+    else:
+        EMAILS_FAILED.inc(len(pending), stage='fetch')
+        logger.error("Error fetching emails: %d messages still failing after %d retries", len(pending), max_retries)
+    return messages
+
+def fetch_detailed_emails(message_ids, gmail_service, batch_size=GMAIL_BATCH_SIZE, rate_limiter=None, headers_only=False):
+    """
+    Fetch many messages using Gmail HTTP batch requests.
+
+    Args:
+        message_ids (list): IDs of the Gmail messages.
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        batch_size (int): Number of messages requested per HTTP batch (at most 100).
+        rate_limiter (rate_limit.TokenBucket): Optional shared quota limiter.
+        headers_only (bool): Fetch only the metadata headers.
+
+    Returns:
+        list: Message resources in the order of message_ids, skipping failed messages.
+    """
+    batch_size = min(batch_size, GMAIL_BATCH_SIZE)
+    detailed_emails = []
+    for start in range(0, len(message_ids), batch_size):
+        chunk = message_ids[start:start + batch_size]
+        fetched = execute_email_batch(chunk, gmail_service, rate_limiter=rate_limiter, headers_only=headers_only)
+        detailed_emails.extend(fetched[message_id] for message_id in chunk if message_id in fetched)
+    return detailed_emails
 
 def get_email_details(message_id, gmail_service):
     """
@@ -69,18 +390,197 @@ def get_email_details(message_id, gmail_service):
         dict: Dictionary containing email details.
     """
     msg = fetch_detailed_email(message_id, gmail_service)
+    return parse_email_details(msg)
+
+def decode_base64url(data, max_bytes):
+    """
+    Decode base64url data chunk by chunk, stopping once max_bytes have been produced.
+
+    Args:
+        data (str): base64url text, with or without padding.
+        max_bytes (int): Maximum number of decoded bytes to return.
+
+    Returns:
+        bytes: Decoded data, truncated to max_bytes.
+    """
+    decoded = bytearray()
+    for start in range(0, len(data), BODY_DECODE_CHUNK):
+        chunk = data[start:start + BODY_DECODE_CHUNK]
+        if len(chunk) % 4:
+            chunk += '=' * (-len(chunk) % 4)
+        decoded += base64.urlsafe_b64decode(chunk)
+        if len(decoded) >= max_bytes:
+            break
+    return bytes(decoded[:max_bytes])
+
+def is_attachment(part):
+    """
+    Check whether a MIME part is an attachment rather than a message body.
+
+    Args:
+        part (dict): MIME part of a Gmail message payload.
+
+    Returns:
+        bool: True if the part has a filename, an attachment ID or an attachment disposition.
+    """
+    if part.get('filename') or part.get('body', {}).get('attachmentId'):
+        return True
+    disposition = first_header(parse_headers(part.get('headers', [])), 'content-disposition')
+    return disposition.lower().startswith('attachment')
+
+def find_body_parts(payload):
+    """
+    Walk the MIME tree of a payload and find the first text/plain and text/html body parts.
+
+    Attachments are skipped without being decoded.
+
+    Args:
+        payload (dict): 'payload' of a Gmail message resource.
+
+    Returns:
+        dict: The first inline part found for each of 'text/plain' and 'text/html'.
+    """
+    found = {}
+    stack = [payload]
+    while stack and len(found) < 2:
+        part = stack.pop()
+        if is_attachment(part):
+            continue
+        mime_type = part.get('mimeType', '')
+        if mime_type in ('text/plain', 'text/html') and part.get('body', {}).get('data'):
+            found.setdefault(mime_type, part)
+        # Reverse so parts are visited in document order
+        stack.extend(reversed(part.get('parts', [])))
+    return found
+
+def part_charset(part):
+    """
+    Read the charset of a MIME part from its Content-Type header, defaulting to UTF-8.
+    """
+    content_type = first_header(parse_headers(part.get('headers', [])), 'content-type')
+    for parameter in content_type.split(';')[1:]:
+        name, _, value = parameter.strip().partition('=')
+        if name.lower() == 'charset' and value:
+            return value.strip('"\'')
+    return 'utf-8'
+
+def decode_part(part, max_chars):
+    """
+    Decode the body of a MIME part to text, reading at most enough data for max_chars characters.
+
+    Args:
+        part (dict): MIME part with base64url 'body.data'.
+        max_chars (int): Maximum number of characters to return.
+
+    Returns:
+        str: Decoded text.
+    """
+    # UTF-8 needs at most 4 bytes per character
+    raw = decode_base64url(part['body']['data'], max_chars * 4)
+    try:
+        decoder = codecs.getincrementaldecoder(part_charset(part))(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    # final=False drops a multi-byte character cut in half by the byte limit
+    return decoder.decode(raw, final=False)[:max_chars]
+
+def extract_message_body(payload, max_chars=MAX_BODY_CHARS):
+    """
+    Extract the text body of a message, preferring text/plain over text/html.
+
+    Args:
+        payload (dict): 'payload' of a Gmail message resource.
+        max_chars (int): Maximum number of characters to return.
+
+    Returns:
+        str: Body text (HTML is returned as is and cleaned later), or None if the payload has no body.
+    """
+    body_parts = find_body_parts(payload)
+    part = body_parts.get('text/plain') or body_parts.get('text/html')
+    if part is None:
+        return None
+    return decode_part(part, max_chars)
 
-    headers = msg['payload']['headers']
+def parse_headers(headers):
+    """
+    Index message headers by lower-cased name in a single pass.
+
+    Args:
+        headers (list): 'headers' list of a Gmail message payload or MIME part.
+
+    Returns:
+        dict: Every value of each header, in message order, keyed by lower-cased name.
+    """
+    indexed = {}
+    for header in headers:
+        indexed.setdefault(header['name'].lower(), []).append(header['value'])
+    return indexed
+
+def first_header(headers, name, default=''):
+    """
+    Get the first value of a header from the result of parse_headers.
+
+    Args:
+        headers (dict): Headers indexed by parse_headers.
+        name (str): Lower-cased header name.
+        default: Value returned when the header is missing.
+
+    Returns:
+        str: Header value.
+    """
+    values = headers.get(name)
+    return values[0] if values else default
+
+def parse_email_date(date_header, internal_date=None):
+    """
+    Parse an email's date into a timezone-aware datetime.
+
+    The Date header is used when it parses; otherwise Gmail's internalDate
+    (milliseconds since the epoch) is used. Dates without an offset are taken as UTC.
+
+    Args:
+        date_header (str): Value of the Date header, or None.
+        internal_date (str): Gmail internalDate of the message, or None.
+
+    Returns:
+        datetime.datetime: Aware email date, or None if neither source is usable.
+    """
+    if date_header:
+        try:
+            parsed_date = email.utils.parsedate_to_datetime(date_header)
+            if parsed_date.tzinfo is None:
+                parsed_date = parsed_date.replace(tzinfo=datetime.timezone.utc)
+            return parsed_date
+        except (TypeError, ValueError, IndexError):
+            pass
+    if internal_date:
+        return datetime.datetime.fromtimestamp(int(internal_date) / 1000, tz=datetime.timezone.utc)
+    return None
+
+def parse_email_details(msg):
+    """
+    Extract email details from a Gmail message resource.
+
+    Missing headers become empty strings rather than errors, so no message is dropped
+    for lacking a Subject or To header.
 
-    subject = [header['value'] for header in headers if header['name'] == 'Subject'][0]
-    sender = [header['value'] for header in headers if header['name'] == 'From'][0]
-    receiver = [header['value'] for header in headers if header['name'] == 'To'][0]
-    date = [header['value'] for header in headers if header['name'] == 'Date'][0]
+    Args:
+        msg (dict): Message resource, as returned by a single or batched messages().get call.
+
+    Returns:
+        dict: Dictionary containing email details.
+    """
+    headers = parse_headers(msg['payload'].get('headers', []))
 
-    formatted_date = email.utils.parsedate_to_datetime(date)
-    email_date = formatted_date.strftime('%Y-%m-%d %H:%M:%S')
+    subject = first_header(headers, 'subject')
+    sender = first_header(headers, 'from')
+    receiver = ', '.join(headers.get('to', []))
+    email_date = parse_email_date(first_header(headers, 'date', None), msg.get('internalDate'))
 
-    message_body = msg['snippet']
+    # Messages fetched with format='metadata' carry no body, only the snippet
+    message_body = extract_message_body(msg['payload'])
+    if message_body is None:
+        message_body = msg.get('snippet', '')
     email_id = msg['id']
     
     response_json = {
@@ -94,54 +594,457 @@ def get_email_details(message_id, gmail_service):
     return response_json
 
 
-def authenticate_gmail():
+def authenticate_gmail(background_refresh=False):
     """
     Authenticate the Gmail API and obtain credentials.
 
+    Credentials come from the process-wide provider, so every caller and worker
+    shares one in-memory token that is refreshed once, shortly before it expires.
+
+    Args:
+        background_refresh (bool): Keep the token fresh from a background thread, for long runs.
+
     Returns:
         google.auth.credentials.Credentials: Google API credentials.
     """
-    creds = None
-    if os.path.exists('token.json'):
-        creds = credentials.Credentials.from_authorized_user_file('token.json', GMAIL_SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, GMAIL_SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+    provider = get_credential_provider()
+    creds = provider.get()
+    if background_refresh:
+        provider.start_background_refresh()
     return creds
 
-def main():
+def gmail_discovery_document():
+    """
+    Read the Gmail v1 discovery document bundled with google-api-python-client, once per process.
+
+    Returns:
+        str: Discovery document as JSON text.
+    """
+    if gmail_discovery['document'] is None:
+        from googleapiclient import discovery_cache
+        gmail_discovery['document'] = discovery_cache.get_static_doc('gmail', 'v1')
+    return gmail_discovery['document']
+
+def build_gmail_service(gmail_credentials):
+    """
+    Build a Gmail API service from the bundled discovery document, without any network request.
+
+    Args:
+        gmail_credentials (google.auth.credentials.Credentials): Google API credentials.
+
+    Returns:
+        googleapiclient.discovery.Resource: Gmail API service.
+    """
+    from googleapiclient.discovery import build_from_document
+    # build_from_document modifies a parsed document, so each service parses its own copy of the text
+    return build_from_document(gmail_discovery_document(), credentials=gmail_credentials)
+
+def list_message_ids(gmail_service, label_ids=None, page_size=DEFAULT_PAGE_SIZE, max_messages=None):
+    """
+    Lazily list message IDs, following nextPageToken until the mailbox is exhausted.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        label_ids (list): Only list messages carrying all of these labels.
+        page_size (int): Number of IDs requested per page (at most 500).
+        max_messages (int): Stop after this many IDs; None lists everything.
+
+    Yields:
+        str: Gmail message ID.
+    """
+    if label_ids is None:
+        label_ids = DEFAULT_LABEL_IDS
+    listed = 0
+    page_token = None
+    while max_messages is None or listed < max_messages:
+        request_args = {'userId': 'me', 'labelIds': label_ids, 'maxResults': page_size}
+        if page_token:
+            request_args['pageToken'] = page_token
+        with timed(GMAIL_REQUEST_SECONDS, method='messages.list'):
+            gmail_results = gmail_service.users().messages().list(**request_args).execute()
+        for message in gmail_results.get('messages', []):
+            if max_messages is not None and listed >= max_messages:
+                return
+            listed += 1
+            yield message['id']
+        page_token = gmail_results.get('nextPageToken')
+        if not page_token:
+            return
+
+def batched(iterable, batch_size):
+    """
+    Group an iterable into lists of at most batch_size items without materializing it.
+
+    Yields:
+        list: Next group of items.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def fetch_stage(message_ids, gmail_service, batch_size=GMAIL_BATCH_SIZE, headers_only=False):
+    """
+    Fetch stage of the ingest pipeline: pull message IDs one HTTP batch at a time.
+
+    Yields:
+        dict: Gmail message resource.
+    """
+    for id_batch in batched(message_ids, batch_size):
+        yield from fetch_detailed_emails(id_batch, gmail_service, batch_size, headers_only=headers_only)
+
+def clean_stage(detailed_emails):
+    """
+    Parse and clean stage of the ingest pipeline.
+
+    Yields:
+        tuple: Database row for each message that parsed successfully.
+    """
+    for msg in detailed_emails:
+        email_row = email_row_from_message(msg)
+        if email_row is not None:
+            yield email_row
+
+def insert_stage(email_rows, buffer_size=EMAIL_BUFFER_SIZE):
+    """
+    Insert stage of the ingest pipeline: write rows to the database in batches.
+
+    Args:
+        email_rows (iterable): Rows produced by clean_stage.
+        buffer_size (int): Number of rows written per batch.
+
+    Returns:
+        int: Number of rows handled.
+    """
+    processed = 0
+    for row_batch in batched(email_rows, buffer_size):
+        processed += len(row_batch)
+        flush_email_buffer(row_batch)
+        logger.info("Processed %d emails", processed)
+    return processed
+
+def fetch_worker(id_queue, row_queue, gmail_credentials, rate_limiter, headers_only=False):
+    """
+    Fetch worker of the concurrent ingest: fetch and clean ID batches until it receives None.
+
+    Each worker builds its own Gmail service so it has its own HTTP transport.
+
+    Args:
+        id_queue (queue.Queue): Batches of message IDs, terminated by None.
+        row_queue (queue.Queue): Receives cleaned rows, then None when the worker stops.
+        gmail_credentials (google.auth.credentials.Credentials): Google API credentials.
+        rate_limiter (rate_limit.TokenBucket): Quota limiter shared by all workers.
+        headers_only (bool): Fetch only the metadata headers.
+    """
+    try:
+        try:
+            gmail_service = build_gmail_service(gmail_credentials)
+        except Exception as e:
+            # The other workers keep consuming; batches nobody takes are counted by concurrent_ingest
+            logger.error("Error starting fetch worker: %s", e)
+            return
+        while True:
+            id_batch = id_queue.get()
+            if id_batch is None:
+                break
+            try:
+                for email_row in clean_stage(fetch_detailed_emails(id_batch, gmail_service, GMAIL_BATCH_SIZE, rate_limiter, headers_only)):
+                    row_queue.put(email_row)
+            except Exception as e:
+                # One failed batch must not stop the worker; only that batch is lost
+                EMAILS_FAILED.inc(len(id_batch), stage='fetch')
+                logger.error("Error fetching a batch of %d emails: %s", len(id_batch), e)
+    finally:
+        row_queue.put(None)
+
+def queue_message_ids(message_ids, id_queue, workers):
+    """
+    Producer of the concurrent ingest: queue message IDs in HTTP-batch-sized groups.
+
+    Args:
+        message_ids (iterable): Message IDs to ingest.
+        id_queue (queue.Queue): Bounded queue read by the fetch workers.
+        workers (int): Number of fetch workers, each of which is sent a final None.
+    """
+    try:
+        for id_batch in batched(message_ids, GMAIL_BATCH_SIZE):
+            id_queue.put(id_batch)
+    except Exception as e:
+        EMAILS_FAILED.inc(stage='list')
+        logger.error("Error listing emails: %s", e)
+    finally:
+        for _ in range(workers):
+            id_queue.put(None)
+
+def concurrent_ingest(message_ids, gmail_credentials, workers, buffer_size=EMAIL_BUFFER_SIZE, rate_limiter=None, headers_only=False):
+    """
+    Ingest messages with several fetch workers and a single batching writer.
+
+    Listing, fetching and inserting overlap: a producer thread queues ID batches,
+    the workers fetch and clean them under a shared quota limiter, and the calling
+    thread writes the cleaned rows to the database in batches. Both queues are
+    bounded so memory stays flat.
+
+    Args:
+        message_ids (iterable): Message IDs to ingest.
+        gmail_credentials (google.auth.credentials.Credentials): Google API credentials.
+        workers (int): Number of fetch workers.
+        buffer_size (int): Number of rows written to the database per batch.
+        rate_limiter (rate_limit.TokenBucket): Quota limiter; defaults to the per-user Gmail quota.
+        headers_only (bool): Fetch only the metadata headers.
+
+    Returns:
+        int: Number of rows handled.
+    """
+    if rate_limiter is None:
+        rate_limiter = TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND)
+    id_queue = queue.Queue(maxsize=workers * QUEUE_BATCHES_PER_WORKER)
+    row_queue = queue.Queue(maxsize=max(buffer_size, GMAIL_BATCH_SIZE) * QUEUE_BATCHES_PER_WORKER)
+
+    threads = [threading.Thread(target=queue_message_ids, args=(message_ids, id_queue, workers), daemon=True)]
+    threads += [
+        threading.Thread(target=fetch_worker, args=(id_queue, row_queue, gmail_credentials, rate_limiter, headers_only), daemon=True)
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    def queued_rows():
+        running_workers = workers
+        while running_workers:
+            email_row = row_queue.get()
+            if email_row is None:
+                running_workers -= 1
+            else:
+                yield email_row
+
+    processed = insert_stage(queued_rows(), buffer_size)
+    # Every worker has stopped; if some could not start, drain what is left so the producer can finish
+    producer = threads[0]
+    while producer.is_alive() or not id_queue.empty():
+        try:
+            id_batch = id_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if id_batch is not None:
+            EMAILS_FAILED.inc(len(id_batch), stage='fetch')
+    for thread in threads:
+        thread.join()
+    return processed
+
+def retryable_failure_count():
+    """
+    Count the emails that could not be listed, fetched or stored so far in this process.
+
+    A sync compares the count before and after ingesting; any increase means mail
+    was left behind and the history checkpoint must stay where it is.
+
+    Returns:
+        float: Sum of EMAILS_FAILED over RETRYABLE_FAILURE_STAGES.
+    """
+    return sum(EMAILS_FAILED.value(stage=stage) for stage in RETRYABLE_FAILURE_STAGES)
+
+def history_checkpoint_key(label_ids):
+    """
+    Build the sync_state key under which the history checkpoint of a label filter is stored.
+
+    Args:
+        label_ids (list): Label filter of the sync.
+
+    Returns:
+        str: Checkpoint key.
+    """
+    return f"{HISTORY_CHECKPOINT_PREFIX}:{','.join(sorted(label_ids))}"
+
+def is_history_expired_error(exception):
+    """
+    Check whether a history.list error means the checkpoint is too old to be used.
+
+    Args:
+        exception (Exception): Error raised by history.list.
+
+    Returns:
+        bool: True for a 404 response.
+    """
+    from googleapiclient.errors import HttpError
+    return isinstance(exception, HttpError) and exception.resp.status == 404
+
+def get_current_history_id(gmail_service):
+    """
+    Get the mailbox's current historyId.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+
+    Returns:
+        str: Current historyId.
+    """
+    with timed(GMAIL_REQUEST_SECONDS, method='getProfile'):
+        return gmail_service.users().getProfile(userId='me').execute()['historyId']
+
+def list_history_message_ids(gmail_service, start_history_id, label_ids=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    List messages that arrived in, or were labelled into, the synced labels since a checkpoint.
+
+    Only messagesAdded and labelsAdded records are requested; messages leaving the
+    labels need no change in the 'email_details' table.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        start_history_id (str): historyId of the last completed sync.
+        label_ids (list): Labels the messages must carry; defaults to INBOX.
+        page_size (int): Number of history records requested per page.
+
+    Returns:
+        tuple: (list of new message IDs in history order, latest historyId).
+
+    Raises:
+        googleapiclient.errors.HttpError: 404 when the checkpoint is too old to be used.
+    """
+    if label_ids is None:
+        label_ids = DEFAULT_LABEL_IDS
+    wanted_labels = set(label_ids)
+    message_ids = {}
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        request_args = {
+            'userId': 'me',
+            'startHistoryId': start_history_id,
+            'historyTypes': ['messageAdded', 'labelAdded'],
+            'maxResults': page_size,
+        }
+        if len(label_ids) == 1:
+            request_args['labelId'] = label_ids[0]
+        if page_token:
+            request_args['pageToken'] = page_token
+        with timed(GMAIL_REQUEST_SECONDS, method='history.list'):
+            history_results = gmail_service.users().history().list(**request_args).execute()
+        for record in history_results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added['message']
+                if wanted_labels.issubset(message.get('labelIds', [])):
+                    message_ids[message['id']] = None
+            for labelled in record.get('labelsAdded', []):
+                message = labelled['message']
+                if wanted_labels.intersection(labelled.get('labelIds', [])) and wanted_labels.issubset(message.get('labelIds', [])):
+                    message_ids[message['id']] = None
+        latest_history_id = history_results.get('historyId', latest_history_id)
+        page_token = history_results.get('nextPageToken')
+        if not page_token:
+            return list(message_ids), latest_history_id
+
+def main(label_ids=None, page_size=DEFAULT_PAGE_SIZE, max_messages=None, buffer_size=EMAIL_BUFFER_SIZE, full_sync=False,
+         workers=DEFAULT_FETCH_WORKERS, quota_units_per_second=GMAIL_QUOTA_UNITS_PER_SECOND, headers_only=False):
     """
     Main function to fetch and save emails using the Gmail API.
 
+    When a history checkpoint from a previous run exists, only messages added since
+    that checkpoint are fetched; otherwise, or when the checkpoint has expired, the
+    whole mailbox is listed. Message IDs are streamed through the fetch, clean and
+    insert stages, so at most one page, one HTTP batch and one insert batch are
+    held in memory regardless of mailbox size.
+
+    Args:
+        label_ids (list): Labels the ingested messages must carry; defaults to INBOX.
+        page_size (int): Number of message IDs listed per page.
+        max_messages (int): Maximum number of messages to ingest; None for all.
+        buffer_size (int): Number of parsed emails written to the database per batch.
+        full_sync (bool): Ignore the history checkpoint and list the whole mailbox.
+        workers (int): Number of concurrent fetch workers; 1 runs the stages in sequence.
+        quota_units_per_second (float): Gmail quota units the workers may spend per second.
+        headers_only (bool): Fetch only headers and the snippet, not the message body.
+
     Returns:
         None
     """
+    if label_ids is None:
+        label_ids = DEFAULT_LABEL_IDS
     create_email_table()
-    gmail_credentials = authenticate_gmail()
-
-    gmail_api_service = build('gmail', 'v1', credentials=gmail_credentials)
-    gmail_results = gmail_api_service.users().messages().list(userId='me', labelIds=['INBOX'], maxResults=10).execute()
-    gmail_messages = gmail_results.get('messages', [])
-
-    if gmail_messages:
-        print("=" * 60)
-        print("Fetching & Saving Emails")
-        print("=" * 60) 
-        temp = 1
-        for message in gmail_messages:
-            print (" Processed email - ", temp, "/", len(gmail_messages))
-            temp += 1 
-            retrieve_and_insert_email_details(message['id'], gmail_api_service) 
+    create_sync_state_table()
+    gmail_credentials = authenticate_gmail(background_refresh=True)
+
+    gmail_api_service = build_gmail_service(gmail_credentials)
+    checkpoint_key = history_checkpoint_key(label_ids)
+    checkpoint = None if full_sync else get_sync_state(checkpoint_key)
+
+    message_ids = None
+    if checkpoint:
+        try:
+            message_ids, new_history_id = list_history_message_ids(gmail_api_service, checkpoint, label_ids, page_size)
+            logger.info("Incremental sync from history %s: %d new emails", checkpoint, len(message_ids))
+            if max_messages is not None:
+                message_ids = message_ids[:max_messages]
+        except Exception as e:
+            if not is_history_expired_error(e):
+                raise
+            logger.warning("History checkpoint %s has expired, running a full sync", checkpoint)
+    if message_ids is None:
+        # Read the historyId before listing so mail arriving mid-sync is picked up next run
+        new_history_id = get_current_history_id(gmail_api_service)
+        message_ids = list_message_ids(gmail_api_service, label_ids, page_size, max_messages)
+
+    logger.info("Fetching & Saving Emails")
+    failures_before = retryable_failure_count()
+    started_at = time.monotonic()
+    if workers > 1:
+        processed = concurrent_ingest(message_ids, gmail_credentials, workers, buffer_size, TokenBucket(quota_units_per_second), headers_only)
+    else:
+        detailed_emails = fetch_stage(message_ids, gmail_api_service, headers_only=headers_only)
+        processed = insert_stage(clean_stage(detailed_emails), buffer_size)
+    elapsed = time.monotonic() - started_at
+    if not processed:
+        logger.info("No Emails")
     else:
-        print("No Emails")
+        logger.info("Saved %d emails in %.1fs (%.1f emails/s)", processed, elapsed, processed / max(elapsed, 1e-9))
+
+    # Failed or capped runs leave mail behind, so they must not move the checkpoint past it
+    failed = retryable_failure_count() - failures_before
+    if failed:
+        logger.warning("%d emails could not be fetched or saved, keeping the history checkpoint so the next run retries them", failed)
+    elif max_messages is None:
+        save_sync_state(checkpoint_key, new_history_id)
+
+def parse_args(argv=None):
+    """
+    Parse command line options for the fetch script.
+
+    Args:
+        argv (list): Arguments to parse; defaults to sys.argv.
+
+    Returns:
+        argparse.Namespace: Parsed options.
+    """
+    parser = argparse.ArgumentParser(description='Fetch emails from Gmail and save them to the database.')
+    parser.add_argument('--label', dest='label_ids', action='append',
+                        help='Only ingest messages with this label ID (repeatable, default: INBOX).')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help='Number of message IDs listed per Gmail API page.')
+    parser.add_argument('--max-messages', type=int, default=None,
+                        help='Stop after ingesting this many messages.')
+    parser.add_argument('--buffer-size', type=int, default=EMAIL_BUFFER_SIZE,
+                        help='Number of emails written to the database per batch.')
+    parser.add_argument('--full-sync', action='store_true',
+                        help='Ignore the saved history checkpoint and list the whole mailbox.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_FETCH_WORKERS,
+                        help='Number of concurrent fetch workers.')
+    parser.add_argument('--quota-units-per-second', type=float, default=GMAIL_QUOTA_UNITS_PER_SECOND,
+                        help='Gmail API quota units the fetch workers may spend per second.')
+    parser.add_argument('--headers-only', action='store_true',
+                        help='Fetch only headers and the snippet instead of the full message body.')
+    add_logging_arguments(parser)
+    add_metrics_arguments(parser)
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
-    main()
-    print("=" * 60)
-    print("Completed Saving Emails")
-    print("=" * 60)
+    args = parse_args()
+    configure_logging(args.log_level, args.log_rate_limit)
+    try:
+        with exporting_metrics(args.metrics_port, args.metrics_file, args.metrics_interval):
+            main(args.label_ids, args.page_size, args.max_messages, args.buffer_size, args.full_sync,
+                 args.workers, args.quota_units_per_second, args.headers_only)
+    finally:
+        close_pool()
+    logger.info("Completed Saving Emails")
@@ -0,0 +1,204 @@
+import os
+import logging
+import datetime
+import tempfile
+import threading
+
+# Constants
+CLIENT_SECRET_FILE = 'auth/credentials.json'
+TOKEN_FILE = 'token.json'
+GMAIL_SCOPES = [
+    'https://www.googleapis.com/auth/gmail.readonly',
+    'https://www.googleapis.com/auth/gmail.modify',
+    'https://www.googleapis.com/auth/gmail.labels'
+]
+
+# Refresh this long before the token expires. google-auth treats a token as expired
+# 3m45s early and would then refresh it inside whichever request notices first, so
+# the margin must be larger for requests never to pay for a refresh.
+REFRESH_MARGIN_SECONDS = 5 * 60
+# Wait before retrying a failed background refresh
+REFRESH_RETRY_SECONDS = 30
+
+# One provider per token file, shared by every thread of the process
+providers = {}
+providers_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+def utc_now():
+    """
+    Current UTC time as a naive datetime, the form google-auth uses for token expiry.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+class CredentialProvider:
+    """
+    Process-wide holder of the Gmail OAuth credentials.
+
+    The token is read from token_file once and kept in memory. It is refreshed
+    under a lock shortly before it expires, so concurrent callers never refresh it
+    twice, and the refreshed token is written back to the file atomically.
+    """
+
+    def __init__(self, token_file=TOKEN_FILE, client_secret_file=CLIENT_SECRET_FILE, scopes=GMAIL_SCOPES,
+                 refresh_margin_seconds=REFRESH_MARGIN_SECONDS, clock=utc_now):
+        self.token_file = token_file
+        self.client_secret_file = client_secret_file
+        self.scopes = scopes
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin_seconds)
+        self.clock = clock
+        self.creds = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.refresher = None
+
+    def needs_refresh(self, creds):
+        """
+        Check whether credentials are invalid or expire within the refresh margin.
+
+        Args:
+            creds (google.oauth2.credentials.Credentials): Credentials to check.
+
+        Returns:
+            bool: True if the credentials should be refreshed before use.
+        """
+        if creds is None or not creds.valid:
+            return True
+        return creds.expiry is not None and creds.expiry - self.clock() < self.refresh_margin
+
+    def get(self):
+        """
+        Return credentials that stay valid for at least the refresh margin.
+
+        Only the first call, and calls made within the margin of expiry, take the lock.
+
+        Returns:
+            google.auth.credentials.Credentials: Google API credentials.
+        """
+        creds = self.creds
+        if not self.needs_refresh(creds):
+            return creds
+        with self.lock:
+            if self.needs_refresh(self.creds):
+                self._load_or_refresh()
+            return self.creds
+
+    def _load_or_refresh(self):
+        from google.auth.transport.requests import Request
+
+        # Another process may already have refreshed the token and saved it
+        stored = self._read_token_file()
+        if stored is not None and not self.needs_refresh(stored):
+            self._use(stored)
+            return
+        creds = self.creds or stored
+        if creds is not None and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            creds = self._authorize()
+        self._write_token_file(creds)
+        self._use(creds)
+
+    def _use(self, creds):
+        # Services built earlier hold on to self.creds, so a new token is copied into it rather than replacing it
+        if self.creds is None or self.creds is creds:
+            self.creds = creds
+            return
+        self.creds.token = creds.token
+        self.creds.expiry = creds.expiry
+        # google-auth has no public setter for the refresh token
+        self.creds._refresh_token = creds.refresh_token
+
+    def _read_token_file(self):
+        from google.oauth2 import credentials
+
+        try:
+            return credentials.Credentials.from_authorized_user_file(self.token_file, self.scopes)
+        except (OSError, ValueError):
+            return None
+
+    def _authorize(self):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        flow = InstalledAppFlow.from_client_secrets_file(self.client_secret_file, self.scopes)
+        return flow.run_local_server(port=0)
+
+    def _write_token_file(self, creds):
+        # Write a private temporary file and rename it, so readers never see a partial token
+        directory = os.path.dirname(os.path.abspath(self.token_file))
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.token-', suffix='.json')
+        try:
+            with os.fdopen(descriptor, 'w') as token:
+                token.write(creds.to_json())
+            os.replace(temp_path, self.token_file)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def seconds_until_refresh(self):
+        """
+        Seconds until the credentials enter the refresh margin.
+
+        Returns:
+            float: Seconds to wait, 0 if a refresh is due now, or None if the token does not expire.
+        """
+        creds = self.creds
+        if creds is None:
+            return 0.0
+        if creds.expiry is None:
+            return None
+        return max(0.0, (creds.expiry - self.clock() - self.refresh_margin).total_seconds())
+
+    def start_background_refresh(self):
+        """
+        Start a daemon thread that refreshes the token before it enters the refresh margin.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            if self.refresher is not None:
+                return
+            self.stopped.clear()
+            self.refresher = threading.Thread(target=self._refresh_loop, name='credential-refresh', daemon=True)
+            self.refresher.start()
+
+    def _refresh_loop(self):
+        while not self.stopped.is_set():
+            delay = self.seconds_until_refresh()
+            if delay:
+                if self.stopped.wait(delay):
+                    break
+                continue
+            if delay is None:
+                break
+            try:
+                self.get()
+            except Exception as e:
+                logger.error("Error refreshing Gmail credentials: %s", e)
+                self.stopped.wait(REFRESH_RETRY_SECONDS)
+
+    def stop_background_refresh(self):
+        """
+        Stop the background refresh thread.
+        """
+        self.stopped.set()
+        if self.refresher is not None:
+            self.refresher.join()
+            self.refresher = None
+
+def get_credential_provider(token_file=TOKEN_FILE):
+    """
+    Return the process-wide credential provider of a token file, creating it on first use.
+
+    Args:
+        token_file (str): File the OAuth token is stored in.
+
+    Returns:
+        CredentialProvider: Shared provider.
+    """
+    with providers_lock:
+        if token_file not in providers:
+            providers[token_file] = CredentialProvider(token_file)
+        return providers[token_file]
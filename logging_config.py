@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+DEFAULT_LOG_LEVEL = 'INFO'
+
+# Records allowed per message per interval; the rest are dropped and counted
+DEFAULT_RATE_LIMIT = 10
+DEFAULT_RATE_LIMIT_INTERVAL_SECONDS = 60
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drop records beyond `rate` per interval for each message, reporting how many were dropped.
+
+    Records are grouped by logger and unformatted message, so "Error fetching email %s: %s"
+    is limited as one message whatever the email. The first record let through after
+    some were dropped says how many.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, interval_seconds=DEFAULT_RATE_LIMIT_INTERVAL_SECONDS, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.interval_seconds = interval_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (logger name, message) -> [window start, records let through, records dropped]
+        self.windows = {}
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = self.clock()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval_seconds:
+                suppressed = window[2] if window is not None else 0
+                window = self.windows[key] = [now, 0, 0]
+            else:
+                suppressed = 0
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+        if suppressed and isinstance(record.args, tuple):
+            record.msg = f'{record.msg} (%d similar messages suppressed)'
+            record.args = record.args + (suppressed,)
+        return True
+
+def configure_logging(level=DEFAULT_LOG_LEVEL, rate=DEFAULT_RATE_LIMIT, interval_seconds=DEFAULT_RATE_LIMIT_INTERVAL_SECONDS):
+    """
+    Send log records of the scripts to stderr, rate-limited per message.
+
+    Args:
+        level (str): Minimum level, such as 'DEBUG' or 'WARNING'.
+        rate (int): Records let through per message per interval; 0 disables the limit.
+        interval_seconds (float): Length of the rate limiting window.
+
+    Returns:
+        logging.Handler: Installed handler.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if rate:
+        handler.addFilter(RateLimitFilter(rate, interval_seconds))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    return handler
+
+def add_logging_arguments(parser):
+    """
+    Add the --log-level and --log-rate-limit options to a script's parser.
+    """
+    parser.add_argument('--log-level', default=DEFAULT_LOG_LEVEL, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        type=str.upper, help='Minimum level of the messages logged.')
+    parser.add_argument('--log-rate-limit', type=int, default=DEFAULT_RATE_LIMIT,
+                        help=f'Times the same message may be logged per {DEFAULT_RATE_LIMIT_INTERVAL_SECONDS}s; 0 for no limit.')
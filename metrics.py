@@ -0,0 +1,401 @@
+import os
+import json
+import math
+import bisect
+import time
+import threading
+import contextlib
+
+# Histogram bucket upper bounds, in seconds: from a cheap in-memory step to a slow Gmail batch
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Seconds between two writes of the JSON metrics file
+DEFAULT_DUMP_INTERVAL_SECONDS = 60
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Counter:
+    """
+    Monotonic count, kept separately for every combination of label values.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        """
+        Add to the count of the given label values.
+
+        Args:
+            amount (float): Non-negative increment.
+            **labels: Value of every label name of the counter.
+        """
+        key = tuple(labels[name] for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(labels[name] for name in self.label_names), 0)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in sorted(self.values.items())]
+
+    def drain(self):
+        with self.lock:
+            values, self.values = self.values, {}
+        return [[list(key), value] for key, value in values.items()]
+
+    def merge(self, drained):
+        with self.lock:
+            for key, value in drained:
+                key = tuple(key)
+                self.values[key] = self.values.get(key, 0) + value
+
+    def clear(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets, with their count and sum.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # Per label values: [count per bucket (last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        """
+        Record one observation for the given label values.
+
+        Args:
+            value (float): Observed value, usually a duration in seconds.
+            **labels: Value of every label name of the histogram.
+        """
+        key = tuple(labels[name] for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, **labels):
+        """
+        Context manager observing the time spent in its block.
+        """
+        return timed(self, **labels)
+
+    def count(self, **labels):
+        state = self.values.get(tuple(labels[name] for name in self.label_names))
+        return sum(state[0]) if state else 0
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                samples.append((f'{self.name}_bucket', key, (('le', format_value(bound)),), cumulative))
+            samples.append((f'{self.name}_count', key, (), cumulative))
+            samples.append((f'{self.name}_sum', key, (), total))
+        return samples
+
+    def drain(self):
+        with self.lock:
+            values, self.values = self.values, {}
+        return [[list(key), counts, total] for key, (counts, total) in values.items()]
+
+    def merge(self, drained):
+        with self.lock:
+            for key, counts, total in drained:
+                key = tuple(key)
+                state = self.values.get(key)
+                if state is None:
+                    state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+                state[0] = [mine + theirs for mine, theirs in zip(state[0], counts)]
+                state[1] += total
+
+    def clear(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+class MetricsRegistry:
+    """
+    Named set of metrics, rendered together in the Prometheus text format or as JSON.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get_or_create(self, metric_class, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Metric '{name}' is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._get_or_create(Counter, name, documentation, label_names)
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, label_names, buckets)
+
+    def render_prometheus(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: Exposition text.
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for sample_name, key, extra, value in metric.samples():
+                lines.append(f'{sample_name}{format_labels(metric.label_names, key, extra)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Summarize every metric as plain data for a JSON dump.
+
+        Returns:
+            dict: Per metric, its kind and one entry per label combination.
+        """
+        snapshot = {}
+        for name, metric in sorted(self.metrics.items()):
+            series = []
+            with metric.lock:
+                items = sorted(metric.values.items())
+            for key, value in items:
+                entry = {'labels': dict(zip(metric.label_names, key))}
+                if metric.kind == 'counter':
+                    entry['value'] = value
+                else:
+                    entry['count'] = sum(value[0])
+                    entry['sum'] = value[1]
+                    entry['buckets'] = dict(zip(map(format_value, metric.buckets + (math.inf,)), value[0]))
+                series.append(entry)
+            snapshot[name] = {'type': metric.kind, 'series': series}
+        return snapshot
+
+    def drain(self):
+        """
+        Take the values recorded so far out of the registry, so another process can merge them.
+
+        Returns:
+            dict: Picklable values keyed by metric name.
+        """
+        return {name: metric.drain() for name, metric in list(self.metrics.items())}
+
+    def merge(self, drained):
+        """
+        Add values taken from another registry with drain().
+
+        Args:
+            drained (dict): Result of MetricsRegistry.drain.
+        """
+        for name, values in drained.items():
+            metric = self.metrics.get(name)
+            if metric is not None:
+                metric.merge(values)
+
+    def clear(self):
+        """
+        Drop every recorded value, keeping the metrics registered.
+        """
+        self.lock = threading.Lock()
+        for metric in self.metrics.values():
+            metric.clear()
+
+# Process-wide registry used by the scripts
+registry = MetricsRegistry()
+
+# A forked process (rule evaluation workers, benchmarks) starts counting from zero
+# instead of reporting the parent's values again
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry.clear)
+
+GMAIL_REQUEST_SECONDS = registry.histogram(
+    'gmail_request_seconds', 'Latency of Gmail API calls; a batch is one HTTP round trip.', ['method'])
+GMAIL_BATCH_ERRORS = registry.counter(
+    'gmail_batch_errors_total', 'Gmail batch sub-requests that failed, by kind.', ['kind'])
+DB_QUERY_SECONDS = registry.histogram(
+    'db_query_seconds', 'Latency of database statements and server-side cursor fetches.', ['operation'])
+DB_ROWS = registry.counter(
+    'db_rows_total', 'Rows written to or read from the database.', ['operation'])
+EMAIL_PARSE_SECONDS = registry.histogram(
+    'email_parse_seconds', 'Time to parse and clean one Gmail message into a database row.')
+EMAILS_INGESTED = registry.counter(
+    'emails_ingested_total', 'Emails parsed and handed to the database.')
+EMAILS_FAILED = registry.counter(
+    'emails_failed_total', 'Emails skipped because they could not be fetched, parsed or stored.', ['stage'])
+RULE_EVALUATION_SECONDS = registry.histogram(
+    'rule_evaluation_seconds', 'Time to evaluate every active rule against one email.')
+RULE_CHECK_SECONDS = registry.histogram(
+    'rule_check_seconds', 'Time to check one rule against one email, recorded when rule profiling is on.', ['rule'])
+RULE_MATCHES = registry.counter(
+    'rule_matches_total', 'Emails matched, by rule.', ['rule'])
+EMAILS_EVALUATED = registry.counter(
+    'emails_evaluated_total', 'Emails the rules were evaluated against.')
+RULE_ACTIONS = registry.counter(
+    'rule_actions_total', 'Emails whose labels were changed by rule actions, by label change.', ['action', 'outcome'])
+
+@contextlib.contextmanager
+def timed(histogram, **labels):
+    """
+    Observe the time spent in the block, including when it raises.
+
+    Args:
+        histogram (Histogram): Histogram to record the duration in.
+        **labels: Label values of the observation.
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started_at, **labels)
+
+def start_metrics_server(port, host='', metrics_registry=None):
+    """
+    Serve the metrics in the Prometheus text format from a daemon thread.
+
+    Args:
+        port (int): Port to listen on; 0 picks a free port.
+        host (str): Address to bind; all interfaces by default.
+        metrics_registry (MetricsRegistry): Registry to serve; the process-wide one by default.
+
+    Returns:
+        http.server.ThreadingHTTPServer: Running server; call shutdown() to stop it.
+    """
+    # http.server costs tens of milliseconds to import and most runs never serve metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = self.server.registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would flood the log
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    server.registry = metrics_registry if metrics_registry is not None else registry
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+def write_metrics_file(path, metrics_registry=None):
+    """
+    Write a JSON snapshot of the metrics, replacing the file atomically.
+
+    Args:
+        path (str): Destination file.
+        metrics_registry (MetricsRegistry): Registry to dump; the process-wide one by default.
+    """
+    metrics_registry = metrics_registry if metrics_registry is not None else registry
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as metrics_file:
+        json.dump({'written_at': time.time(), 'metrics': metrics_registry.snapshot()}, metrics_file)
+    os.replace(temp_path, path)
+
+class MetricsFileWriter:
+    """
+    Writes the JSON metrics snapshot every interval from a daemon thread, and once more on stop().
+    """
+
+    def __init__(self, path, interval_seconds=DEFAULT_DUMP_INTERVAL_SECONDS, metrics_registry=None):
+        self.path = path
+        self.interval_seconds = interval_seconds
+        self.registry = metrics_registry if metrics_registry is not None else registry
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            self.write()
+
+    def write(self):
+        try:
+            write_metrics_file(self.path, self.registry)
+        except OSError:
+            pass
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+def add_metrics_arguments(parser):
+    """
+    Add the --metrics-port, --metrics-file and --metrics-interval options to a script's parser.
+    """
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port at /metrics.')
+    parser.add_argument('--metrics-file', default=None,
+                        help='Write a JSON snapshot of the metrics to this file periodically and on exit.')
+    parser.add_argument('--metrics-interval', type=float, default=DEFAULT_DUMP_INTERVAL_SECONDS,
+                        help='Seconds between two writes of --metrics-file.')
+
+@contextlib.contextmanager
+def exporting_metrics(port=None, path=None, interval_seconds=DEFAULT_DUMP_INTERVAL_SECONDS):
+    """
+    Export the process-wide metrics for the duration of the block.
+
+    Args:
+        port (int): Serve them on this port; None disables the endpoint.
+        path (str): Dump them to this JSON file; None disables the dump.
+        interval_seconds (float): Seconds between two dumps.
+    """
+    server = start_metrics_server(port) if port is not None else None
+    writer = MetricsFileWriter(path, interval_seconds) if path else None
+    try:
+        yield
+    finally:
+        if writer is not None:
+            writer.stop()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
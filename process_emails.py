@@ -1,12 +1,19 @@
 import os
 import json
-import datetime
-from google.oauth2 import credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from database import fetch_all_emails
-from fetch_and_save_emails import authenticate_gmail
+import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from psycopg2 import sql
+from database import (stream_emails, email_id_bounds, close_pool, create_processing_state_table, create_sync_state_table, get_sync_state,
+                      save_sync_state, unprocessed_email_filter, processed_email_filter, advance_processed_emails, mark_emails_processed)
+from fetch_and_save_emails import authenticate_gmail, build_gmail_service
+from rule_engine import (load_rules, compile_rules, compile_condition, rules_to_sql, rule_columns, ruleset_hash, rule_versions, changed_rule_names,
+                         RuleIndex)
+from metrics import (registry, timed, add_metrics_arguments, exporting_metrics, GMAIL_REQUEST_SECONDS, RULE_EVALUATION_SECONDS,
+                     RULE_CHECK_SECONDS, RULE_MATCHES, EMAILS_EVALUATED, RULE_ACTIONS)
+from logging_config import configure_logging, add_logging_arguments
 
 # Constants
 CLIENT_SECRET_FILE = 'auth/credentials.json'
@@ -16,67 +23,552 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.labels'
 ]
 
-# Load the Rules from JSON
-with open('action_rules/rules.json', 'r') as rules_file:
-    rules_data = json.load(rules_file)
+# Gmail accepts at most 1000 message IDs per batchModify call
+BATCH_MODIFY_SIZE = 1000
 
-def fetch_emails_from_database(gmail_service):
+# Label name -> ID cache, loaded once per run and optionally persisted between runs
+LABEL_CACHE_FILE = '.label_cache.json'
+LABEL_CACHE_TTL_SECONDS = 3600
+label_cache = {'labels': None, 'loaded_at': 0.0, 'path': None}
+
+# Rule evaluation processes; each id range is streamed and evaluated by one worker
+DEFAULT_RULE_WORKERS = 1
+# Ranges queued per worker, so a worker that finishes early picks up more of the table
+ID_RANGES_PER_WORKER = 4
+# The parent runs the credential refresh and metrics threads by then; a forked child could
+# inherit a lock one of them holds, so workers start from a clean interpreter instead
+RULE_WORKER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Rules held by each rule evaluation process, set once by init_rule_worker
+rule_worker_state = {}
+
+# sync_state key of the rule versions the stored emails were last evaluated with
+RULE_VERSIONS_STATE_KEY = 'rule_versions'
+
+# Rules from action_rules/rules.json, loaded and compiled on first use
+rules_cache = {'rules_data': None, 'compiled_rules': None}
+
+logger = logging.getLogger(__name__)
+
+def get_rules_data():
+    """
+    Load the rules from action_rules/rules.json on first use.
+
+    Returns:
+        list: Rule definitions in the rules.json format.
+    """
+    if rules_cache['rules_data'] is None:
+        rules_cache['rules_data'] = load_rules()
+    return rules_cache['rules_data']
+
+def use_rules(rules_data):
     """
-    Fetch emails from the database and initiate processing.
+    Replace the cached rules, for callers that load and validate the rules file themselves.
+
+    Args:
+        rules_data (list): Rule definitions in the rules.json format.
+
+    Returns:
+        None
+    """
+    rules_cache['rules_data'] = rules_data
+    rules_cache['compiled_rules'] = None
+
+def get_compiled_rules():
+    """
+    Compile the active rules on first use.
+
+    Returns:
+        list: CompiledRule for each active rule.
+    """
+    if rules_cache['compiled_rules'] is None:
+        rules_cache['compiled_rules'] = compile_rules(get_rules_data())
+    return rules_cache['compiled_rules']
+
+def fetch_emails_from_database(gmail_service, create_missing_labels=False, workers=DEFAULT_RULE_WORKERS, full=False, profile_rules=False):
+    """
+    Stream the emails that could match an active rule from the database and initiate processing.
+
+    The active rules are translated into one SQL condition and only the columns they
+    reference are selected, so only candidate rows are loaded; rows arrive through a
+    server-side cursor and are checked against the compiled rules one at a time.
+    With more than one worker the candidate ids are split into ranges that are
+    evaluated in separate processes, and only the resulting label changes come back.
+
+    Every evaluated email is recorded in 'email_processing_state' with the hash of
+    the ruleset, and later runs skip emails already processed with the same rules.
+    When some rules changed since the last run, only those rules are evaluated
+    against the emails that run processed; see reevaluate_changed_rules.
 
     Args:
         gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        create_missing_labels (bool): Create 'move_to_folder' labels that do not exist yet.
+        workers (int): Number of processes evaluating the rules.
+        full (bool): Evaluate every candidate email, including those already processed.
+        profile_rules (bool): Record the time each rule check takes, by rule.
 
     Returns:
         None
     """
     try:
-        print("=" * 60)
-        print("Fetching Emails From Database")
-        print("=" * 60) 
-        emails = fetch_all_emails()
-        if not emails:
-            print('No emails found in the database.')
+        logger.info("Fetching Emails From Database")
+        rules_data = get_rules_data()
+        current_ruleset_hash = ruleset_hash(rules_data)
+        candidate_filter = candidate_email_filter(rules_data, current_ruleset_hash, full)
+        if candidate_filter is None:
+            logger.info('No active rules found.')
+            return
+        if not full:
+            reevaluate_changed_rules(gmail_service, rules_data, create_missing_labels)
+        columns = rule_columns(rules_data)
+        rule_index = RuleIndex(rules_data, columns)
+        if profile_rules:
+            rule_index.profile_rule_checks(RULE_CHECK_SECONDS)
+        logger.info("Processing Emails")
+        folder_label_ids = resolve_folder_label_ids(gmail_service, rule_index.rules, create_missing_labels)
+        label_deltas = [actions_to_label_delta(rule.actions, folder_label_ids) for rule in rule_index.rules]
+        pending_modifications = {}
+        if workers > 1:
+            processed, matched = evaluate_rules_in_parallel(
+                gmail_service, rules_data, label_deltas, pending_modifications, workers, current_ruleset_hash, full, profile_rules)
+        else:
+            processed = 0
+            matched = 0
+            unmatched_ids = []
+            for email in stream_emails(columns, *candidate_filter):
+                processed += 1
+                label_delta = email_label_delta(email, rule_index, label_deltas)
+                if label_delta is None:
+                    queue_unmatched_email(unmatched_ids, email[1], current_ruleset_hash)
+                else:
+                    matched += 1
+                    queue_label_delta(gmail_service, pending_modifications, email[1], label_delta, current_ruleset_hash)
+            mark_emails_processed(unmatched_ids, current_ruleset_hash)
+            EMAILS_EVALUATED.inc(processed)
+        for label_delta, message_ids in pending_modifications.items():
+            if message_ids:
+                batch_modify_emails(gmail_service, message_ids, label_delta, current_ruleset_hash)
+        save_applied_rule_versions(rules_data)
+        if not processed:
+            logger.info('No new emails in the database match the active rules.')
         else:
-            print(f'Total emails in the database: {len(emails)}')
-            print("=" * 60)
-            print("Processing Emails")
-            print("=" * 60) 
-            for email in emails:
-                process_email(gmail_service, email)
+            logger.info('Candidate emails processed: %d, emails modified: %d', processed, matched)
     
     except Exception as e:
-        print(f"Error fetching emails from the database: {str(e)}")
+        logger.error("Error fetching emails from the database: %s", e)
+
+def load_applied_rule_versions():
+    """
+    Read the rules the stored emails were last evaluated with.
+
+    Returns:
+        tuple: (ruleset hash, rule versions keyed by name in rule order), or (None, None) before the first run.
+    """
+    state = get_sync_state(RULE_VERSIONS_STATE_KEY)
+    if state is None:
+        return None, None
+    applied = json.loads(state)
+    return applied['ruleset_hash'], applied['rule_versions']
+
+def save_applied_rule_versions(rules_data):
+    """
+    Record the rules the stored emails have been evaluated with.
+
+    Args:
+        rules_data (list): Rule definitions in the rules.json format.
+
+    Returns:
+        None
+    """
+    save_sync_state(RULE_VERSIONS_STATE_KEY, json.dumps({
+        'ruleset_hash': ruleset_hash(rules_data),
+        'rule_versions': rule_versions(rules_data),
+    }))
+
+def reevaluate_changed_rules(gmail_service, rules_data, create_missing_labels=False):
+    """
+    Bring the emails processed with the previous rules up to date by evaluating only the rules that changed.
+
+    Only emails matching a new or changed rule are loaded. Each is evaluated against
+    every active rule, so conflicting actions resolve as in a full pass, and its labels
+    are changed if a new or changed rule matches. All other emails processed with the
+    previous rules are recorded as processed with the current ones in one statement.
+    Removed or deactivated rules leave their labels in place. If the unchanged rules
+    were reordered, nothing is done here and the main pass re-evaluates every email.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        rules_data (list): Rule definitions in the rules.json format.
+        create_missing_labels (bool): Create 'move_to_folder' labels that do not exist yet.
+
+    Returns:
+        tuple: (number of emails evaluated, number of emails matched).
+    """
+    previous_ruleset_hash, previous_versions = load_applied_rule_versions()
+    current_ruleset_hash = ruleset_hash(rules_data)
+    if previous_ruleset_hash is None or previous_ruleset_hash == current_ruleset_hash:
+        return 0, 0
+    changed_names = changed_rule_names(previous_versions, rule_versions(rules_data))
+    if changed_names is None:
+        logger.info('Rules were reordered, every candidate email will be evaluated again')
+        return 0, 0
+    logger.info('Evaluating new or changed rules: %s', ', '.join(changed_names) or 'none')
+
+    changes = []
+    processed = 0
+    changed_rules_data = [rule for rule in rules_data if any(rule_name in changed_names for rule_name in rule)]
+    changed_filter = rules_to_sql(changed_rules_data)
+    if changed_filter is not None:
+        columns = rule_columns(rules_data)
+        rule_index = RuleIndex(rules_data, columns)
+        changed_positions = {position for position, rule in enumerate(rule_index.rules) if rule.name in changed_names}
+        folder_label_ids = resolve_folder_label_ids(gmail_service, rule_index.rules, create_missing_labels)
+        label_deltas = [actions_to_label_delta(rule.actions, folder_label_ids) for rule in rule_index.rules]
+        changed_clause, params = changed_filter
+        state_clause, state_params = processed_email_filter(previous_ruleset_hash)
+        where_clause = sql.SQL('({}) AND {}').format(changed_clause, state_clause)
+        for email in stream_emails(columns, where_clause, params + state_params):
+            processed += 1
+            positions = rule_index.matching_positions(email)
+            if changed_positions.isdisjoint(positions):
+                continue
+            for position in positions:
+                RULE_MATCHES.inc(rule=rule_index.rules[position].name)
+            changes.append((email[1], merge_label_deltas(label_deltas[position] for position in positions)))
+        EMAILS_EVALUATED.inc(processed)
+
+    # Matched emails are recorded once their labels are changed; a failed change is retried by the main pass
+    advance_processed_emails(previous_ruleset_hash, current_ruleset_hash, [email_id for email_id, _ in changes])
+    pending_modifications = {}
+    for email_id, label_delta in changes:
+        queue_label_delta(gmail_service, pending_modifications, email_id, label_delta, current_ruleset_hash)
+    for label_delta, message_ids in pending_modifications.items():
+        if message_ids:
+            batch_modify_emails(gmail_service, message_ids, label_delta, current_ruleset_hash)
+    save_applied_rule_versions(rules_data)
+    logger.info('Emails evaluated against changed rules: %d, emails modified: %d', processed, len(changes))
+    return processed, len(changes)
+
+def candidate_email_filter(rules_data, current_ruleset_hash, full=False):
+    """
+    Build the condition selecting the emails to evaluate.
+
+    Args:
+        rules_data (list): Rule definitions as loaded from the rules file.
+        current_ruleset_hash (str): Hash of the rules.
+        full (bool): Include emails already processed with these rules.
+
+    Returns:
+        tuple: (psycopg2.sql.Composable, list of parameters), or None if no rule is active.
+    """
+    rule_filter = rules_to_sql(rules_data)
+    if rule_filter is None or full:
+        return rule_filter
+    rule_clause, params = rule_filter
+    state_clause, state_params = unprocessed_email_filter(current_ruleset_hash)
+    return sql.SQL('({}) AND {}').format(rule_clause, state_clause), params + state_params
+
+def queue_label_delta(gmail_service, pending_modifications, email_id, label_delta, current_ruleset_hash=None):
+    """
+    Group an email with the others that need the same label change, sending full groups.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        pending_modifications (dict): Email IDs waiting for a batchModify, keyed by label delta.
+        email_id (str): ID of the email.
+        label_delta (tuple): (add, remove) label ID sets.
+        current_ruleset_hash (str): Hash of the rules, recorded for the emails once modified.
+
+    Returns:
+        None
+    """
+    message_ids = pending_modifications.setdefault(label_delta, [])
+    message_ids.append(email_id)
+    if len(message_ids) >= BATCH_MODIFY_SIZE:
+        batch_modify_emails(gmail_service, message_ids, label_delta, current_ruleset_hash)
+        message_ids.clear()
+
+def queue_unmatched_email(unmatched_ids, email_id, current_ruleset_hash):
+    """
+    Collect an email no rule matched, recording full batches as processed.
+
+    Args:
+        unmatched_ids (list): Email IDs waiting to be recorded.
+        email_id (str): ID of the email.
+        current_ruleset_hash (str): Hash of the rules.
+
+    Returns:
+        None
+    """
+    unmatched_ids.append(email_id)
+    if len(unmatched_ids) >= BATCH_MODIFY_SIZE:
+        mark_emails_processed(unmatched_ids, current_ruleset_hash)
+        unmatched_ids.clear()
+
+def partition_id_range(min_id, max_id, partitions):
+    """
+    Split the ids from min_id to max_id into contiguous ranges of similar size.
+
+    Args:
+        min_id (int): Smallest id, included in the first range.
+        max_id (int): Largest id, included in the last range.
+        partitions (int): Maximum number of ranges.
+
+    Returns:
+        list: (start, end) ranges; start is included, end is not.
+    """
+    span = max_id - min_id + 1
+    partitions = max(1, min(partitions, span))
+    bounds = [min_id + span * number // partitions for number in range(partitions + 1)]
+    return list(zip(bounds, bounds[1:]))
 
-def process_email(gmail_service, email_data):
+def init_rule_worker(worker_rules_data, label_deltas, current_ruleset_hash, full=False, profile_rules=False):
+    """
+    Compile the rules once in a rule evaluation process.
+
+    Args:
+        worker_rules_data (list): Rule definitions in the rules.json format.
+        label_deltas (list): Label delta of each active rule, in rule order.
+        current_ruleset_hash (str): Hash of the rules.
+        full (bool): Include emails already processed with these rules.
+        profile_rules (bool): Record the time each rule check takes, by rule.
+
+    Returns:
+        None
+    """
+    columns = rule_columns(worker_rules_data)
+    rule_worker_state['columns'] = columns
+    rule_worker_state['ruleset_hash'] = current_ruleset_hash
+    rule_worker_state['candidate_filter'] = candidate_email_filter(worker_rules_data, current_ruleset_hash, full)
+    rule_worker_state['rule_index'] = RuleIndex(worker_rules_data, columns)
+    if profile_rules:
+        rule_worker_state['rule_index'].profile_rule_checks(RULE_CHECK_SECONDS)
+    rule_worker_state['label_deltas'] = label_deltas
+
+def evaluate_email_range(id_range):
+    """
+    Evaluate the rules against the candidate emails in one id range.
+
+    Runs in a rule evaluation process that streams the range over its own database connection.
+    Emails no rule matches are recorded as processed here; the others are recorded by
+    the parent once their label change has been applied.
+
+    Args:
+        id_range (tuple): (start, end) range of ids; start is included, end is not.
+
+    Returns:
+        tuple: (number of emails evaluated, list of (email ID, label delta) for the matching emails,
+            metrics recorded by the process since its last range, for the parent to merge).
+    """
+    rule_index = rule_worker_state['rule_index']
+    label_deltas = rule_worker_state['label_deltas']
+    current_ruleset_hash = rule_worker_state['ruleset_hash']
+    processed = 0
+    changes = []
+    unmatched_ids = []
+    for email in stream_emails(rule_worker_state['columns'], *rule_worker_state['candidate_filter'], id_range=id_range):
+        processed += 1
+        label_delta = email_label_delta(email, rule_index, label_deltas)
+        if label_delta is None:
+            queue_unmatched_email(unmatched_ids, email[1], current_ruleset_hash)
+        else:
+            changes.append((email[1], label_delta))
+    mark_emails_processed(unmatched_ids, current_ruleset_hash)
+    EMAILS_EVALUATED.inc(processed)
+    return processed, changes, registry.drain()
+
+def evaluate_rules_in_parallel(gmail_service, rules_data, label_deltas, pending_modifications, workers, current_ruleset_hash, full=False,
+                               profile_rules=False):
+    """
+    Evaluate the rules over id ranges in a process pool and queue the resulting label changes.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        rules_data (list): Rule definitions in the rules.json format.
+        label_deltas (list): Label delta of each active rule, in rule order.
+        pending_modifications (dict): Email IDs waiting for a batchModify, keyed by label delta.
+        workers (int): Number of processes.
+        current_ruleset_hash (str): Hash of the rules.
+        full (bool): Include emails already processed with these rules.
+        profile_rules (bool): Record the time each rule check takes, by rule.
+
+    Returns:
+        tuple: (number of emails evaluated, number of emails matched).
+    """
+    min_id, max_id = email_id_bounds(*candidate_email_filter(rules_data, current_ruleset_hash, full))
+    if min_id is None:
+        return 0, 0
+    id_ranges = partition_id_range(min_id, max_id, workers * ID_RANGES_PER_WORKER)
+    # Workers open their own connections; the parent's stay unused until they finish
+    close_pool()
+    processed = 0
+    matched = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(RULE_WORKER_START_METHOD), initializer=init_rule_worker,
+                             initargs=(rules_data, label_deltas, current_ruleset_hash, full, profile_rules)) as executor:
+        futures = [executor.submit(evaluate_email_range, id_range) for id_range in id_ranges]
+        for future in as_completed(futures):
+            range_processed, changes, worker_metrics = future.result()
+            registry.merge(worker_metrics)
+            processed += range_processed
+            matched += len(changes)
+            for email_id, label_delta in changes:
+                queue_label_delta(gmail_service, pending_modifications, email_id, label_delta, current_ruleset_hash)
+    return processed, matched
+
+def process_email(gmail_service, email_data, rules=None):
     """
     Process an email based on predefined rules.
 
     Args:
         gmail_service (googleapiclient.discovery.Resource): Gmail API service.
         email_data (tuple): Tuple containing email details.
+        rules (list): Compiled rules to apply; defaults to the active rules from rules.json.
 
     Returns:
         None
     """
+    if rules is None:
+        rules = get_compiled_rules()
 
-    Id = email_data[0]
     email_id = email_data[1]
-    email_subject = email_data[2]
-    email_sender = email_data[3]
-    email_receiver = email_data[4]
-    email_date = email_data[5]
-    email_message = email_data[6]
-
-    for rule in rules_data:
-        for rule_name, rule_data in rule.items():
-            if rule_data.get('active') == 1 and rule_data.get('collective_predicate') == "Any":
-                if any(check_rule_condition(email_data, condition) for condition in rule_data.get("conditions")):
-                    perform_rule_actions(gmail_service, email_id, rule_data["actions"])
-
-            if rule_data.get('active') == 1 and rule_data.get('collective_predicate') == "All":
-                if all(check_rule_condition(email_data, condition) for condition in rule_data.get("conditions")):
-                    perform_rule_actions(gmail_service, email_id, rule_data["actions"])
+
+    for rule in rules:
+        if rule.matches(email_data):
+            perform_rule_actions(gmail_service, email_id, rule.actions)
+
+def resolve_folder_label_ids(gmail_service, rules, create_missing=False):
+    """
+    Resolve the 'move_to_folder' target of every rule to a label ID once per run.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        rules (list): Compiled rules.
+        create_missing (bool): Create labels that do not exist yet.
+
+    Returns:
+        dict: Label ID (or None if the label does not exist) keyed by folder name.
+    """
+    folder_label_ids = {}
+    for rule in rules:
+        folder_name = rule.actions.get('move_to_folder')
+        if folder_name and folder_name not in folder_label_ids:
+            folder_label_ids[folder_name] = get_label_id(gmail_service, folder_name, create_missing)
+            if folder_label_ids[folder_name] is None:
+                logger.error("Error: Label '%s' not found.", folder_name)
+    return folder_label_ids
+
+def actions_to_label_delta(actions, folder_label_ids):
+    """
+    Translate rule actions into the labels to add and remove.
+
+    Args:
+        actions (dict): Dictionary containing rule actions.
+        folder_label_ids (dict): Label IDs keyed by folder name.
+
+    Returns:
+        tuple: (frozenset of label IDs to add, frozenset of label IDs to remove).
+    """
+    add_labels = set()
+    remove_labels = set()
+    if actions["mark_as_read"]:
+        remove_labels.add('UNREAD')
+    else:
+        add_labels.add('UNREAD')
+    label_id = folder_label_ids.get(actions.get('move_to_folder'))
+    if label_id:
+        add_labels.add(label_id)
+    return frozenset(add_labels), frozenset(remove_labels)
+
+def merge_label_deltas(label_deltas):
+    """
+    Merge label deltas in rule order; a later rule wins when two rules disagree on a label.
+
+    Args:
+        label_deltas (iterable): (add, remove) label ID sets.
+
+    Returns:
+        tuple: (frozenset of label IDs to add, frozenset of label IDs to remove).
+    """
+    add_labels = set()
+    remove_labels = set()
+    for add, remove in label_deltas:
+        add_labels -= remove
+        remove_labels -= add
+        add_labels |= add
+        remove_labels |= remove
+    return frozenset(add_labels), frozenset(remove_labels)
+
+def email_label_delta(email_data, rule_index, label_deltas):
+    """
+    Evaluate the rules against an email and merge the label changes of the matching ones.
+
+    Args:
+        email_data (tuple): Tuple containing email details.
+        rule_index (rule_engine.RuleIndex): Index of the active rules.
+        label_deltas (list): Label delta of each rule in rule_index.rules.
+
+    Returns:
+        tuple: Merged (add, remove) label ID sets, or None if no rule matches.
+    """
+    started_at = time.perf_counter()
+    positions = rule_index.matching_positions(email_data)
+    RULE_EVALUATION_SECONDS.observe(time.perf_counter() - started_at)
+    if not positions:
+        return None
+    for position in positions:
+        RULE_MATCHES.inc(rule=rule_index.rules[position].name)
+    matching_deltas = [label_deltas[position] for position in positions]
+    if len(matching_deltas) == 1:
+        return matching_deltas[0]
+    return merge_label_deltas(matching_deltas)
+
+def label_delta_name(label_delta):
+    """
+    Describe a label delta for logs and metrics, such as '+Label_3 -UNREAD'.
+    """
+    add_labels, remove_labels = label_delta
+    return ' '.join([f'+{label}' for label in sorted(add_labels)] + [f'-{label}' for label in sorted(remove_labels)])
+
+def batch_modify_emails(gmail_service, message_ids, label_delta, current_ruleset_hash=None):
+    """
+    Apply one label delta to many emails with batchModify calls of up to BATCH_MODIFY_SIZE IDs.
+
+    If Gmail rejects a label ID, the label cache and its persisted file are dropped so
+    the next run looks the labels up again, and the remaining chunks are not sent.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        message_ids (list): IDs of the emails.
+        label_delta (tuple): (add, remove) label ID sets.
+        current_ruleset_hash (str): If given, emails are recorded as processed with these rules once modified.
+
+    Returns:
+        None
+    """
+    add_labels, remove_labels = label_delta
+    action = label_delta_name(label_delta)
+    for start in range(0, len(message_ids), BATCH_MODIFY_SIZE):
+        chunk = message_ids[start:start + BATCH_MODIFY_SIZE]
+        try:
+            with timed(GMAIL_REQUEST_SECONDS, method='messages.batchModify'):
+                gmail_service.users().messages().batchModify(userId='me', body={
+                    'ids': chunk,
+                    'addLabelIds': sorted(add_labels),
+                    'removeLabelIds': sorted(remove_labels),
+                }).execute()
+            RULE_ACTIONS.inc(len(chunk), action=action, outcome='applied')
+            logger.info("Rule actions %s applied to %d emails", action, len(chunk))
+        except Exception as e:
+            if is_invalid_label_error(e):
+                RULE_ACTIONS.inc(len(message_ids) - start, action=action, outcome='failed')
+                logger.error("Error applying rule actions %s to %d emails, a label no longer exists: %s", action, len(message_ids) - start, e)
+                invalidate_label_cache(forget_persisted=True)
+                return
+            RULE_ACTIONS.inc(len(chunk), action=action, outcome='failed')
+            logger.error("Error applying rule actions %s to %d emails: %s", action, len(chunk), e)
+        else:
+            if current_ruleset_hash is not None:
+                mark_emails_processed(chunk, current_ruleset_hash)
 
 def perform_rule_actions(gmail_service, email_id, actions):
     """
@@ -99,12 +591,10 @@ def perform_rule_actions(gmail_service, email_id, actions):
         if "move_to_folder" in actions:
             move_email_to_folder(gmail_service, email_id, actions['move_to_folder'])
 
-        print("=" * 60)
-        print("Rule Condition Checked and Action Performed for Email : ", email_id)
-        print("=" * 60)
+        logger.debug("Rule Condition Checked and Action Performed for Email: %s", email_id)
 
     except Exception as e:
-        print(f"Error performing rule actions: {str(e)}")
+        logger.error("Error performing rule actions: %s", e)
 
 def check_rule_condition(email_data, condition):
     """
@@ -117,39 +607,10 @@ def check_rule_condition(email_data, condition):
     Returns:
         bool: True if the condition is satisfied, False otherwise.
     """
-    field = condition["field"]
-    predicate = condition["predicate"]
-    value = condition["value"]
-
-    if field == "subject":
-        if predicate == "contains" and value in email_data[2]:
-            print("Condition matched: subject contains value")
-            return True
-        elif predicate == "does not contain" and value not in email_data[2]:
-            return True
-    elif field == "sender":
-        if predicate == "contains" and value in email_data[3]:
-            return True
-        elif predicate == "does not contain" and value not in email_data[3]:
-            return True
-    elif field == "receiver":
-        if predicate == "contains" and value in email_data[4]:
-            return True
-        elif predicate == "does not contain" and value not in email_data[4]:
-            return True
-    elif field == "message":
-        if predicate == "contains" and value in email_data[6]:
-            return True
-        elif predicate == "does not contain" and value not in email_data[6]:
-            return True
-    elif field == "date":
-        email_date = datetime.datetime.strptime(str(email_data[5]), "%Y-%m-%d %H:%M:%S")
-        rule_date = datetime.datetime.strptime(value, "%Y-%m-%d")
-        if predicate == "greater than" and email_date > rule_date:
-            return True
-        elif predicate == "lesser than" and email_date < rule_date:
-            return True
-    return False
+    try:
+        return compile_condition(condition)(email_data)
+    except ValueError:
+        return False
 
 def mark_email_as_read(gmail_service, email_id):
     """
@@ -163,9 +624,12 @@ def mark_email_as_read(gmail_service, email_id):
         None
     """
     try:
-        gmail_service.users().messages().modify(userId='me', id=email_id, body={'removeLabelIds': ['UNREAD']}).execute()
+        with timed(GMAIL_REQUEST_SECONDS, method='messages.modify'):
+            gmail_service.users().messages().modify(userId='me', id=email_id, body={'removeLabelIds': ['UNREAD']}).execute()
+        RULE_ACTIONS.inc(action='-UNREAD', outcome='applied')
     except Exception as e:
-        print(f"Error marking email as read: {str(e)}")
+        RULE_ACTIONS.inc(action='-UNREAD', outcome='failed')
+        logger.error("Error marking email as read: %s", e)
 
 def mark_email_as_unread(gmail_service, email_id):
     """
@@ -179,9 +643,12 @@ def mark_email_as_unread(gmail_service, email_id):
         None
     """
     try:
-        gmail_service.users().messages().modify(userId='me', id=email_id, body={'addLabelIds': ['UNREAD']}).execute()
+        with timed(GMAIL_REQUEST_SECONDS, method='messages.modify'):
+            gmail_service.users().messages().modify(userId='me', id=email_id, body={'addLabelIds': ['UNREAD']}).execute()
+        RULE_ACTIONS.inc(action='+UNREAD', outcome='applied')
     except Exception as e:
-        print(f"Error marking email as unread: {str(e)}")
+        RULE_ACTIONS.inc(action='+UNREAD', outcome='failed')
+        logger.error("Error marking email as unread: %s", e)
 
 def move_email_to_folder(gmail_service, email_id, folder_name):
     """
@@ -198,43 +665,226 @@ def move_email_to_folder(gmail_service, email_id, folder_name):
     try:
         label_id = get_label_id(gmail_service, folder_name)
         if label_id:
-            gmail_service.users().messages().modify(userId='me', id=email_id, body={'addLabelIds': [label_id]}).execute()
+            with timed(GMAIL_REQUEST_SECONDS, method='messages.modify'):
+                gmail_service.users().messages().modify(userId='me', id=email_id, body={'addLabelIds': [label_id]}).execute()
+            RULE_ACTIONS.inc(action=f'+{label_id}', outcome='applied')
         else:
-            print(f"Error: Label '{folder_name}' not found.")
+            logger.error("Error: Label '%s' not found.", folder_name)
     except Exception as e:
-        print(f"Error moving email to folder: {str(e)}")
+        logger.error("Error moving email to folder: %s", e)
+
+def configure_label_cache(path=None):
+    """
+    Set the file the label cache is persisted to and drop the labels held in memory.
 
-def get_label_id(gmail_service, folder_name):
+    Args:
+        path (str): Cache file, or None to keep the cache in memory only.
+
+    Returns:
+        None
+    """
+    label_cache['path'] = path
+    invalidate_label_cache()
+
+def invalidate_label_cache(forget_persisted=False):
+    """
+    Forget the cached labels so the next lookup lists them from Gmail again.
+
+    Args:
+        forget_persisted (bool): Delete the persisted cache file too, so later runs list them again as well.
+
+    Returns:
+        None
+    """
+    label_cache['labels'] = None
+    label_cache['loaded_at'] = 0.0
+    if forget_persisted and label_cache['path']:
+        try:
+            os.remove(label_cache['path'])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error("Error deleting label cache: %s", e)
+
+def is_invalid_label_error(exception):
+    """
+    Check whether a Gmail API error rejected a label ID, as happens for a label deleted in Gmail.
+
+    Args:
+        exception (Exception): Error raised by a request.
+
+    Returns:
+        bool: True for a 400 response naming an invalid label.
+    """
+    from googleapiclient.errors import HttpError
+    return isinstance(exception, HttpError) and exception.resp.status == 400 and 'invalid label' in str(exception.reason).lower()
+
+def read_persisted_labels(path, ttl_seconds):
+    """
+    Read labels persisted by an earlier run if they are younger than the TTL.
+
+    Returns:
+        tuple: (labels dict, save time), or (None, 0.0) if the file is missing, unreadable or expired.
+    """
+    try:
+        with open(path, 'r') as cache_file:
+            persisted = json.load(cache_file)
+        if time.time() - persisted['saved_at'] < ttl_seconds:
+            return persisted['labels'], persisted['saved_at']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None, 0.0
+
+def persist_labels(path, labels, saved_at):
+    """
+    Persist the label cache, replacing the file atomically.
+
+    Returns:
+        None
+    """
+    try:
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as cache_file:
+            json.dump({'saved_at': saved_at, 'labels': labels}, cache_file)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.error("Error saving label cache: %s", e)
+
+def load_label_cache(gmail_service, refresh=False, ttl_seconds=LABEL_CACHE_TTL_SECONDS):
+    """
+    Return the label name -> ID mapping, listing labels from Gmail only when the cache is empty or stale.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        refresh (bool): Ignore cached labels and list them again.
+        ttl_seconds (float): Maximum age of cached labels.
+
+    Returns:
+        dict: Label IDs keyed by label name.
+    """
+    now = time.time()
+    if not refresh and label_cache['labels'] is not None and now - label_cache['loaded_at'] < ttl_seconds:
+        return label_cache['labels']
+
+    path = label_cache['path']
+    if not refresh and path:
+        labels, saved_at = read_persisted_labels(path, ttl_seconds)
+        if labels is not None:
+            label_cache['labels'], label_cache['loaded_at'] = labels, saved_at
+            return labels
+
+    with timed(GMAIL_REQUEST_SECONDS, method='labels.list'):
+        response = gmail_service.users().labels().list(userId='me').execute()
+    labels = {label['name']: label['id'] for label in response.get('labels', [])}
+    label_cache['labels'], label_cache['loaded_at'] = labels, now
+    if path:
+        persist_labels(path, labels, now)
+    return labels
+
+def create_label(gmail_service, folder_name):
+    """
+    Create a user label and add it to the cache.
+
+    Args:
+        gmail_service (googleapiclient.discovery.Resource): Gmail API service.
+        folder_name (str): Name of the folder.
+
+    Returns:
+        str: ID of the new label.
+    """
+    with timed(GMAIL_REQUEST_SECONDS, method='labels.create'):
+        label = gmail_service.users().labels().create(userId='me', body={
+            'name': folder_name,
+            'labelListVisibility': 'labelShow',
+            'messageListVisibility': 'show',
+        }).execute()
+    labels = label_cache['labels'] if label_cache['labels'] is not None else {}
+    labels[folder_name] = label['id']
+    label_cache['labels'] = labels
+    if label_cache['path']:
+        persist_labels(label_cache['path'], labels, label_cache['loaded_at'] or time.time())
+    return label['id']
+
+def get_label_id(gmail_service, folder_name, create_missing=False):
     """
     Get the label ID for a specific folder.
 
+    Labels are served from the label cache; a name missing from the cache triggers
+    one fresh listing in case the label was created since the cache was loaded.
+
     Args:
         gmail_service (googleapiclient.discovery.Resource): Gmail API service.
         folder_name (str): Name of the folder.
+        create_missing (bool): Create the label if it does not exist.
 
     Returns:
         str: Label ID for the folder.
     """
     try:
-        labels = gmail_service.users().labels().list(userId='me').execute()
-        for label in labels['labels']:
-            if label['name'] == folder_name:
-                return label['id']
-        return None
+        label_id = load_label_cache(gmail_service).get(folder_name)
+        if label_id is None:
+            label_id = load_label_cache(gmail_service, refresh=True).get(folder_name)
+        if label_id is None and create_missing:
+            label_id = create_label(gmail_service, folder_name)
+        return label_id
     except Exception as e:
-        print(f"Error getting label ID for folder: {str(e)}")
+        logger.error("Error getting label ID for folder: %s", e)
         return None
 
 
-def main():
-    creds = authenticate_gmail()
+def main(label_cache_file=LABEL_CACHE_FILE, create_missing_labels=False, workers=DEFAULT_RULE_WORKERS, full=False, profile_rules=False):
+    """
+    Apply the active rules to the stored emails.
+
+    Args:
+        label_cache_file (str): File the label cache is persisted to; None keeps it in memory.
+        create_missing_labels (bool): Create 'move_to_folder' labels that do not exist yet.
+        workers (int): Number of processes evaluating the rules.
+        full (bool): Re-evaluate emails already processed with the current rules.
+        profile_rules (bool): Record the time each rule check takes, by rule.
+
+    Returns:
+        None
+    """
+    creds = authenticate_gmail(background_refresh=True)
+    configure_label_cache(label_cache_file)
+    create_sync_state_table()
+    create_processing_state_table()
 
     # Gmail API service
-    gmail_service = build('gmail', 'v1', credentials=creds)
-    fetch_emails_from_database(gmail_service)
+    gmail_service = build_gmail_service(creds)
+    fetch_emails_from_database(gmail_service, create_missing_labels, workers, full, profile_rules)
+
+def parse_args(argv=None):
+    """
+    Parse command line options for the processing script.
+
+    Args:
+        argv (list): Arguments to parse; defaults to sys.argv.
+
+    Returns:
+        argparse.Namespace: Parsed options.
+    """
+    parser = argparse.ArgumentParser(description='Apply the rules in action_rules/rules.json to the stored emails.')
+    parser.add_argument('--label-cache', default=LABEL_CACHE_FILE,
+                        help='File the Gmail label cache is persisted to.')
+    parser.add_argument('--no-label-cache', dest='label_cache', action='store_const', const=None,
+                        help='Keep the Gmail label cache in memory only.')
+    parser.add_argument('--create-missing-labels', action='store_true',
+                        help="Create 'move_to_folder' labels that do not exist yet.")
+    parser.add_argument('--workers', type=int, default=DEFAULT_RULE_WORKERS,
+                        help='Processes evaluating the rules over ranges of stored emails.')
+    parser.add_argument('--full', action='store_true',
+                        help='Re-evaluate every stored email, not only those new since the rules last ran.')
+    parser.add_argument('--profile-rules', action='store_true',
+                        help='Record the time each rule check takes in the rule_check_seconds metric.')
+    add_logging_arguments(parser)
+    add_metrics_arguments(parser)
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
-    main()
-    print("=" * 60)
-    print("Completed Processing Emails")
-    print("=" * 60)
+    args = parse_args()
+    configure_logging(args.log_level, args.log_rate_limit)
+    with exporting_metrics(args.metrics_port, args.metrics_file, args.metrics_interval):
+        main(args.label_cache, args.create_missing_labels, args.workers, args.full, args.profile_rules)
+    logger.info("Completed Processing Emails")
@@ -0,0 +1,52 @@
+import threading
+import time
+
+# Gmail allows 250 quota units per user per second; messages.get costs 5 units
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+MESSAGES_GET_QUOTA_UNITS = 5
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every worker that calls the Gmail API.
+
+    Tokens are quota units: they refill continuously at `rate` per second up to
+    `capacity`, and acquire() blocks until enough are available.
+    """
+
+    def __init__(self, rate=GMAIL_QUOTA_UNITS_PER_SECOND, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, waiting until they are available.
+
+        Requests larger than the capacity are allowed and leave the bucket in debt,
+        so a full HTTP batch is never blocked forever.
+
+        Args:
+            tokens (float): Quota units the next request costs.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= min(tokens, self.capacity):
+                    self.tokens -= tokens
+                    return waited
+                delay = (min(tokens, self.capacity) - self.tokens) / self.rate
+            self.sleep(delay)
+            waited += delay
@@ -0,0 +1,519 @@
+import json
+import time
+import hashlib
+import datetime
+from collections import namedtuple
+from psycopg2 import sql
+from database import EMAIL_COLUMNS
+from aho_corasick import build_substring_matcher, AHO_CORASICK_MIN_PATTERNS
+
+RULES_FILE = 'action_rules/rules.json'
+
+# Columns every processed row starts with
+KEY_COLUMNS = ('id', 'emailid')
+
+TEXT_FIELDS = ('subject', 'sender', 'receiver', 'message')
+RULE_DATE_FORMAT = '%Y-%m-%d'
+
+CompiledRule = namedtuple('CompiledRule', ['name', 'matches', 'actions', 'fields'])
+
+def load_rules(path=RULES_FILE):
+    """
+    Load the raw rule definitions from a JSON file.
+
+    Args:
+        path (str): Path to the rules file.
+
+    Returns:
+        list: Rule definitions as stored in the file.
+    """
+    with open(path, 'r') as rules_file:
+        return json.load(rules_file)
+
+def to_datetime(value):
+    """
+    Convert a stored email date to a timezone-aware datetime.
+
+    Args:
+        value (datetime.datetime or str): Date as returned by the database or a test fixture;
+            naive values are taken as UTC.
+
+    Returns:
+        datetime.datetime: Aware email date.
+    """
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.fromisoformat(str(value))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+def parse_rule_date(value):
+    """
+    Parse the date of a rule condition as midnight UTC.
+
+    Args:
+        value (str): Date in RULE_DATE_FORMAT.
+
+    Returns:
+        datetime.datetime: Aware rule date.
+    """
+    return datetime.datetime.strptime(value, RULE_DATE_FORMAT).replace(tzinfo=datetime.timezone.utc)
+
+def compile_condition(condition, columns=EMAIL_COLUMNS):
+    """
+    Compile a rule condition into a predicate over an email row.
+
+    The field name is resolved to a column index and date values are parsed once
+    here, so the returned predicate only does the comparison.
+
+    Args:
+        condition (dict): Condition with 'field', 'predicate' and 'value' keys.
+        columns (tuple): Column layout of the rows the predicate will receive.
+
+    Returns:
+        function: Predicate taking an email row and returning a bool.
+
+    Raises:
+        ValueError: If the field or predicate is not supported.
+    """
+    field = condition["field"]
+    predicate = condition["predicate"]
+    value = condition["value"]
+
+    if field not in columns or (field not in TEXT_FIELDS and field != "date"):
+        raise ValueError(f"Unsupported rule field: {field}")
+    index = columns.index(field)
+
+    if field == "date":
+        rule_date = parse_rule_date(value)
+        if predicate == "greater than":
+            return lambda email_data: to_datetime(email_data[index]) > rule_date
+        if predicate == "lesser than":
+            return lambda email_data: to_datetime(email_data[index]) < rule_date
+    else:
+        if predicate == "contains":
+            return lambda email_data: value in email_data[index]
+        if predicate == "does not contain":
+            return lambda email_data: value not in email_data[index]
+    raise ValueError(f"Unsupported predicate '{predicate}' for field '{field}'")
+
+def compile_rule(rule_name, rule_data, columns=EMAIL_COLUMNS):
+    """
+    Compile one rule definition.
+
+    Args:
+        rule_name (str): Name of the rule.
+        rule_data (dict): Rule definition from the rules file.
+        columns (tuple): Column layout of the rows the rule will be evaluated against.
+
+    Returns:
+        CompiledRule: Compiled rule, or None if the rule is inactive.
+
+    Raises:
+        ValueError: If the rule uses an unsupported collective predicate or condition.
+    """
+    if rule_data.get('active') != 1:
+        return None
+
+    conditions = tuple(compile_condition(condition, columns) for condition in rule_data.get("conditions", []))
+    collective_predicate = rule_data.get('collective_predicate')
+
+    if collective_predicate == "All":
+        def matches(email_data):
+            for condition in conditions:
+                if not condition(email_data):
+                    return False
+            return True
+    elif collective_predicate == "Any":
+        def matches(email_data):
+            for condition in conditions:
+                if condition(email_data):
+                    return True
+            return False
+    else:
+        raise ValueError(f"Unsupported collective predicate '{collective_predicate}' in rule '{rule_name}'")
+
+    fields = frozenset(condition["field"] for condition in rule_data.get("conditions", []))
+    return CompiledRule(rule_name, matches, rule_data["actions"], fields)
+
+def compile_rules(rules_data, columns=EMAIL_COLUMNS):
+    """
+    Compile every active rule, keeping the order of the rules file.
+
+    Args:
+        rules_data (list): Rule definitions as loaded from the rules file.
+        columns (tuple): Column layout of the rows the rules will be evaluated against.
+
+    Returns:
+        list: CompiledRule for each active rule.
+    """
+    compiled_rules = []
+    for rule in rules_data:
+        for rule_name, rule_data in rule.items():
+            compiled_rule = compile_rule(rule_name, rule_data, columns)
+            if compiled_rule is not None:
+                compiled_rules.append(compiled_rule)
+    return compiled_rules
+
+def rule_columns(rules_data):
+    """
+    List the columns the active rules need, so rows can be loaded without unused fields.
+
+    Args:
+        rules_data (list): Rule definitions as loaded from the rules file.
+
+    Returns:
+        tuple: KEY_COLUMNS followed by every referenced field, in table order.
+    """
+    referenced = set()
+    for rule in rules_data:
+        for rule_data in rule.values():
+            if rule_data.get('active') == 1:
+                referenced.update(condition["field"] for condition in rule_data.get("conditions", []))
+    return KEY_COLUMNS + tuple(column for column in EMAIL_COLUMNS if column in referenced and column not in KEY_COLUMNS)
+
+def ruleset_hash(rules_data):
+    """
+    Hash the active rules, so results evaluated against another version of the rules can be told apart.
+
+    Rule order is part of the hash because later rules win when actions conflict.
+
+    Args:
+        rules_data (list): Rule definitions as loaded from the rules file.
+
+    Returns:
+        str: Hex SHA-256 digest of the active rules.
+    """
+    active_rules = [
+        [rule_name, rule_data]
+        for rule in rules_data
+        for rule_name, rule_data in rule.items()
+        if rule_data.get('active') == 1
+    ]
+    return hashlib.sha256(json.dumps(active_rules, sort_keys=True).encode('utf-8')).hexdigest()
+
+def rule_version(rule_name, rule_data):
+    """
+    Hash one rule definition, so a changed rule can be told apart from an unchanged one.
+
+    Args:
+        rule_name (str): Name of the rule.
+        rule_data (dict): Rule definition from the rules file.
+
+    Returns:
+        str: Hex SHA-256 digest of the rule.
+    """
+    return hashlib.sha256(json.dumps([rule_name, rule_data], sort_keys=True).encode('utf-8')).hexdigest()
+
+def rule_versions(rules_data):
+    """
+    Version every active rule.
+
+    Args:
+        rules_data (list): Rule definitions as loaded from the rules file.
+
+    Returns:
+        dict: Version of each active rule keyed by rule name, in rule order.
+    """
+    return {
+        rule_name: rule_version(rule_name, rule_data)
+        for rule in rules_data
+        for rule_name, rule_data in rule.items()
+        if rule_data.get('active') == 1
+    }
+
+def changed_rule_names(previous_versions, current_versions):
+    """
+    List the active rules that are new or changed since a previous version of the rules.
+
+    Rules that were removed or deactivated are not listed: the labels they applied
+    stay in place. Rules kept unchanged must also keep their relative order, since
+    later rules win when actions conflict; otherwise every rule is affected.
+
+    Args:
+        previous_versions (dict): Rule versions keyed by name, in rule order, as returned by rule_versions.
+        current_versions (dict): Rule versions of the current rules.
+
+    Returns:
+        list: Names of the new or changed rules, in rule order, or None if the order of the unchanged rules differs.
+    """
+    unchanged = [rule_name for rule_name, version in current_versions.items() if previous_versions.get(rule_name) == version]
+    previous_order = [rule_name for rule_name in previous_versions if rule_name in current_versions]
+    if unchanged != [rule_name for rule_name in previous_order if rule_name in unchanged]:
+        return None
+    return [rule_name for rule_name in current_versions if rule_name not in unchanged]
+
+def validate_rules(rules_data):
+    """
+    Check that rule definitions can be compiled and evaluated, without keeping the result.
+
+    Args:
+        rules_data (list): Rule definitions as loaded from the rules file.
+
+    Raises:
+        ValueError: If the definitions are malformed, a rule name is repeated or an
+            active rule uses an unsupported field, predicate or collective predicate.
+    """
+    if not isinstance(rules_data, list):
+        raise ValueError('The rules file must hold a list of rules')
+    seen_names = set()
+    for rule in rules_data:
+        if not isinstance(rule, dict):
+            raise ValueError(f"Expected a rule name mapped to its definition, got {rule!r}")
+        for rule_name, rule_data in rule.items():
+            if rule_name in seen_names:
+                raise ValueError(f"Rule '{rule_name}' is defined more than once")
+            seen_names.add(rule_name)
+            if not isinstance(rule_data, dict) or rule_data.get('active') != 1:
+                continue
+            try:
+                if 'mark_as_read' not in rule_data['actions']:
+                    raise ValueError(f"Rule '{rule_name}' does not say whether to mark emails as read")
+                compile_rule(rule_name, rule_data)
+            except (KeyError, TypeError) as e:
+                raise ValueError(f"Rule '{rule_name}' is malformed: {e!r}") from e
+
+def escape_like(value):
+    """
+    Escape LIKE wildcards so a value is matched literally.
+
+    Args:
+        value (str): Text to search for.
+
+    Returns:
+        str: LIKE pattern matching any text that contains value.
+    """
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+def condition_to_sql(condition):
+    """
+    Translate a rule condition into a parameterized SQL expression.
+
+    'contains' becomes a case-sensitive LIKE, matching the Python predicate exactly
+    and served by the pg_trgm indexes; date predicates become range comparisons.
+
+    Args:
+        condition (dict): Condition with 'field', 'predicate' and 'value' keys.
+
+    Returns:
+        tuple: (psycopg2.sql.Composable, list of parameters).
+
+    Raises:
+        ValueError: If the field or predicate is not supported.
+    """
+    field = condition["field"]
+    predicate = condition["predicate"]
+    value = condition["value"]
+    column = sql.Identifier(field)
+
+    if field == "date":
+        rule_date = parse_rule_date(value)
+        if predicate == "greater than":
+            return sql.SQL('{} > %s').format(column), [rule_date]
+        if predicate == "lesser than":
+            return sql.SQL('{} < %s').format(column), [rule_date]
+    elif field in TEXT_FIELDS:
+        if predicate == "contains":
+            return sql.SQL('{} LIKE %s').format(column), [escape_like(value)]
+        if predicate == "does not contain":
+            return sql.SQL('{} NOT LIKE %s').format(column), [escape_like(value)]
+    else:
+        raise ValueError(f"Unsupported rule field: {field}")
+    raise ValueError(f"Unsupported predicate '{predicate}' for field '{field}'")
+
+def rule_to_sql(rule_name, rule_data):
+    """
+    Translate a rule into a WHERE clause selecting the emails it matches.
+
+    Args:
+        rule_name (str): Name of the rule.
+        rule_data (dict): Rule definition from the rules file.
+
+    Returns:
+        tuple: (psycopg2.sql.Composable, list of parameters).
+
+    Raises:
+        ValueError: If the rule uses an unsupported collective predicate or condition.
+    """
+    collective_predicate = rule_data.get('collective_predicate')
+    if collective_predicate == "All":
+        joiner, empty = sql.SQL(' AND '), sql.SQL('TRUE')
+    elif collective_predicate == "Any":
+        joiner, empty = sql.SQL(' OR '), sql.SQL('FALSE')
+    else:
+        raise ValueError(f"Unsupported collective predicate '{collective_predicate}' in rule '{rule_name}'")
+
+    clauses = []
+    params = []
+    for condition in rule_data.get("conditions", []):
+        clause, condition_params = condition_to_sql(condition)
+        clauses.append(clause)
+        params.extend(condition_params)
+    if not clauses:
+        return empty, params
+    return sql.SQL('({})').format(joiner.join(clauses)), params
+
+def rules_to_sql(rules_data):
+    """
+    Translate every active rule into one WHERE clause matching the emails any of them could act on.
+
+    Args:
+        rules_data (list): Rule definitions as loaded from the rules file.
+
+    Returns:
+        tuple: (psycopg2.sql.Composable, list of parameters), or None if no rule is active.
+    """
+    clauses = []
+    params = []
+    for rule in rules_data:
+        for rule_name, rule_data in rule.items():
+            if rule_data.get('active') != 1:
+                continue
+            clause, rule_params = rule_to_sql(rule_name, rule_data)
+            clauses.append(clause)
+            params.extend(rule_params)
+    if not clauses:
+        return None
+    return sql.SQL(' OR ').join(clauses), params
+
+class RuleIndex:
+    """
+    Evaluate many rules against an email by scanning each text field once.
+
+    Every 'contains' / 'does not contain' value is collected per field into one
+    multi-pattern matcher. Matching an email scans each field once, giving the set
+    of values present, and rules are decided from that set. An inverted index from
+    value to rule skips rules that cannot match: an All rule needs its anchor value
+    present, and an Any rule made only of 'contains' conditions needs one of its values.
+    """
+
+    def __init__(self, rules_data, columns=EMAIL_COLUMNS, min_automaton_patterns=AHO_CORASICK_MIN_PATTERNS):
+        self.rules = compile_rules(rules_data, columns)
+        pattern_ids = {}
+        field_patterns = {}
+        self.rule_checks = []
+        self.always_checked = []
+        rules_by_pattern = {}
+
+        def pattern_id(field, value):
+            key = (field, value)
+            if key not in pattern_ids:
+                pattern_ids[key] = len(pattern_ids)
+                field_patterns.setdefault(field, []).append((value, pattern_ids[key]))
+            return pattern_ids[key]
+
+        active_rules = [
+            rule_data for rule in rules_data for rule_data in rule.values() if rule_data.get('active') == 1
+        ]
+        for position, rule_data in enumerate(active_rules):
+            contains, not_contains, date_checks = set(), set(), []
+            for condition in rule_data.get("conditions", []):
+                if condition["field"] == "date":
+                    date_checks.append(compile_condition(condition, columns))
+                elif condition["predicate"] == "contains":
+                    contains.add(pattern_id(condition["field"], condition["value"]))
+                else:
+                    not_contains.add(pattern_id(condition["field"], condition["value"]))
+            is_all = rule_data['collective_predicate'] == "All"
+            self.rule_checks.append((is_all, frozenset(contains), frozenset(not_contains), tuple(date_checks)))
+
+            if is_all and contains:
+                rules_by_pattern.setdefault(min(contains), []).append(position)
+            elif not is_all and contains and not not_contains and not date_checks:
+                for contained in contains:
+                    rules_by_pattern.setdefault(contained, []).append(position)
+            else:
+                self.always_checked.append(position)
+
+        self.rules_by_pattern = rules_by_pattern
+        self.rule_check_histogram = None
+        self.field_matchers = []
+        for field, patterns in field_patterns.items():
+            global_ids = [global_id for _, global_id in patterns]
+            matcher = build_substring_matcher([value for value, _ in patterns], min_automaton_patterns)
+            self.field_matchers.append((columns.index(field), matcher, global_ids))
+
+    def found_patterns(self, email_data):
+        """
+        Scan each indexed field of an email once.
+
+        Returns:
+            set: IDs of the condition values present in the email.
+        """
+        found = set()
+        for index, matcher, global_ids in self.field_matchers:
+            found.update(global_ids[local_id] for local_id in matcher(email_data[index]))
+        return found
+
+    def matching_positions(self, email_data):
+        """
+        Find the rules an email matches.
+
+        Args:
+            email_data (tuple): Email row in the column layout the index was built for.
+
+        Returns:
+            list: Positions in self.rules of the matching rules, in rule order.
+        """
+        found = self.found_patterns(email_data)
+        candidates = set(self.always_checked)
+        for pattern in found:
+            candidates.update(self.rules_by_pattern.get(pattern, ()))
+
+        if self.rule_check_histogram is not None:
+            return self._profiled_positions(sorted(candidates), found, email_data)
+
+        # Same test as _rule_matches, inlined: this loop runs for every candidate rule of every email
+        matching = []
+        for position in sorted(candidates):
+            is_all, contains, not_contains, date_checks = self.rule_checks[position]
+            if is_all:
+                if (contains <= found and found.isdisjoint(not_contains)
+                        and all(check(email_data) for check in date_checks)):
+                    matching.append(position)
+            elif (not found.isdisjoint(contains) or not not_contains <= found
+                    or any(check(email_data) for check in date_checks)):
+                matching.append(position)
+        return matching
+
+    def _rule_matches(self, position, found, email_data):
+        is_all, contains, not_contains, date_checks = self.rule_checks[position]
+        if is_all:
+            return (contains <= found and found.isdisjoint(not_contains)
+                    and all(check(email_data) for check in date_checks))
+        return (not found.isdisjoint(contains) or not not_contains <= found
+                or any(check(email_data) for check in date_checks))
+
+    def _profiled_positions(self, candidates, found, email_data):
+        matching = []
+        for position in candidates:
+            started_at = time.perf_counter()
+            matched = self._rule_matches(position, found, email_data)
+            self.rule_check_histogram.observe(time.perf_counter() - started_at, rule=self.rules[position].name)
+            if matched:
+                matching.append(position)
+        return matching
+
+    def profile_rule_checks(self, histogram):
+        """
+        Record the time each rule check takes from now on, labelled by rule name.
+
+        The single scan of the text fields is shared by every rule and is not
+        attributed to any of them. Rules skipped through the inverted index cost
+        nothing and record nothing. Off by default, since timing a check costs
+        about as much as the check.
+
+        Args:
+            histogram (metrics.Histogram): Histogram with a 'rule' label, or None to stop profiling.
+        """
+        self.rule_check_histogram = histogram
+
+    def matching_rules(self, email_data):
+        """
+        Find the rules an email matches.
+
+        Returns:
+            list: Matching CompiledRule objects, in rule order.
+        """
+        return [self.rules[position] for position in self.matching_positions(email_data)]
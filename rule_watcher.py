@@ -0,0 +1,89 @@
+import os
+import logging
+from collections import namedtuple
+from database import EMAIL_COLUMNS
+from rule_engine import RULES_FILE, load_rules, validate_rules, ruleset_hash, rule_versions, RuleIndex
+
+# One loaded version of the rules file; replaced as a whole, never modified
+RuleSet = namedtuple('RuleSet', ['rules_data', 'rule_index', 'ruleset_hash', 'rule_versions'])
+
+logger = logging.getLogger(__name__)
+
+def load_ruleset(path=RULES_FILE, columns=EMAIL_COLUMNS):
+    """
+    Load, validate and compile a rules file.
+
+    Args:
+        path (str): Path to the rules file.
+        columns (tuple): Column layout of the rows the rules will be evaluated against.
+
+    Returns:
+        RuleSet: The compiled rules with their hashes.
+
+    Raises:
+        OSError: If the file cannot be read.
+        ValueError: If the file is not valid JSON or the rules are invalid.
+    """
+    rules_data = load_rules(path)
+    validate_rules(rules_data)
+    return RuleSet(rules_data, RuleIndex(rules_data, columns), ruleset_hash(rules_data), rule_versions(rules_data))
+
+class RuleWatcher:
+    """
+    Keep the compiled rules in step with the rules file.
+
+    The file is checked by size and modification time, and reloaded only when
+    either changes. A new version is loaded, validated and compiled completely
+    before it replaces the current RuleSet in one assignment, so readers see the
+    old rules or the new ones, never a mix. An invalid file is logged and the
+    current rules stay in use until the file is fixed.
+    """
+
+    def __init__(self, path=RULES_FILE, columns=EMAIL_COLUMNS, on_change=None):
+        """
+        Load the rules file for the first time.
+
+        Args:
+            path (str): Path to the rules file.
+            columns (tuple): Column layout of the rows the rules will be evaluated against.
+            on_change (function): Called with the previous and the new RuleSet after each reload.
+
+        Raises:
+            OSError, ValueError: If the rules file cannot be loaded.
+        """
+        self.path = path
+        self.columns = columns
+        self.on_change = on_change
+        self.file_signature = self.current_signature()
+        self.ruleset = load_ruleset(path, columns)
+
+    def current_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def check(self):
+        """
+        Reload the rules if the file changed since the last check.
+
+        Returns:
+            bool: True if new rules replaced the current ones.
+        """
+        signature = self.current_signature()
+        if signature == self.file_signature:
+            return False
+        self.file_signature = signature
+        try:
+            ruleset = load_ruleset(self.path, self.columns)
+        except (OSError, ValueError) as e:
+            logger.error("Keeping the current rules, %s could not be loaded: %s", self.path, e)
+            return False
+        if ruleset.ruleset_hash == self.ruleset.ruleset_hash:
+            return False
+        previous, self.ruleset = self.ruleset, ruleset
+        logger.info("Reloaded rules from %s, %d active", self.path, len(ruleset.rule_versions))
+        if self.on_change is not None:
+            self.on_change(previous, ruleset)
+        return True
@@ -0,0 +1,33 @@
+import random
+import unittest
+from aho_corasick import AhoCorasick, build_substring_matcher
+
+class TestAhoCorasick(unittest.TestCase):
+
+    def test_search_finds_overlapping_patterns(self):
+        automaton = AhoCorasick(['he', 'she', 'his', 'hers', 'e'])
+        self.assertEqual(automaton.search('ushers'), {0, 1, 3, 4})
+        self.assertEqual(automaton.search('xyz'), set())
+
+    def test_search_empty_pattern_always_matches(self):
+        self.assertEqual(AhoCorasick(['', 'a']).search(''), {0})
+
+    def test_search_matches_brute_force(self):
+        rng = random.Random(7)
+        patterns = list({''.join(rng.choice('abc') for _ in range(rng.randint(1, 5))) for _ in range(60)})
+        automaton = AhoCorasick(patterns)
+        for _ in range(200):
+            text = ''.join(rng.choice('abcd') for _ in range(rng.randint(0, 40)))
+            expected = {pattern_id for pattern_id, pattern in enumerate(patterns) if pattern in text}
+            self.assertEqual(automaton.search(text), expected)
+
+    def test_build_substring_matcher_small_and_large_sets_agree(self):
+        patterns = ['café', 'sale', 'ale', 'no-reply@']
+        text = 'Café sale from no-reply@shop'
+        naive = build_substring_matcher(patterns, min_automaton_patterns=100)
+        automaton = build_substring_matcher(patterns, min_automaton_patterns=1)
+        self.assertEqual(naive(text), {1, 2, 3})
+        self.assertEqual(automaton(text), {1, 2, 3})
+
+if __name__ == '__main__':
+    unittest.main()
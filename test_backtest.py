@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from datetime import datetime, timezone
+from rule_engine import RuleIndex
+from backtest import SNAPSHOT_COLUMNS, write_snapshot, EmailSnapshot, backtest_rules, load_snapshot
+
+ROWS = [
+    (None, 'alerts@hdfcbank.net', 'me@gmail.com', 'Statement', None),
+    (datetime(2023, 12, 1, tzinfo=timezone.utc), 'no-reply@swiggy.in', 'me@gmail.com', 'Your order', "Don't want these emails?"),
+    (datetime(2023, 12, 18, tzinfo=timezone.utc), 'priya@gmail.com', 'me@gmail.com', 'Lunch', 'café at noon'),
+    (datetime(2023, 12, 18, 9, 0, tzinfo=timezone.utc), 'no-reply@swiggy.in', 'me@gmail.com', 'Offer', "Don't"),
+    (datetime(2023, 12, 20, tzinfo=timezone.utc), 'no-reply@swiggy.in', 'team@gmail.com', 'Your order', " want this"),
+]
+
+RULES = [
+    {'swiggy': {'collective_predicate': 'All', 'active': 1, 'actions': {'mark_as_read': True}, 'conditions': [
+        {'field': 'sender', 'predicate': 'contains', 'value': 'swiggy'},
+        {'field': 'message', 'predicate': 'contains', 'value': "Don't"},
+        {'field': 'date', 'predicate': 'greater than', 'value': '2023-12-18'},
+    ]}},
+    {'personal': {'collective_predicate': 'Any', 'active': 1, 'actions': {'mark_as_read': False}, 'conditions': [
+        {'field': 'message', 'predicate': 'contains', 'value': 'café'},
+        {'field': 'subject', 'predicate': 'does not contain', 'value': 'order'},
+        {'field': 'date', 'predicate': 'lesser than', 'value': '2023-12-18'},
+    ]}},
+    {'draft': {'collective_predicate': 'All', 'active': 0, 'actions': {'mark_as_read': True}, 'conditions': []}},
+]
+
+class TestBacktest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'snapshot')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_counts_match_row_by_row_evaluation(self):
+        write_snapshot(self.path, ROWS, [1, 5])
+        snapshot = EmailSnapshot(self.path)
+        try:
+            report = backtest_rules(snapshot, RULES)
+        finally:
+            snapshot.close()
+
+        # Rows with a date and text can be checked one at a time by the rule engine
+        rule_index = RuleIndex(RULES, SNAPSHOT_COLUMNS)
+        expected = [0, 0]
+        for row in ROWS[1:]:
+            for position in rule_index.matching_positions(row):
+                expected[position] += 1
+        # The statement without a date or message still matches 'personal' by its subject
+        expected[1] += 1
+        self.assertEqual([rule['matches'] for rule in report['rules']], expected)
+        self.assertEqual([rule['rule'] for rule in report['rules']], ['swiggy', 'personal'])
+        self.assertEqual([condition['matches'] for condition in report['rules'][0]['conditions']], [3, 2, 2])
+        self.assertEqual([condition['matches'] for condition in report['rules'][1]['conditions']], [1, 3, 1])
+        self.assertEqual((report['emails'], report['matched']), (5, 4))
+
+    def test_write_snapshot_rejects_unsorted_rows(self):
+        with self.assertRaises(ValueError):
+            write_snapshot(self.path, [ROWS[2], ROWS[1]])
+        with self.assertRaises(ValueError):
+            write_snapshot(self.path, [ROWS[1], ROWS[0]])
+
+    @patch('backtest.stream_emails')
+    @patch('backtest.email_table_version')
+    def test_snapshot_is_reused_until_stored_emails_change(self, mock_email_table_version, mock_stream_emails):
+        mock_email_table_version.return_value = [1, 5, 5, 3]
+        mock_stream_emails.side_effect = lambda *args, **kwargs: iter(ROWS)
+
+        for _ in range(2):
+            load_snapshot(self.path).close()
+        # Same id bounds and row count, but an email was updated in place
+        mock_email_table_version.return_value = [1, 5, 5, 4]
+        snapshot = load_snapshot(self.path)
+        snapshot.close()
+
+        self.assertEqual(mock_stream_emails.call_count, 2)
+        self.assertEqual(mock_stream_emails.call_args.args[0], SNAPSHOT_COLUMNS)
+        self.assertEqual(snapshot.source, [1, 5, 5, 4])
+
+if __name__ == '__main__':
+    unittest.main()
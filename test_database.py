@@ -1,10 +1,16 @@
 import unittest
 from unittest.mock import patch, MagicMock
-from datetime import datetime
-from database import connect, create_email_table, insert_email, fetch_all_emails
+from datetime import datetime, timezone
+from psycopg2 import sql
+import database
+from database import connect, create_email_table, insert_email, insert_emails, fetch_all_emails, pooled_connection, close_pool, get_sync_state, save_sync_state, stream_emails, email_id_bounds, mark_emails_processed, advance_processed_emails, unprocessed_email_filter, months_between, ensure_partitions, email_table_version, detach_partitions_before, search_emails
 
 class TestDatabase(unittest.TestCase):
 
+    def tearDown(self):
+        close_pool()
+        database.partition_cache['months'].clear()
+
     @patch('psycopg2.connect')
     def test_connect(self, mock_connect):
         mock_connection = MagicMock()
@@ -29,7 +35,59 @@ class TestDatabase(unittest.TestCase):
         mock_connection.commit.assert_called_once()
 
     @patch('psycopg2.connect')
-    def test_insert_email(self, mock_connect):
+    def test_create_email_table_creates_partitioned_table(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = None
+
+        create_email_table()
+
+        statements = [repr(call.args[0]) for call in mock_cursor.execute.call_args_list]
+        self.assertTrue(any('PARTITION BY RANGE (date)' in statement and 'search_vector' in statement for statement in statements))
+        self.assertTrue(any('PARTITION OF email_details DEFAULT' in statement for statement in statements))
+        self.assertTrue(any('USING GIN (search_vector)' in statement for statement in statements))
+        self.assertFalse(any('RENAME' in statement for statement in statements))
+
+    @patch('psycopg2.connect')
+    def test_create_email_table_migrates_plain_table_to_partitions(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.side_effect = [('r',), ('timestamp with time zone',), (3,), (False, False, 0), (False, False, 0)]
+        # Constraints, indexes, then the months holding mail: November and January, not December
+        mock_cursor.fetchall.side_effect = [[], [], [(datetime(2023, 11, 1),), (datetime(2024, 1, 1),)]]
+        mock_cursor.rowcount = 2
+
+        create_email_table()
+
+        statements = [repr(call.args[0]) for call in mock_cursor.execute.call_args_list]
+        position = lambda text: next(i for i, statement in enumerate(statements) if text in statement)
+        self.assertLess(position('RENAME TO email_details_unpartitioned'), position('PARTITION BY RANGE'))
+        for partition in ('email_details_y2023m11', 'email_details_y2024m01'):
+            self.assertLess(position(partition), position('DISTINCT ON (emailid)'))
+        self.assertFalse(any('email_details_y2023m12' in statement for statement in statements))
+        self.assertLess(position('DISTINCT ON (emailid)'), position('DROP TABLE email_details_unpartitioned'))
+        mock_connection.commit.assert_called_once()
+
+    @patch('psycopg2.connect')
+    def test_create_email_table_skips_migration_when_partitioned(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = ('p',)
+
+        create_email_table()
+
+        statements = [repr(call.args[0]) for call in mock_cursor.execute.call_args_list]
+        self.assertFalse(any('RENAME' in statement or 'CREATE TABLE' in statement and 'sync_state' not in statement for statement in statements))
+
+    @patch('database.ensure_partitions')
+    @patch('psycopg2.connect')
+    def test_insert_email(self, mock_connect, mock_ensure_partitions):
         mock_connection = MagicMock()
         mock_cursor = MagicMock()
         mock_connect.return_value = mock_connection
@@ -39,5 +97,320 @@ class TestDatabase(unittest.TestCase):
 
         mock_connection.commit.assert_called_once()
 
+    @patch('psycopg2.connect')
+    def test_pooled_connection_reuses_connection(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_connection.closed = False
+        mock_connect.return_value = mock_connection
+
+        with pooled_connection() as first:
+            pass
+        with pooled_connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        mock_connect.assert_called_once_with(
+            host='localhost', database='postgres', user='sanjeev', password='sanjeevemail'
+        )
+        mock_connection.close.assert_not_called()
+
+    @patch('psycopg2.connect')
+    def test_create_email_table_converts_naive_dates(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.side_effect = [('r',), ('timestamp without time zone',), (0,)]
+        mock_cursor.fetchall.return_value = []
+        mock_cursor.rowcount = 0
+
+        create_email_table()
+
+        statements = [str(call.args[0]) for call in mock_cursor.execute.call_args_list]
+        self.assertTrue(any('TYPE TIMESTAMPTZ' in statement for statement in statements))
+
+    @patch('database.ensure_partitions')
+    @patch('database.psycopg2.extras.execute_values')
+    @patch('psycopg2.connect')
+    def test_insert_emails(self, mock_connect, mock_execute_values, mock_ensure_partitions):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        rows = [
+            ('123', 'subject1', 'sender1', 'receiver1', '2023-12-20 12:30:00', 'message1'),
+            ('456', 'subject2', 'sender2', 'receiver2', '2023-12-21 12:30:00', 'message2'),
+        ]
+
+        inserted = insert_emails(rows, batch_size=50)
+
+        self.assertEqual(inserted, 2)
+        self.assertEqual(mock_execute_values.call_count, 2)
+        self.assertEqual(mock_execute_values.call_args.args[2], rows)
+        self.assertEqual(mock_execute_values.call_args.kwargs['page_size'], 50)
+        self.assertIn('ON CONFLICT (emailid, date)', repr(mock_execute_values.call_args.args[1]))
+        self.assertEqual(list(mock_ensure_partitions.call_args.args[0]), ['2023-12-20 12:30:00', '2023-12-21 12:30:00'])
+        mock_connection.commit.assert_called_once()
+
+    @patch('database.ensure_partitions')
+    @patch('database.psycopg2.extras.execute_values')
+    @patch('psycopg2.connect')
+    def test_insert_emails_moves_refetched_email_with_a_different_date(self, mock_connect, mock_execute_values, mock_ensure_partitions):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        # Migrated from TIMESTAMP as 10:00+00, parsed again from 'Mon, 18 Dec 2023 10:00:00 +0530'
+        refetched_date = datetime(2023, 12, 18, 4, 30, tzinfo=timezone.utc)
+        rows = [('123', 'subject1', 'sender1', 'receiver1', refetched_date, 'message1')]
+
+        insert_emails(rows)
+
+        move, upsert = mock_execute_values.call_args_list
+        self.assertIn('UPDATE email_details', move.args[1])
+        self.assertIn('stored.date IS DISTINCT FROM incoming.date', move.args[1])
+        self.assertEqual(move.args[2], [('123', refetched_date)])
+        self.assertIn('ON CONFLICT (emailid, date)', repr(upsert.args[1]))
+        self.assertEqual(upsert.args[2], rows)
+        mock_connection.commit.assert_called_once()
+
+    @patch('database.ensure_partitions')
+    @patch('database.psycopg2.extras.execute_values')
+    @patch('psycopg2.connect')
+    def test_insert_emails_counts_the_write(self, mock_connect, mock_execute_values, mock_ensure_partitions):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+
+        insert_emails([('123', 'subject1', 'sender1', 'receiver1', '2023-12-20 12:30:00', 'message1')])
+
+        statement, params = mock_cursor.execute.call_args.args
+        self.assertIn('sync_state.value::bigint + 1', statement)
+        self.assertEqual(params, ('email_details_changes',))
+        mock_connection.commit.assert_called_once()
+
+    @patch('psycopg2.connect')
+    def test_email_table_version(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = (1, 9, 7, 12)
+
+        self.assertEqual(email_table_version(), [1, 9, 7, 12])
+        statement = mock_cursor.execute.call_args.args[0]
+        self.assertIn('count(*)', statement)
+        self.assertIn('FROM sync_state', statement)
+
+    @patch('database.ensure_partitions')
+    @patch('database.psycopg2.extras.execute_values')
+    @patch('psycopg2.connect')
+    def test_insert_emails_keeps_last_copy_of_duplicates(self, mock_connect, mock_execute_values, mock_ensure_partitions):
+        mock_connect.return_value = MagicMock()
+        rows = [
+            ('123', 'old', 'sender1', 'receiver1', '2023-12-20 12:30:00', 'message1'),
+            ('456', 'subject2', 'sender2', 'receiver2', '2023-12-21 12:30:00', 'message2'),
+            ('123', 'new', 'sender1', 'receiver1', '2023-12-20 12:30:00', 'message1'),
+        ]
+
+        self.assertEqual(insert_emails(rows), 2)
+        self.assertEqual(mock_execute_values.call_args.args[2], [rows[2], rows[1]])
+
+    @patch('database.psycopg2.extras.execute_values')
+    @patch('psycopg2.connect')
+    def test_insert_emails_empty(self, mock_connect, mock_execute_values):
+        self.assertEqual(insert_emails([]), 0)
+        mock_connect.assert_not_called()
+        mock_execute_values.assert_not_called()
+
+    @patch('psycopg2.connect')
+    def test_sync_state_round_trip(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = ('12345',)
+
+        save_sync_state('gmail_history_id:INBOX', 12345)
+        self.assertEqual(get_sync_state('gmail_history_id:INBOX'), '12345')
+
+        self.assertEqual(mock_cursor.execute.call_args_list[0].args[1], ('gmail_history_id:INBOX', '12345'))
+        mock_connection.commit.assert_called_once()
+
+        mock_cursor.fetchone.return_value = None
+        self.assertIsNone(get_sync_state('unknown'))
+
+    @patch('psycopg2.connect')
+    def test_stream_emails_uses_server_side_cursor(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.__iter__.return_value = iter([(1, 'email1'), (2, 'email2')])
+
+        rows = stream_emails(('id', 'emailid'), itersize=50)
+
+        mock_connect.assert_not_called()
+        self.assertEqual(list(rows), [(1, 'email1'), (2, 'email2')])
+        mock_connection.cursor.assert_called_once_with(name='stream_emails')
+        self.assertEqual(mock_cursor.itersize, 50)
+        mock_connection.rollback.assert_called_once()
+
+    @patch('psycopg2.connect')
+    def test_stream_emails_restricts_id_range(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.__iter__.return_value = iter([])
+
+        list(stream_emails(('id',), sql.SQL('subject LIKE %s'), ['%a%'], id_range=(10, 20)))
+
+        query, params = mock_cursor.execute.call_args.args
+        self.assertIn('id >= %s AND id < %s', repr(query))
+        self.assertEqual(params, ['%a%', 10, 20])
+
+    @patch('psycopg2.connect')
+    def test_email_id_bounds(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = (3, 42)
+
+        self.assertEqual(email_id_bounds(), (3, 42))
+        self.assertIn('min(id), max(id)', mock_cursor.execute.call_args.args[0].string)
+
+    @patch('database.psycopg2.extras.execute_values')
+    @patch('psycopg2.connect')
+    def test_mark_emails_processed(self, mock_connect, mock_execute_values):
+        mock_connection = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.closed = False
+
+        self.assertEqual(mark_emails_processed(['email1', 'email2', 'email1'], 'hash'), 2)
+        self.assertEqual(mark_emails_processed([], 'hash'), 0)
+
+        mock_execute_values.assert_called_once()
+        self.assertEqual(mock_execute_values.call_args.args[2], [('email1', 'hash'), ('email2', 'hash')])
+        mock_connection.commit.assert_called_once()
+
+    @patch('psycopg2.connect')
+    def test_advance_processed_emails(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.closed = False
+        mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
+        mock_cursor.rowcount = 40
+
+        self.assertEqual(advance_processed_emails('old', 'new', ['email1']), 40)
+
+        query, params = mock_cursor.execute.call_args.args
+        self.assertIn('UPDATE email_processing_state SET ruleset_hash = %s', query)
+        self.assertEqual(params, ('new', 'old', ['email1']))
+        mock_connection.commit.assert_called_once()
+
+    def test_unprocessed_email_filter(self):
+        clause, params = unprocessed_email_filter('hash')
+        self.assertIn('ruleset_hash = %s', clause.string)
+        self.assertEqual(params, ['hash'])
+
+    def test_months_between_crosses_years_in_utc(self):
+        first = datetime(2023, 11, 30, 23, 30, tzinfo=timezone.utc)
+        # 01:30 on Jan 1st at +05:30 is still December in UTC
+        last = datetime.fromisoformat('2024-01-01T01:30:00+05:30')
+
+        self.assertEqual(months_between(first, last), [
+            datetime(2023, 11, 1, tzinfo=timezone.utc), datetime(2023, 12, 1, tzinfo=timezone.utc)])
+
+    @patch('psycopg2.connect')
+    def test_ensure_partitions_creates_each_month_once(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = (False, False, 0)
+        dates = [datetime(2024, 1, 3, tzinfo=timezone.utc), datetime(2024, 1, 28, tzinfo=timezone.utc),
+                 datetime(2024, 2, 1, tzinfo=timezone.utc), None]
+
+        self.assertEqual(ensure_partitions(dates), ['email_details_y2024m01', 'email_details_y2024m02'])
+        self.assertEqual(ensure_partitions(dates), [])
+
+        self.assertEqual(mock_cursor.execute.call_args_list[0].args[1]['name'], 'email_details_y2024m01')
+        statement = repr(mock_cursor.execute.call_args_list[1].args[0])
+        self.assertIn("Identifier('email_details_y2024m01')", statement)
+        self.assertIn("'2024-01-01T00:00:00+00:00'", statement)
+        self.assertIn("'2024-02-01T00:00:00+00:00'", statement)
+        self.assertEqual(mock_cursor.execute.call_count, 4)
+
+    @patch('psycopg2.connect')
+    def test_ensure_partitions_skips_attached_partition(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = (True, True, 0)
+
+        self.assertEqual(ensure_partitions([datetime(2024, 1, 3, tzinfo=timezone.utc)]), ['email_details_y2024m01'])
+
+        self.assertEqual(mock_cursor.execute.call_count, 1)
+        self.assertIn('pg_inherits', repr(mock_cursor.execute.call_args.args[0]))
+
+    @patch('psycopg2.connect')
+    def test_ensure_partitions_archives_detached_table_and_moves_default_rows(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = (False, True, 2)
+
+        self.assertEqual(ensure_partitions([datetime(2024, 1, 3, tzinfo=timezone.utc)]), ['email_details_y2024m01'])
+
+        statements = [repr(call.args[0]) for call in mock_cursor.execute.call_args_list[1:]]
+        self.assertIn('RENAME TO', statements[0])
+        self.assertIn("Identifier('email_details_y2024m01_archived')", statements[0])
+        self.assertIn('DELETE FROM', statements[1])
+        self.assertIn('PARTITION OF email_details FOR VALUES', statements[2])
+        self.assertIn('FROM email_details_moved', statements[3])
+        self.assertIn('DROP TABLE email_details_moved', statements[4])
+        mock_connection.commit.assert_called_once()
+
+    @patch('psycopg2.connect')
+    def test_detach_partitions_before(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = [('email_details_y2024m02',), ('email_details_default',),
+                                             ('email_details_y2023m12',), ('email_details_y2024m01',)]
+
+        detached = detach_partitions_before(datetime(2024, 2, 1, tzinfo=timezone.utc))
+
+        self.assertEqual(detached, ['email_details_y2023m12_archived', 'email_details_y2024m01_archived'])
+        statements = [repr(call.args[0]) for call in mock_cursor.execute.call_args_list[1:]]
+        self.assertEqual(len(statements), 5)
+        self.assertTrue(all('DETACH PARTITION' in statement for statement in statements[0:4:2]))
+        self.assertIn('INSERT INTO sync_state', statements[4])
+        self.assertIn("Identifier('email_details_y2023m12_archived')", statements[1])
+
+    @patch('psycopg2.connect')
+    def test_search_emails(self, mock_connect):
+        mock_connection = MagicMock()
+        mock_cursor = MagicMock()
+        mock_connect.return_value = mock_connection
+        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = [(7, 'email7', 'Invoice', 'billing@example.com', None, 0.4)]
+        since = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+        results = search_emails('"overdue invoice" -paid', limit=5, since=since)
+
+        self.assertEqual(results, [(7, 'email7', 'Invoice', 'billing@example.com', None, 0.4)])
+        query, params = mock_cursor.execute.call_args.args
+        self.assertIn('search_vector @@ websearch_to_tsquery', repr(query))
+        self.assertIn('date >= %s', repr(query))
+        self.assertNotIn('date < %s', repr(query))
+        self.assertEqual(params, ['"overdue invoice" -paid', '"overdue invoice" -paid', since, 5])
+
 if __name__ == '__main__':
     unittest.main()
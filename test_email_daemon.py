@@ -0,0 +1,184 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+from googleapiclient.errors import HttpError
+from email_daemon import EmailDaemon, HistoryPollSource, parse_push_notification, IDLE
+from database import EMAIL_INSERT_COLUMNS
+from rule_engine import ruleset_hash, RuleIndex
+from rule_watcher import RuleSet
+from process_emails import get_rules_data, rules_cache
+from metrics import EMAILS_FAILED
+
+class FakeNotificationSource:
+    """
+    Notification source replaying a fixed list of historyIds, then stopping.
+    """
+
+    def __init__(self, history_ids):
+        self.history_ids = list(history_ids)
+        self.stopped = False
+
+    def next_notification(self):
+        if self.stopped or not self.history_ids:
+            return None
+        return self.history_ids.pop(0)
+
+    def stop(self):
+        self.stopped = True
+
+def _message(message_id, sender, body):
+    return {'id': message_id, 'snippet': body, 'internalDate': '1703030400000', 'payload': {
+        'mimeType': 'text/plain', 'body': {}, 'headers': [
+            {'name': 'Subject', 'value': 'Hello'},
+            {'name': 'From', 'value': sender},
+            {'name': 'To', 'value': 'me@gmail.com'},
+            {'name': 'Date', 'value': 'Thu, 21 Dec 2023 10:00:00 +0000'},
+        ]}}
+
+@patch('email_daemon.mark_emails_processed')
+@patch('email_daemon.insert_emails')
+@patch('email_daemon.save_sync_state')
+@patch('email_daemon.get_sync_state')
+@patch('email_daemon.resolve_folder_label_ids', return_value={'INBOX': 'INBOX'})
+class TestEmailDaemon(unittest.TestCase):
+
+    def _gmail_service(self, history_pages):
+        gmail_service = MagicMock()
+        gmail_service.users().history().list().execute.side_effect = history_pages
+        return gmail_service
+
+    def test_sync_once_stores_and_processes_new_mail(self, mock_resolve, mock_get_sync_state, mock_save_sync_state, mock_insert_emails, mock_mark_emails_processed):
+        mock_get_sync_state.return_value = '100'
+        gmail_service = self._gmail_service([{'historyId': '105', 'history': [
+            {'messagesAdded': [{'message': {'id': 'm1', 'labelIds': ['INBOX']}}, {'message': {'id': 'm2', 'labelIds': ['INBOX']}}]},
+        ]}])
+        messages = {'m1': _message('m1', 'no-reply@swiggy.in', "Don't want this"), 'm2': _message('m2', 'friend@example.com', 'hi')}
+        daemon = EmailDaemon(gmail_service, FakeNotificationSource([]))
+
+        with patch('email_daemon.fetch_stage', side_effect=lambda ids, svc: (messages[message_id] for message_id in ids)), \
+                patch('process_emails.mark_emails_processed') as mock_mark_modified:
+            stored = daemon.sync_once()
+
+        self.assertEqual(stored, 2)
+        self.assertEqual([row[0] for row in mock_insert_emails.call_args.args[0]], ['m1', 'm2'])
+        gmail_service.users().messages().batchModify.assert_called_once_with(userId='me', body={
+            'ids': ['m1'], 'addLabelIds': ['INBOX', 'UNREAD'], 'removeLabelIds': []})
+        mock_mark_modified.assert_called_once_with(['m1'], ruleset_hash(get_rules_data()))
+        mock_mark_emails_processed.assert_called_once_with(['m2'], ruleset_hash(get_rules_data()))
+        mock_save_sync_state.assert_called_once_with('gmail_history_id:INBOX', '105')
+        self.assertEqual(daemon.checkpoint, '105')
+
+    def test_sync_once_keeps_checkpoint_when_messages_fail(self, mock_resolve, mock_get_sync_state, mock_save_sync_state, mock_insert_emails, mock_mark_emails_processed):
+        mock_get_sync_state.return_value = '100'
+        gmail_service = self._gmail_service([{'historyId': '105', 'history': [
+            {'messagesAdded': [{'message': {'id': 'm1', 'labelIds': ['INBOX']}}, {'message': {'id': 'm2', 'labelIds': ['INBOX']}}]},
+        ]}])
+        daemon = EmailDaemon(gmail_service, FakeNotificationSource([]))
+
+        def fetch_stage(message_ids, service):
+            EMAILS_FAILED.inc(stage='fetch')
+            yield _message('m1', 'friend@example.com', 'hi')
+
+        with patch('email_daemon.fetch_stage', side_effect=fetch_stage), self.assertRaises(RuntimeError):
+            daemon.sync_once()
+
+        self.assertEqual([row[0] for row in mock_insert_emails.call_args.args[0]], ['m1'])
+        mock_save_sync_state.assert_not_called()
+        self.assertEqual(daemon.checkpoint, '100')
+
+    def test_expired_checkpoint_stores_mail_and_leaves_rules_to_the_processing_pass(self, mock_resolve, mock_get_sync_state, mock_save_sync_state, mock_insert_emails, mock_mark_emails_processed):
+        mock_get_sync_state.return_value = '1'
+        gmail_service = self._gmail_service([HttpError(MagicMock(status=404, reason='Not Found'), b'{}')])
+        gmail_service.users().getProfile().execute.return_value = {'historyId': '700'}
+        gmail_service.users().messages().list().execute.return_value = {'messages': [{'id': 'm1'}, {'id': 'm2'}]}
+        messages = {'m1': _message('m1', 'no-reply@swiggy.in', "Don't want this"), 'm2': _message('m2', 'friend@example.com', 'hi')}
+        daemon = EmailDaemon(gmail_service, FakeNotificationSource([]))
+
+        with patch('email_daemon.fetch_stage', side_effect=lambda ids, svc: (messages[message_id] for message_id in ids)), \
+                patch('email_daemon.fetch_emails_from_database') as mock_fetch_emails_from_database:
+            stored = daemon.sync_once()
+
+        self.assertEqual(stored, 2)
+        self.assertEqual([row[0] for row in mock_insert_emails.call_args.args[0]], ['m1', 'm2'])
+        gmail_service.users().messages().batchModify.assert_not_called()
+        mock_mark_emails_processed.assert_not_called()
+        mock_fetch_emails_from_database.assert_called_once_with(gmail_service, False)
+        mock_save_sync_state.assert_called_once_with('gmail_history_id:INBOX', '700')
+
+    def test_first_sync_only_records_checkpoint(self, mock_resolve, mock_get_sync_state, mock_save_sync_state, mock_insert_emails, mock_mark_emails_processed):
+        mock_get_sync_state.return_value = None
+        gmail_service = MagicMock()
+        gmail_service.users().getProfile().execute.return_value = {'historyId': '42'}
+        daemon = EmailDaemon(gmail_service, FakeNotificationSource([]))
+
+        self.assertEqual(daemon.sync_once(), 0)
+
+        mock_save_sync_state.assert_called_once_with('gmail_history_id:INBOX', '42')
+        gmail_service.users().history().list.assert_not_called()
+
+    def test_run_syncs_only_on_newer_notifications(self, mock_resolve, mock_get_sync_state, mock_save_sync_state, mock_insert_emails, mock_mark_emails_processed):
+        mock_get_sync_state.return_value = '100'
+        gmail_service = self._gmail_service([{'historyId': '100'}, {'historyId': '120'}])
+        daemon = EmailDaemon(gmail_service, FakeNotificationSource(['90', '100', '120']))
+
+        with patch('email_daemon.fetch_stage', return_value=iter([])):
+            daemon.run()
+
+        self.assertEqual(gmail_service.users().history().list().execute.call_count, 2)
+        self.assertEqual(daemon.checkpoint, '120')
+
+    def test_run_checks_rules_when_no_notification_arrives(self, mock_resolve, mock_get_sync_state, mock_save_sync_state, mock_insert_emails, mock_mark_emails_processed):
+        mock_get_sync_state.return_value = '100'
+        gmail_service = self._gmail_service([{'historyId': '100'}])
+        daemon = EmailDaemon(gmail_service, FakeNotificationSource([IDLE, IDLE]))
+
+        with patch('email_daemon.fetch_stage', return_value=iter([])), patch.object(daemon.rule_watcher, 'check') as mock_check:
+            daemon.run()
+
+        self.assertEqual(mock_check.call_count, 3)
+        self.assertEqual(gmail_service.users().history().list().execute.call_count, 1)
+
+    def test_run_retries_failed_sync(self, mock_resolve, mock_get_sync_state, mock_save_sync_state, mock_insert_emails, mock_mark_emails_processed):
+        mock_get_sync_state.side_effect = [Exception('database is down'), '100']
+        gmail_service = self._gmail_service([{'historyId': '101'}])
+        sleep = MagicMock()
+        daemon = EmailDaemon(gmail_service, FakeNotificationSource([]), sleep=sleep)
+
+        with patch('email_daemon.fetch_stage', return_value=iter([])):
+            daemon.run()
+
+        sleep.assert_called_once_with(5)
+        self.assertEqual(daemon.checkpoint, '101')
+
+    def test_reloaded_rules_apply_to_new_and_stored_mail(self, mock_resolve, mock_get_sync_state, mock_save_sync_state, mock_insert_emails, mock_mark_emails_processed):
+        daemon = EmailDaemon(MagicMock(), FakeNotificationSource([]))
+        rules_data = [{'friends': {'collective_predicate': 'All', 'active': 1, 'actions': {'mark_as_read': True},
+                                   'conditions': [{'field': 'sender', 'predicate': 'contains', 'value': 'friend@'}]}}]
+        ruleset = RuleSet(rules_data, RuleIndex(rules_data, EMAIL_INSERT_COLUMNS), ruleset_hash(rules_data), {})
+
+        with patch.dict(rules_cache), patch('email_daemon.fetch_emails_from_database') as mock_fetch_emails_from_database:
+            daemon.rules_changed(daemon.rule_watcher.ruleset, ruleset)
+            self.assertIs(rules_cache['rules_data'], rules_data)
+
+        mock_fetch_emails_from_database.assert_called_once_with(daemon.gmail_service, False)
+        self.assertEqual(daemon.ruleset_hash, ruleset_hash(rules_data))
+        self.assertEqual(daemon.label_deltas, [(frozenset(), frozenset({'UNREAD'}))])
+
+class TestNotificationSources(unittest.TestCase):
+
+    def test_parse_push_notification(self):
+        self.assertEqual(parse_push_notification(json.dumps({'emailAddress': 'me@gmail.com', 'historyId': 1234}).encode()), '1234')
+        with self.assertRaises(ValueError):
+            parse_push_notification(b'not json')
+
+    def test_history_poll_source(self):
+        gmail_service = MagicMock()
+        gmail_service.users().getProfile().execute.return_value = {'historyId': '7'}
+        source = HistoryPollSource(gmail_service, interval_seconds=0)
+
+        self.assertEqual(source.next_notification(), '7')
+        source.stop()
+        self.assertIsNone(source.next_notification())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,20 +1,43 @@
+import time
+import base64
+import datetime
 import unittest
 from unittest.mock import patch, MagicMock
-from fetch_and_save_emails import clean_email_content, retrieve_and_insert_email_details, get_email_details, authenticate_gmail, main
+from googleapiclient import discovery_cache
+from googleapiclient.errors import HttpError
+from metrics import EMAILS_FAILED
+from fetch_and_save_emails import clean_email_content, retrieve_and_insert_email_details, flush_email_buffer, get_email_details, execute_email_batch, fetch_detailed_emails, is_quota_error, list_message_ids, list_history_message_ids, concurrent_ingest, retryable_failure_count, parse_email_details, parse_headers, extract_message_body, decode_base64url, message_get_request, authenticate_gmail, build_gmail_service, gmail_discovery, main
 
 class TestFetchAndSaveEmails(unittest.TestCase):
 
     def test_clean_email_content(self):
         content = "Sample <b>content</b> with <script>alert('danger')</script> tags."
         cleaned_content = clean_email_content(content)
-        self.assertEqual(cleaned_content, "Sample content with alert('danger') tags.")
+        self.assertEqual(cleaned_content, "Sample content with  tags.")
+
+    def test_clean_email_content_keeps_escaped_text_and_unicode(self):
+        content = "<style>p {color: red}</style><p>Use &lt;b&gt; for bold &amp; caf\u00e9 \u2603</p>\x00\x07<!-- hidden -->"
+        self.assertEqual(clean_email_content(content), "Use <b> for bold & caf\u00e9 \u2603")
+
+    def test_clean_email_content_handles_malformed_html(self):
+        content = "a < b and <b>c</b> < " * 1000
+        self.assertEqual(clean_email_content(content), "a < b and c < " * 1000)
+
+    def test_clean_email_content_is_linear_on_unclosed_elements(self):
+        for unclosed, kept in (('<script>x', ''), ('<STYLE type="text/css">x', ''), ('<!--x', ''), ('<script x', '<script x')):
+            content = 'text ' + unclosed * 8000
+            started_at = time.perf_counter()
+            cleaned_content = clean_email_content(content)
+            self.assertLess(time.perf_counter() - started_at, 0.5, unclosed)
+            self.assertEqual(cleaned_content, 'text ' + kept * 8000)
+
+    def test_clean_email_content_strips_unclosed_element_to_the_end(self):
+        self.assertEqual(clean_email_content('a <script>b</script> c <style>d</STYLE > e <!-- f --> g <script>h'), 'a  c  e  g ')
 
-    @patch('fetch_and_save_emails.build')
     @patch('fetch_and_save_emails.insert_email')
     @patch('fetch_and_save_emails.get_email_details')
-    def test_retrieve_and_insert_email_details(self, mock_get_email_details, mock_insert_email, mock_build):
-        credentials_mock = MagicMock()
-        gmail_service_mock = mock_build.return_value
+    def test_retrieve_and_insert_email_details(self, mock_get_email_details, mock_insert_email):
+        gmail_service_mock = MagicMock()
         message_id = '123'
 
         mock_get_email_details.return_value = {
@@ -23,10 +46,10 @@ class TestFetchAndSaveEmails(unittest.TestCase):
             'sender': 'sender1',
             'receiver': 'test_receiver',
             'date': '2023-01-01 12:00:00',
-            'message': '<script>message1'
+            'message': '<p>message1'
         }
 
-        retrieve_and_insert_email_details(message_id, credentials_mock)
+        retrieve_and_insert_email_details(message_id, gmail_service_mock)
 
         mock_get_email_details.assert_called_once_with(message_id, gmail_service_mock)
         mock_insert_email.assert_called_once_with(
@@ -58,46 +81,425 @@ class TestFetchAndSaveEmails(unittest.TestCase):
         self.assertEqual(response['subject'], 'test_subject')
         self.assertEqual(response['sender'], 'sender1')
         self.assertEqual(response['receiver'], 'test_receiver')
-        self.assertEqual(response['date'], '2022-01-01 12:00:00')
+        self.assertEqual(response['date'], datetime.datetime(2022, 1, 1, 12, 0, tzinfo=datetime.timezone.utc))
         self.assertEqual(response['message'], 'message1')
 
-    @patch('fetch_and_save_emails.credentials.Credentials.from_authorized_user_file')
+    def _encode(self, text, encoding='utf-8'):
+        return base64.urlsafe_b64encode(text.encode(encoding)).decode('ascii').rstrip('=')
+
+    def test_extract_message_body_prefers_plain_text_and_skips_attachments(self):
+        payload = {
+            'mimeType': 'multipart/mixed',
+            'parts': [
+                {'mimeType': 'text/plain', 'filename': 'notes.txt', 'body': {'data': self._encode('attachment text')}},
+                {'mimeType': 'multipart/alternative', 'parts': [
+                    {'mimeType': 'text/html', 'body': {'data': self._encode('<p>html body</p>')}},
+                    {'mimeType': 'text/plain', 'body': {'data': self._encode('plain body')}},
+                ]},
+                {'mimeType': 'application/pdf', 'filename': 'invoice.pdf', 'body': {'attachmentId': 'att1', 'size': 10 ** 7}},
+            ],
+        }
+
+        self.assertEqual(extract_message_body(payload), 'plain body')
+
+    def test_extract_message_body_falls_back_to_html_and_charset(self):
+        payload = {
+            'mimeType': 'text/html',
+            'headers': [{'name': 'Content-Type', 'value': 'text/html; charset="iso-8859-1"'}],
+            'body': {'data': self._encode('<p>caf\u00e9</p>', 'iso-8859-1')},
+        }
+
+        self.assertEqual(extract_message_body(payload), '<p>caf\u00e9</p>')
+        self.assertIsNone(extract_message_body({'mimeType': 'text/plain', 'body': {'size': 0}}))
+
+    def test_extract_message_body_is_size_bounded(self):
+        payload = {'mimeType': 'text/plain', 'body': {'data': self._encode('\u00e9' * 100000)}}
+
+        self.assertEqual(extract_message_body(payload, max_chars=10), '\u00e9' * 10)
+        self.assertEqual(len(decode_base64url(self._encode('x' * 100000), 1000)), 1000)
+
+    def test_get_email_details_uses_decoded_body(self):
+        msg = {
+            'id': '123',
+            'snippet': 'short',
+            'payload': {
+                'mimeType': 'text/plain',
+                'headers': [
+                    {'name': 'Subject', 'value': 's'}, {'name': 'From', 'value': 'f'},
+                    {'name': 'To', 'value': 't'}, {'name': 'Date', 'value': 'Sat, 01 Jan 2022 12:00:00 +0000'},
+                ],
+                'body': {'data': self._encode('the whole message body')},
+            },
+        }
+        with patch('fetch_and_save_emails.fetch_detailed_email', return_value=msg):
+            self.assertEqual(get_email_details('123', MagicMock())['message'], 'the whole message body')
+
+    def test_parse_headers_is_case_insensitive_and_multi_valued(self):
+        headers = parse_headers([
+            {'name': 'SUBJECT', 'value': 's'}, {'name': 'To', 'value': 'a@example.com'}, {'name': 'to', 'value': 'b@example.com'},
+        ])
+        self.assertEqual(headers, {'subject': ['s'], 'to': ['a@example.com', 'b@example.com']})
+
+    def test_parse_email_details_tolerates_missing_headers(self):
+        msg = {
+            'id': '123',
+            'snippet': 'body',
+            'internalDate': '1640995200000',
+            'payload': {'headers': [{'name': 'from', 'value': 'sender1'}, {'name': 'Date', 'value': 'not a date'}]},
+        }
+
+        details = parse_email_details(msg)
+
+        self.assertEqual(details['subject'], '')
+        self.assertEqual(details['receiver'], '')
+        self.assertEqual(details['sender'], 'sender1')
+        self.assertEqual(details['date'], datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc))
+
+    def test_message_get_request_headers_only(self):
+        gmail_service = MagicMock()
+        message_get_request(gmail_service, '123', headers_only=True)
+        gmail_service.users.return_value.messages.return_value.get.assert_called_once_with(
+            userId='me', id='123', format='metadata', metadataHeaders=['Subject', 'From', 'To', 'Date'])
+
+    @patch('googleapiclient.discovery_cache.get_static_doc', wraps=discovery_cache.get_static_doc)
+    def test_build_gmail_service_reads_bundled_discovery_once(self, mock_get_static_doc):
+        with patch.dict(gmail_discovery, {'document': None}):
+            first = build_gmail_service(MagicMock())
+            second = build_gmail_service(MagicMock())
+
+        mock_get_static_doc.assert_called_once_with('gmail', 'v1')
+        self.assertIsNot(first, second)
+        self.assertTrue(hasattr(first.users().messages(), 'batchModify'))
+
+    @patch.dict('gmail_auth.providers', clear=True)
+    @patch('google.oauth2.credentials.Credentials.from_authorized_user_file')
     def test_authenticate_gmail(self, mock_credentials):
         creds_mock = MagicMock()
         creds_mock.valid = True
+        creds_mock.expiry = None
         mock_credentials.return_value = creds_mock
 
         credentials = authenticate_gmail()
+        self.assertIs(authenticate_gmail(), credentials)
 
         mock_credentials.assert_called_once_with('token.json', ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.modify', 'https://www.googleapis.com/auth/gmail.labels'])
         self.assertEqual(credentials, creds_mock)
 
-    @patch('fetch_and_save_emails.build')
-    @patch('fetch_and_save_emails.authenticate_gmail')
-    @patch('fetch_and_save_emails.create_email_table')
-    def test_main(self, mock_create_email_table, mock_authenticate_gmail, mock_build):
-        credentials_mock = MagicMock()
-        gmail_service_mock = mock_build.return_value
-        gmail_results_mock = {'messages': [{'id': '123'}, {'id': '456'}]}
+    @patch('fetch_and_save_emails.insert_emails')
+    def test_flush_email_buffer(self, mock_insert_emails):
+        email_buffer = [('1', 's', 'f', 't', '2023-01-01 12:00:00', 'm')]
+        written = []
+        mock_insert_emails.side_effect = lambda rows: written.append(list(rows)) or len(rows)
+
+        self.assertEqual(flush_email_buffer(email_buffer), 1)
+        self.assertEqual(written, [[('1', 's', 'f', 't', '2023-01-01 12:00:00', 'm')]])
+        self.assertEqual(email_buffer, [])
+        self.assertEqual(flush_email_buffer(email_buffer), 0)
+        mock_insert_emails.assert_called_once()
+
+    def _batch_service(self, responses):
+        """Build a Gmail service mock whose HTTP batches answer from a queue of per-call outcomes, or raise a queued error."""
+        gmail_service = MagicMock()
+        batches = []
+
+        def new_batch_http_request(callback):
+            added = []
+            batch = MagicMock()
+            batch.add.side_effect = lambda request, request_id: added.append(request_id)
+
+            def execute():
+                outcomes = responses.pop(0)
+                if isinstance(outcomes, Exception):
+                    raise outcomes
+                for request_id in added:
+                    outcome = outcomes[request_id]
+                    if isinstance(outcome, Exception):
+                        callback(request_id, None, outcome)
+                    else:
+                        callback(request_id, outcome, None)
+
+            batch.execute.side_effect = execute
+            batches.append(added)
+            return batch
+
+        gmail_service.new_batch_http_request.side_effect = new_batch_http_request
+        return gmail_service, batches
+
+    def _http_error(self, status):
+        return HttpError(MagicMock(status=status, reason='error'), b'{}')
+
+    def test_is_quota_error(self):
+        self.assertTrue(is_quota_error(self._http_error(429)))
+        self.assertFalse(is_quota_error(self._http_error(404)))
+        self.assertFalse(is_quota_error(ValueError('boom')))
+
+    @patch('fetch_and_save_emails.time.sleep')
+    def test_execute_email_batch_retries_quota_errors(self, mock_sleep):
+        gmail_service, batches = self._batch_service([
+            {'1': {'id': '1'}, '2': self._http_error(429), '3': self._http_error(404)},
+            {'2': {'id': '2'}},
+        ])
+
+        messages = execute_email_batch(['1', '2', '3'], gmail_service)
+
+        self.assertEqual(messages, {'1': {'id': '1'}, '2': {'id': '2'}})
+        self.assertEqual(batches, [['1', '2', '3'], ['2']])
+        mock_sleep.assert_called_once()
+
+    @patch('fetch_and_save_emails.time.sleep')
+    def test_execute_email_batch_retries_failed_batch_requests(self, mock_sleep):
+        gmail_service, batches = self._batch_service([
+            ConnectionResetError('connection reset'),
+            self._http_error(503),
+            {'1': {'id': '1'}, '2': {'id': '2'}},
+        ])
+
+        messages = execute_email_batch(['1', '2'], gmail_service)
+
+        self.assertEqual(messages, {'1': {'id': '1'}, '2': {'id': '2'}})
+        self.assertEqual(batches, [['1', '2']] * 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('fetch_and_save_emails.time.sleep')
+    def test_execute_email_batch_counts_chunk_as_failed_instead_of_raising(self, mock_sleep):
+        gmail_service, _ = self._batch_service([ConnectionResetError('connection reset')] * 3 + [self._http_error(400)])
+        failures_before = retryable_failure_count()
+
+        self.assertEqual(execute_email_batch(['1', '2'], gmail_service, max_retries=2), {})
+        self.assertEqual(execute_email_batch(['3'], gmail_service), {})
+
+        self.assertEqual(retryable_failure_count() - failures_before, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('fetch_and_save_emails.time.sleep')
+    def test_execute_email_batch_counts_deleted_messages_as_not_retryable(self, mock_sleep):
+        gmail_service, _ = self._batch_service([{'1': {'id': '1'}, '2': self._http_error(404), '3': self._http_error(500)}])
+        failures_before = retryable_failure_count()
+        missing_before = EMAILS_FAILED.value(stage='missing')
+
+        messages = execute_email_batch(['1', '2', '3'], gmail_service)
+
+        self.assertEqual(messages, {'1': {'id': '1'}})
+        self.assertEqual(EMAILS_FAILED.value(stage='missing') - missing_before, 1)
+        self.assertEqual(retryable_failure_count() - failures_before, 1)
+
+    @patch('fetch_and_save_emails.time.sleep')
+    def test_fetch_detailed_emails_chunks_batches(self, mock_sleep):
+        gmail_service, batches = self._batch_service([
+            {'1': {'id': '1'}, '2': {'id': '2'}},
+            {'3': {'id': '3'}},
+        ])
+
+        messages = fetch_detailed_emails(['1', '2', '3'], gmail_service, batch_size=2)
+
+        self.assertEqual(messages, [{'id': '1'}, {'id': '2'}, {'id': '3'}])
+        self.assertEqual(batches, [['1', '2'], ['3']])
+        mock_sleep.assert_not_called()
+
+    def test_list_message_ids_follows_page_tokens(self):
+        gmail_service = MagicMock()
+        list_mock = gmail_service.users.return_value.messages.return_value.list
+        list_mock.return_value.execute.side_effect = [
+            {'messages': [{'id': '1'}, {'id': '2'}], 'nextPageToken': 'page2'},
+            {'messages': [{'id': '3'}]},
+        ]
+
+        message_ids = list_message_ids(gmail_service, ['INBOX'], page_size=2)
+
+        list_mock.assert_not_called()
+        self.assertEqual(list(message_ids), ['1', '2', '3'])
+        list_mock.assert_has_calls([
+            unittest.mock.call(userId='me', labelIds=['INBOX'], maxResults=2),
+            unittest.mock.call(userId='me', labelIds=['INBOX'], maxResults=2, pageToken='page2'),
+        ], any_order=True)
+
+    def test_list_message_ids_max_messages(self):
+        gmail_service = MagicMock()
+        list_mock = gmail_service.users.return_value.messages.return_value.list
+        list_mock.return_value.execute.side_effect = [
+            {'messages': [{'id': '1'}, {'id': '2'}], 'nextPageToken': 'page2'},
+            {'messages': [{'id': '3'}]},
+        ]
+
+        self.assertEqual(list(list_message_ids(gmail_service, page_size=2, max_messages=2)), ['1', '2'])
+        self.assertEqual(list_mock.return_value.execute.call_count, 1)
+
+    def test_list_history_message_ids(self):
+        gmail_service = MagicMock()
+        history_mock = gmail_service.users.return_value.history.return_value.list
+        history_mock.return_value.execute.side_effect = [
+            {
+                'history': [
+                    {'messagesAdded': [{'message': {'id': '1', 'labelIds': ['INBOX', 'UNREAD']}}]},
+                    {'messagesAdded': [{'message': {'id': '2', 'labelIds': ['SENT']}}]},
+                ],
+                'nextPageToken': 'page2',
+                'historyId': '110',
+            },
+            {
+                'history': [
+                    {'labelsAdded': [{'message': {'id': '3', 'labelIds': ['INBOX']}, 'labelIds': ['INBOX']}]},
+                    {'messagesAdded': [{'message': {'id': '1', 'labelIds': ['INBOX']}}]},
+                ],
+                'historyId': '120',
+            },
+        ]
+
+        message_ids, history_id = list_history_message_ids(gmail_service, '100', ['INBOX'], page_size=50)
+
+        self.assertEqual(message_ids, ['1', '3'])
+        self.assertEqual(history_id, '120')
+        history_mock.assert_called_with(userId='me', startHistoryId='100', historyTypes=['messageAdded', 'labelAdded'],
+                                        maxResults=50, labelId='INBOX', pageToken='page2')
+
+    def _patch_main_dependencies(self, checkpoint):
+        patchers = {
+            name: patch(f'fetch_and_save_emails.{name}')
+            for name in ('create_email_table', 'create_sync_state_table', 'get_sync_state', 'save_sync_state',
+                         'authenticate_gmail', 'build_gmail_service', 'insert_emails', 'fetch_detailed_emails', 'email_row_from_message')
+        }
+        mocks = {name: patcher.start() for name, patcher in patchers.items()}
+        for patcher in patchers.values():
+            self.addCleanup(patcher.stop)
+        mocks['get_sync_state'].return_value = checkpoint
+        mocks['fetch_detailed_emails'].side_effect = lambda message_ids, service, batch_size, headers_only: [{'id': message_id} for message_id in message_ids]
+        mocks['email_row_from_message'].side_effect = lambda msg: (msg['id'],)
+        written = []
+        mocks['insert_emails'].side_effect = lambda rows: written.append(list(rows)) or len(rows)
+        return mocks, written
+
+    def test_main(self):
+        mocks, written = self._patch_main_dependencies(checkpoint=None)
+        credentials_mock = mocks['authenticate_gmail'].return_value
+        gmail_service_mock = mocks['build_gmail_service'].return_value
+        gmail_results_mock = {'messages': [{'id': '123'}, {'id': '456'}, {'id': '789'}]}
         gmail_service_mock.users.return_value.messages.return_value.list.return_value.execute.return_value = gmail_results_mock
-        mock_authenticate_gmail.return_value = credentials_mock
-
-        with patch('fetch_and_save_emails.retrieve_and_insert_email_details') as mock_retrieve_insert:
-            main()
-
-            mock_create_email_table.assert_called_once()
-            mock_authenticate_gmail.assert_called_once()
-            mock_build.assert_called_once_with('gmail', 'v1', credentials=credentials_mock)
-            
-            gmail_service_mock.users.return_value.messages.return_value.list.assert_called_once_with(
-                userId='me', labelIds=['INBOX'], maxResults=10)
-            
-            assert gmail_service_mock.users.return_value.messages.return_value.list.return_value.execute.call_count > 0
-            
-            mock_retrieve_insert.assert_has_calls([
-                unittest.mock.call('123', credentials_mock),
-                unittest.mock.call('456', credentials_mock)
-            ])
+        gmail_service_mock.users.return_value.getProfile.return_value.execute.return_value = {'historyId': '500'}
+
+        main(page_size=10, buffer_size=2)
+
+        mocks['create_email_table'].assert_called_once()
+        mocks['create_sync_state_table'].assert_called_once()
+        mocks['authenticate_gmail'].assert_called_once()
+        mocks['build_gmail_service'].assert_called_once_with(credentials_mock)
+        
+        gmail_service_mock.users.return_value.messages.return_value.list.assert_called_once_with(
+            userId='me', labelIds=['INBOX'], maxResults=10)
+        
+        assert gmail_service_mock.users.return_value.messages.return_value.list.return_value.execute.call_count > 0
+        
+        mocks['fetch_detailed_emails'].assert_called_once_with(['123', '456', '789'], gmail_service_mock, 100, headers_only=False)
+        self.assertEqual(written, [[('123',), ('456',)], [('789',)]])
+        mocks['save_sync_state'].assert_called_once_with('gmail_history_id:INBOX', '500')
+
+    def test_main_incremental_sync(self):
+        mocks, written = self._patch_main_dependencies(checkpoint='400')
+        gmail_service_mock = mocks['build_gmail_service'].return_value
+        gmail_service_mock.users.return_value.history.return_value.list.return_value.execute.return_value = {
+            'history': [{'messagesAdded': [{'message': {'id': '999', 'labelIds': ['INBOX']}}]}],
+            'historyId': '450',
+        }
+
+        main()
+
+        gmail_service_mock.users.return_value.messages.return_value.list.assert_not_called()
+        self.assertEqual(written, [[('999',)]])
+        mocks['save_sync_state'].assert_called_once_with('gmail_history_id:INBOX', '450')
+
+    def test_main_expired_checkpoint_falls_back_to_full_sync(self):
+        mocks, written = self._patch_main_dependencies(checkpoint='1')
+        gmail_service_mock = mocks['build_gmail_service'].return_value
+        gmail_service_mock.users.return_value.history.return_value.list.return_value.execute.side_effect = self._http_error(404)
+        gmail_service_mock.users.return_value.messages.return_value.list.return_value.execute.return_value = {'messages': [{'id': '123'}]}
+        gmail_service_mock.users.return_value.getProfile.return_value.execute.return_value = {'historyId': '700'}
+
+        main()
+
+        self.assertEqual(written, [[('123',)]])
+        mocks['save_sync_state'].assert_called_once_with('gmail_history_id:INBOX', '700')
+
+    def test_main_capped_run_keeps_checkpoint(self):
+        mocks, written = self._patch_main_dependencies(checkpoint=None)
+        gmail_service_mock = mocks['build_gmail_service'].return_value
+        gmail_service_mock.users.return_value.messages.return_value.list.return_value.execute.return_value = {'messages': [{'id': '1'}, {'id': '2'}]}
+
+        main(max_messages=1)
+
+        self.assertEqual(written, [[('1',)]])
+        mocks['save_sync_state'].assert_not_called()
+
+    def test_main_failed_insert_keeps_checkpoint(self):
+        mocks, written = self._patch_main_dependencies(checkpoint='400')
+        gmail_service_mock = mocks['build_gmail_service'].return_value
+        gmail_service_mock.users.return_value.history.return_value.list.return_value.execute.return_value = {
+            'history': [{'messagesAdded': [{'message': {'id': '999', 'labelIds': ['INBOX']}}]}],
+            'historyId': '450',
+        }
+        mocks['insert_emails'].side_effect = Exception('database is down')
+
+        main()
+
+        mocks['save_sync_state'].assert_not_called()
+
+    @patch('fetch_and_save_emails.insert_emails')
+    @patch('fetch_and_save_emails.email_row_from_message')
+    @patch('fetch_and_save_emails.fetch_detailed_emails')
+    @patch('fetch_and_save_emails.build_gmail_service')
+    def test_concurrent_ingest(self, mock_build_gmail_service, mock_fetch_detailed_emails, mock_row_from_message, mock_insert_emails):
+        credentials_mock = MagicMock()
+        rate_limiter = MagicMock()
+        mock_fetch_detailed_emails.side_effect = lambda message_ids, service, batch_size, limiter, headers_only: [{'id': message_id} for message_id in message_ids]
+        mock_row_from_message.side_effect = lambda msg: (msg['id'],)
+        written = []
+        mock_insert_emails.side_effect = lambda rows: written.append(list(rows)) or len(rows)
+        message_ids = (str(i) for i in range(250))
+
+        processed = concurrent_ingest(message_ids, credentials_mock, workers=3, buffer_size=100, rate_limiter=rate_limiter)
+
+        self.assertEqual(processed, 250)
+        self.assertEqual(mock_build_gmail_service.call_count, 3)
+        mock_build_gmail_service.assert_called_with(credentials_mock)
+        self.assertEqual(sorted(row[0] for batch in written for row in batch), sorted(str(i) for i in range(250)))
+        self.assertTrue(all(len(batch) <= 100 for batch in written))
+        self.assertEqual(mock_fetch_detailed_emails.call_count, 3)
+        self.assertTrue(all(call.args[3] is rate_limiter for call in mock_fetch_detailed_emails.call_args_list))
+
+    @patch('fetch_and_save_emails.insert_emails')
+    @patch('fetch_and_save_emails.email_row_from_message')
+    @patch('fetch_and_save_emails.fetch_detailed_emails')
+    @patch('fetch_and_save_emails.build_gmail_service')
+    def test_concurrent_ingest_loses_only_the_failed_batch(self, mock_build_gmail_service, mock_fetch_detailed_emails, mock_row_from_message, mock_insert_emails):
+        calls = []
+
+        def fetch_detailed_emails(message_ids, service, batch_size, limiter, headers_only):
+            calls.append(message_ids)
+            if len(calls) == 2:
+                raise ConnectionResetError('connection reset')
+            return [{'id': message_id} for message_id in message_ids]
+
+        mock_fetch_detailed_emails.side_effect = fetch_detailed_emails
+        mock_row_from_message.side_effect = lambda msg: (msg['id'],)
+        written = []
+        mock_insert_emails.side_effect = lambda rows: written.append(list(rows)) or len(rows)
+        failures_before = retryable_failure_count()
+
+        processed = concurrent_ingest((str(i) for i in range(2000)), MagicMock(), workers=4, rate_limiter=MagicMock())
+
+        self.assertEqual(processed, 1900)
+        self.assertEqual(sum(len(batch) for batch in written), 1900)
+        self.assertEqual(retryable_failure_count() - failures_before, 100)
+
+    @patch('fetch_and_save_emails.insert_emails')
+    @patch('fetch_and_save_emails.fetch_detailed_emails')
+    @patch('fetch_and_save_emails.build_gmail_service', side_effect=Exception('no transport'))
+    def test_concurrent_ingest_counts_batches_left_by_workers_that_could_not_start(self, mock_build_gmail_service, mock_fetch_detailed_emails, mock_insert_emails):
+        failures_before = retryable_failure_count()
+
+        processed = concurrent_ingest((str(i) for i in range(2500)), MagicMock(), workers=2, rate_limiter=MagicMock())
+
+        self.assertEqual(processed, 0)
+        mock_fetch_detailed_emails.assert_not_called()
+        self.assertEqual(retryable_failure_count() - failures_before, 2500)
 
 if __name__ == '__main__':
     unittest.main()
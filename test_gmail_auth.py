@@ -0,0 +1,122 @@
+import os
+import json
+import datetime
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+from gmail_auth import CredentialProvider
+from fetch_and_save_emails import build_gmail_service
+
+NOW = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+class FakeCredentials:
+    """
+    Stand-in for google.oauth2.credentials.Credentials with a controllable expiry.
+    """
+
+    refresh_count = 0
+
+    def __init__(self, token, expiry, refresh_token='refresh'):
+        self.token = token
+        self.expiry = expiry
+        self._refresh_token = refresh_token
+
+    @property
+    def refresh_token(self):
+        return self._refresh_token
+
+    @property
+    def valid(self):
+        return self.expiry is None or self.expiry > NOW
+
+    def refresh(self, request):
+        FakeCredentials.refresh_count += 1
+        self.token = f'{self.token}-refreshed'
+        self.expiry = NOW + datetime.timedelta(hours=1)
+
+    def to_json(self):
+        return json.dumps({'token': self.token, 'expiry': self.expiry.isoformat() if self.expiry else None})
+
+def _load_fake_token(path, scopes):
+    with open(path) as token:
+        stored = json.load(token)
+    return FakeCredentials(stored['token'], datetime.datetime.fromisoformat(stored['expiry']) if stored['expiry'] else None)
+
+@patch('google.oauth2.credentials.Credentials.from_authorized_user_file', side_effect=_load_fake_token)
+class TestCredentialProvider(unittest.TestCase):
+
+    def setUp(self):
+        FakeCredentials.refresh_count = 0
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.token_file = os.path.join(self.directory.name, 'token.json')
+
+    def _write_token(self, token, expiry):
+        with open(self.token_file, 'w') as token_file:
+            token_file.write(FakeCredentials(token, expiry).to_json())
+
+    def _provider(self):
+        return CredentialProvider(self.token_file, clock=lambda: NOW)
+
+    def test_token_is_read_once(self, mock_from_file):
+        self._write_token('token', NOW + datetime.timedelta(hours=1))
+        provider = self._provider()
+
+        self.assertEqual(provider.get().token, 'token')
+        self.assertIs(provider.get(), provider.get())
+        mock_from_file.assert_called_once()
+
+    def test_token_near_expiry_is_refreshed_once_across_threads(self, mock_from_file):
+        self._write_token('token', NOW + datetime.timedelta(minutes=1))
+        provider = self._provider()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(provider.get().token)) for _ in range(8)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(FakeCredentials.refresh_count, 1)
+        self.assertEqual(results, ['token-refreshed'] * 8)
+        with open(self.token_file) as token_file:
+            self.assertEqual(json.load(token_file)['token'], 'token-refreshed')
+        self.assertEqual(os.listdir(self.directory.name), ['token.json'])
+
+    def test_token_refreshed_by_another_process_is_reused(self, mock_from_file):
+        self._write_token('token', NOW + datetime.timedelta(minutes=1))
+        provider = self._provider()
+        provider.get()
+        self._write_token('other-process', NOW + datetime.timedelta(hours=1))
+        provider.creds.expiry = NOW + datetime.timedelta(minutes=2)
+
+        self.assertEqual(provider.get().token, 'other-process')
+        self.assertEqual(FakeCredentials.refresh_count, 1)
+
+    @patch('googleapiclient.discovery.build_from_document')
+    def test_token_refreshed_by_another_process_reaches_built_services(self, mock_build_from_document, mock_from_file):
+        self._write_token('token', NOW + datetime.timedelta(minutes=1))
+        provider = self._provider()
+        build_gmail_service(provider.get())
+        self._write_token('other-process', NOW + datetime.timedelta(hours=1))
+        provider.creds.expiry = NOW + datetime.timedelta(minutes=2)
+
+        provider.get()
+
+        service_creds = mock_build_from_document.call_args.kwargs['credentials']
+        self.assertIs(provider.get(), service_creds)
+        self.assertEqual(service_creds.token, 'other-process')
+        self.assertEqual(service_creds.expiry, NOW + datetime.timedelta(hours=1))
+
+    def test_seconds_until_refresh(self, mock_from_file):
+        self._write_token('token', NOW + datetime.timedelta(minutes=30))
+        provider = self._provider()
+        self.assertEqual(provider.seconds_until_refresh(), 0.0)
+
+        provider.get()
+
+        self.assertEqual(provider.seconds_until_refresh(), 25 * 60)
+
+if __name__ == '__main__':
+    unittest.main()
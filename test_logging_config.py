@@ -0,0 +1,40 @@
+import logging
+import unittest
+from logging_config import RateLimitFilter
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def make_record(msg, *args, name='fetch_and_save_emails'):
+    return logging.LogRecord(name, logging.ERROR, __file__, 1, msg, args, None)
+
+class TestRateLimitFilter(unittest.TestCase):
+
+    def test_limits_each_message_per_interval(self):
+        clock = FakeClock()
+        rate_limit = RateLimitFilter(rate=2, interval_seconds=60, clock=clock)
+
+        passed = [rate_limit.filter(make_record('Error fetching email %s: %s', f'id{number}', 'boom')) for number in range(5)]
+
+        self.assertEqual(passed, [True, True, False, False, False])
+        self.assertTrue(rate_limit.filter(make_record('Error listing emails: %s', 'boom')))
+
+    def test_reports_suppressed_records_in_the_next_window(self):
+        clock = FakeClock()
+        rate_limit = RateLimitFilter(rate=1, interval_seconds=60, clock=clock)
+        for number in range(4):
+            rate_limit.filter(make_record('Processed %d emails', number))
+
+        clock.now = 61
+        record = make_record('Processed %d emails', 400)
+
+        self.assertTrue(rate_limit.filter(record))
+        self.assertEqual(record.getMessage(), 'Processed 400 emails (3 similar messages suppressed)')
+
+if __name__ == '__main__':
+    unittest.main()
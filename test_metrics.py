@@ -0,0 +1,106 @@
+import os
+import json
+import tempfile
+import unittest
+import urllib.request
+from metrics import MetricsRegistry, timed, start_metrics_server, write_metrics_file
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter_is_kept_per_label_values(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('rule_actions_total', 'Actions.', ['action'])
+
+        counter.inc(action='-UNREAD')
+        counter.inc(3, action='-UNREAD')
+        counter.inc(action='+Label_1')
+
+        self.assertEqual(counter.value(action='-UNREAD'), 4)
+        self.assertEqual(counter.value(action='+Label_1'), 1)
+        self.assertIn('rule_actions_total{action="-UNREAD"} 4', registry.render_prometheus())
+
+    def test_histogram_renders_cumulative_buckets(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('gmail_request_seconds', 'Latency.', ['method'], buckets=(0.1, 1.0))
+
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value, method='messages.list')
+
+        text = registry.render_prometheus()
+        self.assertIn('# TYPE gmail_request_seconds histogram', text)
+        self.assertIn('gmail_request_seconds_bucket{method="messages.list",le="0.1"} 1', text)
+        self.assertIn('gmail_request_seconds_bucket{method="messages.list",le="1.0"} 3', text)
+        self.assertIn('gmail_request_seconds_bucket{method="messages.list",le="+Inf"} 4', text)
+        self.assertIn('gmail_request_seconds_count{method="messages.list"} 4', text)
+        self.assertIn('gmail_request_seconds_sum{method="messages.list"} 4.25', text)
+
+    def test_label_values_are_escaped(self):
+        registry = MetricsRegistry()
+        registry.counter('rule_matches_total', 'Matches.', ['rule']).inc(rule='say "hi"\\n')
+
+        self.assertIn('rule_matches_total{rule="say \\"hi\\"\\\\n"} 1', registry.render_prometheus())
+
+    def test_registering_a_name_twice_returns_the_same_metric(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('emails_total', 'Emails.')
+
+        self.assertIs(registry.counter('emails_total', 'Emails.'), counter)
+        with self.assertRaises(ValueError):
+            registry.histogram('emails_total', 'Emails.')
+
+    def test_drained_values_merge_into_another_registry(self):
+        worker = MetricsRegistry()
+        parent = MetricsRegistry()
+        for registry in (worker, parent):
+            registry.counter('emails_evaluated_total', 'Emails.')
+            registry.histogram('rule_evaluation_seconds', 'Evaluation.')
+        worker.metrics['emails_evaluated_total'].inc(5)
+        worker.metrics['rule_evaluation_seconds'].observe(0.002)
+        parent.metrics['emails_evaluated_total'].inc(2)
+
+        parent.merge(worker.drain())
+
+        self.assertEqual(parent.metrics['emails_evaluated_total'].value(), 7)
+        self.assertEqual(parent.metrics['rule_evaluation_seconds'].count(), 1)
+        self.assertEqual(worker.metrics['emails_evaluated_total'].value(), 0)
+
+    def test_timed_records_a_failing_block(self):
+        histogram = MetricsRegistry().histogram('db_query_seconds', 'Queries.', ['operation'])
+
+        with self.assertRaises(RuntimeError):
+            with timed(histogram, operation='insert'):
+                raise RuntimeError('connection lost')
+
+        self.assertEqual(histogram.count(operation='insert'), 1)
+
+    def test_metrics_server_serves_prometheus_text(self):
+        registry = MetricsRegistry()
+        registry.counter('emails_ingested_total', 'Emails.').inc(12)
+        server = start_metrics_server(0, '127.0.0.1', registry)
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+                body = response.read().decode('utf-8')
+                content_type = response.headers['Content-Type']
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertTrue(content_type.startswith('text/plain'))
+        self.assertIn('emails_ingested_total 12', body)
+
+    def test_write_metrics_file(self):
+        registry = MetricsRegistry()
+        registry.histogram('email_parse_seconds', 'Parsing.', buckets=(0.001,)).observe(0.0005)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.json')
+
+            write_metrics_file(path, registry)
+
+            with open(path) as metrics_file:
+                dumped = json.load(metrics_file)
+        series = dumped['metrics']['email_parse_seconds']['series'][0]
+        self.assertEqual(series['count'], 1)
+        self.assertEqual(series['buckets'], {'0.001': 1, '+Inf': 0})
+
+if __name__ == '__main__':
+    unittest.main()
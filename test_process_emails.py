@@ -1,20 +1,206 @@
+import os
+import json
+import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
-from process_emails import fetch_emails_from_database, process_email, perform_rule_actions, check_rule_condition, mark_email_as_read, mark_email_as_unread, move_email_to_folder, get_label_id
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+from datetime import datetime, timezone
+from rule_engine import compile_rules, ruleset_hash, rule_versions
+from process_emails import rules_cache, label_cache, get_rules_data, get_compiled_rules, fetch_emails_from_database, reevaluate_changed_rules, partition_id_range, process_email, merge_label_deltas, batch_modify_emails, actions_to_label_delta, perform_rule_actions, check_rule_condition, mark_email_as_read, mark_email_as_unread, move_email_to_folder, get_label_id, configure_label_cache
 
 class TestProcessEmails(unittest.TestCase):
 
-    @patch('process_emails.fetch_all_emails')
-    @patch('process_emails.process_email')
-    def test_fetch_emails_from_database(self, mock_process_email, mock_fetch_all_emails):
-        mock_fetch_all_emails.return_value = [('1', 'email1', 'test_subject', 'sender1', 'test_receiver', '2023-01-01 00:00:00', 'message1'), ('2', 'email2', 'subject2', 'sender2', 'receiver2', '2023-01-02 00:00:00', 'message2')]
+    def setUp(self):
+        configure_label_cache(None)
+
+    @patch('process_emails.save_sync_state')
+    @patch('process_emails.get_sync_state', return_value=None)
+    @patch('process_emails.mark_emails_processed')
+    @patch('process_emails.get_label_id')
+    @patch('process_emails.stream_emails')
+    def test_fetch_emails_from_database(self, mock_stream_emails, mock_get_label_id, mock_mark_emails_processed, mock_get_sync_state, mock_save_sync_state):
+        mock_stream_emails.return_value = iter([
+            ('1', 'email1', 'no-reply@swiggy.in', datetime(2023, 12, 20), "Don't want this"),
+            ('2', 'email2', 'sender2', datetime(2023, 12, 20), 'message2'),
+            ('3', 'email3', 'no-reply@swiggy.in', datetime(2023, 12, 21), "Don't want that"),
+        ])
+        mock_get_label_id.return_value = 'INBOX'
         gmail_service = MagicMock()
 
         fetch_emails_from_database(gmail_service)
 
-        mock_fetch_all_emails.assert_called_once()
-        assert mock_process_email.call_count > 0
-        mock_process_email.assert_called_with(gmail_service, ('2', 'email2', 'subject2', 'sender2', 'receiver2', '2023-01-02 00:00:00', 'message2'))
+        mock_stream_emails.assert_called_once()
+        columns, where_clause, params = mock_stream_emails.call_args.args
+        self.assertEqual(columns, ('id', 'emailid', 'sender', 'date', 'message'))
+        self.assertEqual(params, ['%Don\'t want%', '%no-reply@swiggy.in%', datetime(2023, 12, 18, tzinfo=timezone.utc), ruleset_hash(get_rules_data())])
+        self.assertIn('email_processing_state', repr(where_clause))
+        mock_get_label_id.assert_called_once_with(gmail_service, 'INBOX', False)
+        gmail_service.users().messages().batchModify.assert_called_once_with(userId='me', body={
+            'ids': ['email1', 'email3'], 'addLabelIds': ['INBOX', 'UNREAD'], 'removeLabelIds': []})
+        gmail_service.users().messages().modify.assert_not_called()
+        self.assertEqual([call.args for call in mock_mark_emails_processed.call_args_list],
+                         [(['email2'], ruleset_hash(get_rules_data())), (['email1', 'email3'], ruleset_hash(get_rules_data()))])
+
+    @patch('process_emails.save_sync_state')
+    @patch('process_emails.get_sync_state', return_value=None)
+    @patch('process_emails.mark_emails_processed')
+    @patch('process_emails.get_label_id')
+    @patch('process_emails.stream_emails')
+    def test_fetch_emails_from_database_full_pass(self, mock_stream_emails, mock_get_label_id, mock_mark_emails_processed, mock_get_sync_state, mock_save_sync_state):
+        mock_stream_emails.return_value = iter([])
+        mock_get_label_id.return_value = 'INBOX'
+
+        fetch_emails_from_database(MagicMock(), full=True)
+
+        columns, where_clause, params = mock_stream_emails.call_args.args
+        self.assertNotIn('email_processing_state', repr(where_clause))
+        self.assertEqual(len(params), 3)
+
+    @patch('process_emails.save_sync_state')
+    @patch('process_emails.get_sync_state', return_value=None)
+    @patch('process_emails.ProcessPoolExecutor')
+    @patch('process_emails.mark_emails_processed')
+    @patch('process_emails.close_pool')
+    @patch('process_emails.email_id_bounds')
+    @patch('process_emails.get_label_id')
+    @patch('process_emails.stream_emails')
+    def test_fetch_emails_from_database_in_parallel(self, mock_stream_emails, mock_get_label_id, mock_email_id_bounds, mock_close_pool, mock_mark_emails_processed, mock_process_pool, mock_get_sync_state, mock_save_sync_state):
+        mock_process_pool.side_effect = lambda mp_context, **kwargs: ThreadPoolExecutor(**kwargs)
+        rows = [(number, f'email{number}', 'no-reply@swiggy.in', datetime(2023, 12, 20), "Don't want this") for number in range(1, 11)]
+        rows[4] = (5, 'email5', 'sender5', datetime(2023, 12, 20), 'message5')
+        mock_stream_emails.side_effect = lambda columns, where_clause, params, id_range: iter(
+            [row for row in rows if id_range[0] <= row[0] < id_range[1]])
+        mock_email_id_bounds.return_value = (1, 10)
+        mock_get_label_id.return_value = 'INBOX'
+        gmail_service = MagicMock()
+
+        fetch_emails_from_database(gmail_service, workers=2)
+
+        mock_close_pool.assert_called_once()
+        self.assertIn(mock_process_pool.call_args.kwargs['mp_context'].get_start_method(), ('forkserver', 'spawn'))
+        id_ranges = sorted(call.kwargs['id_range'] for call in mock_stream_emails.call_args_list)
+        self.assertEqual(id_ranges, partition_id_range(1, 10, 8))
+        body = gmail_service.users().messages().batchModify.call_args.kwargs['body']
+        self.assertEqual(sorted(body['ids'], key=lambda email_id: int(email_id[5:])),
+                         [row[1] for row in rows if row[0] != 5])
+        self.assertEqual(body['addLabelIds'], ['INBOX', 'UNREAD'])
+        marked = [email_id for call in mock_mark_emails_processed.call_args_list for email_id in call.args[0]]
+        self.assertEqual(sorted(marked), sorted(row[1] for row in rows))
+
+    @patch('process_emails.save_sync_state')
+    @patch('process_emails.get_sync_state')
+    @patch('process_emails.advance_processed_emails')
+    @patch('process_emails.mark_emails_processed')
+    @patch('process_emails.get_label_id', return_value='Label_1')
+    @patch('process_emails.stream_emails')
+    def test_reevaluate_changed_rules(self, mock_stream_emails, mock_get_label_id, mock_mark_emails_processed, mock_advance_processed_emails,
+                                      mock_get_sync_state, mock_save_sync_state):
+        def rule(name, value, actions):
+            return {name: {'collective_predicate': 'All', 'active': 1, 'actions': actions,
+                           'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': value}]}}
+        rules_data = [rule('receipts', 'receipt', {'mark_as_read': True}),
+                      rule('invoices', 'invoice', {'mark_as_read': False, 'move_to_folder': 'Invoices'})]
+        mock_get_sync_state.return_value = json.dumps({'ruleset_hash': 'previous', 'rule_versions': dict(
+            rule_versions(rules_data), invoices='stale')})
+        mock_stream_emails.return_value = iter([
+            (1, 'email1', 'invoice and receipt'),
+            (2, 'email2', 'invoice'),
+        ])
+        gmail_service = MagicMock()
+
+        self.assertEqual(reevaluate_changed_rules(gmail_service, rules_data), (2, 2))
+
+        columns, where_clause, params = mock_stream_emails.call_args.args
+        self.assertEqual(columns, ('id', 'emailid', 'subject'))
+        self.assertEqual(params, ['%invoice%', 'previous'])
+        current_hash = ruleset_hash(rules_data)
+        mock_advance_processed_emails.assert_called_once_with('previous', current_hash, ['email1', 'email2'])
+        bodies = [call.kwargs['body'] for call in gmail_service.users().messages().batchModify.call_args_list]
+        self.assertEqual(bodies, [{'ids': ['email1', 'email2'], 'addLabelIds': ['Label_1', 'UNREAD'], 'removeLabelIds': []}])
+        mock_mark_emails_processed.assert_called_once_with(['email1', 'email2'], current_hash)
+        self.assertEqual(json.loads(mock_save_sync_state.call_args.args[1]),
+                         {'ruleset_hash': current_hash, 'rule_versions': rule_versions(rules_data)})
+
+    @patch('process_emails.advance_processed_emails')
+    @patch('process_emails.get_sync_state')
+    @patch('process_emails.stream_emails')
+    def test_reevaluate_changed_rules_leaves_reordered_rules_to_the_main_pass(self, mock_stream_emails, mock_get_sync_state,
+                                                                             mock_advance_processed_emails):
+        rules_data = [{name: {'collective_predicate': 'All', 'active': 1, 'actions': {'mark_as_read': True}, 'conditions': []}}
+                      for name in ('first', 'second')]
+        mock_get_sync_state.return_value = json.dumps({'ruleset_hash': 'previous', 'rule_versions': dict(
+            reversed(rule_versions(rules_data).items()))})
+
+        self.assertEqual(reevaluate_changed_rules(MagicMock(), rules_data), (0, 0))
+
+        mock_stream_emails.assert_not_called()
+        mock_advance_processed_emails.assert_not_called()
+
+    def test_partition_id_range(self):
+        self.assertEqual(partition_id_range(1, 10, 3), [(1, 4), (4, 7), (7, 11)])
+        self.assertEqual(partition_id_range(5, 6, 8), [(5, 6), (6, 7)])
+
+    @patch('process_emails.load_rules')
+    def test_rules_are_loaded_on_first_use(self, mock_load_rules):
+        mock_load_rules.return_value = [
+            {'rule1': {'collective_predicate': 'All', 'conditions': [], 'actions': {'mark_as_read': True}, 'active': 1}}]
+        with patch.dict(rules_cache, {'rules_data': None, 'compiled_rules': None}):
+            self.assertEqual([rule.name for rule in get_compiled_rules()], ['rule1'])
+            get_rules_data()
+        mock_load_rules.assert_called_once_with()
+
+    def test_actions_to_label_delta(self):
+        self.assertEqual(actions_to_label_delta({'mark_as_read': True, 'move_to_folder': 'Receipts'}, {'Receipts': 'Label_1'}),
+                         (frozenset({'Label_1'}), frozenset({'UNREAD'})))
+        self.assertEqual(actions_to_label_delta({'mark_as_read': False, 'move_to_folder': 'Missing'}, {'Missing': None}),
+                         (frozenset({'UNREAD'}), frozenset()))
+
+    def test_merge_label_deltas_later_rule_wins(self):
+        merged = merge_label_deltas([
+            (frozenset({'UNREAD', 'Label_1'}), frozenset()),
+            (frozenset({'Label_2'}), frozenset({'UNREAD'})),
+        ])
+        self.assertEqual(merged, (frozenset({'Label_1', 'Label_2'}), frozenset({'UNREAD'})))
+
+    @patch('process_emails.BATCH_MODIFY_SIZE', 2)
+    def test_batch_modify_emails_chunks_ids(self):
+        gmail_service = MagicMock()
+        batch_modify_emails(gmail_service, ['1', '2', '3'], (frozenset({'Label_1'}), frozenset({'UNREAD'})))
+
+        batch_modify = gmail_service.users.return_value.messages.return_value.batchModify
+        self.assertEqual([call.kwargs['body']['ids'] for call in batch_modify.call_args_list], [['1', '2'], ['3']])
+        self.assertEqual(batch_modify.call_args.kwargs['body']['removeLabelIds'], ['UNREAD'])
+
+    @patch('process_emails.mark_emails_processed')
+    def test_batch_modify_emails_records_only_applied_emails(self, mock_mark_emails_processed):
+        gmail_service = MagicMock()
+        gmail_service.users().messages().batchModify().execute.side_effect = [Exception('quota'), {}]
+
+        with patch('process_emails.BATCH_MODIFY_SIZE', 1):
+            batch_modify_emails(gmail_service, ['1', '2'], (frozenset(), frozenset({'UNREAD'})), 'hash')
+
+        mock_mark_emails_processed.assert_called_once_with(['2'], 'hash')
+
+    @patch('process_emails.mark_emails_processed')
+    def test_batch_modify_emails_forgets_label_cache_on_deleted_label(self, mock_mark_emails_processed):
+        gmail_service = MagicMock()
+        gmail_service.users().labels().list.return_value.execute.return_value = {'labels': [{'name': 'Bank', 'id': 'Label_5'}]}
+        gmail_service.users().messages().batchModify().execute.side_effect = HttpError(
+            MagicMock(status=400, reason='Bad Request'), b'{"error": {"code": 400, "message": "Invalid label: Label_5"}}')
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = os.path.join(cache_dir, 'labels.json')
+            configure_label_cache(cache_file)
+            self.assertEqual(get_label_id(gmail_service, 'Bank'), 'Label_5')
+            self.assertTrue(os.path.exists(cache_file))
+
+            with patch('process_emails.BATCH_MODIFY_SIZE', 1):
+                batch_modify_emails(gmail_service, ['1', '2'], (frozenset({'Label_5'}), frozenset()), 'hash')
+
+            self.assertFalse(os.path.exists(cache_file))
+            self.assertIsNone(label_cache['labels'])
+        self.assertEqual(gmail_service.users().messages().batchModify().execute.call_count, 1)
+        mock_mark_emails_processed.assert_not_called()
 
     @patch('process_emails.mark_email_as_read')
     @patch('process_emails.move_email_to_folder')
@@ -28,6 +214,19 @@ class TestProcessEmails(unittest.TestCase):
         mock_mark_email_as_read.assert_called_with(gmail_service, email_id)
         mock_move_email_to_folder.assert_called_with(gmail_service, email_id, 'SPAM')
 
+    @patch('process_emails.perform_rule_actions')
+    def test_process_email(self, mock_perform_rule_actions):
+        gmail_service = MagicMock()
+        email_data = ('1', 'email1', 'test_subject', 'sender1', 'test_receiver', '2023-01-01 00:00:00', 'message1')
+        rules = compile_rules([
+            {'match': {'collective_predicate': 'All', 'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'test'}], 'actions': {'mark_as_read': True}, 'active': 1}},
+            {'miss': {'collective_predicate': 'All', 'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'other'}], 'actions': {'mark_as_read': False}, 'active': 1}},
+        ])
+
+        process_email(gmail_service, email_data, rules)
+
+        mock_perform_rule_actions.assert_called_once_with(gmail_service, 'email1', {'mark_as_read': True})
+
     def test_check_rule_condition(self):
         email_data = ('1', 'email1', 'test_subject', 'sender1', 'test_receiver', '2023-01-01 00:00:00', 'message1')
         
@@ -75,5 +274,42 @@ class TestProcessEmails(unittest.TestCase):
         folder_name = 'folder3'
         self.assertIsNone(get_label_id(gmail_service, folder_name))
 
+    def test_get_label_id_lists_labels_once(self):
+        gmail_service = MagicMock()
+        labels = {'labels': [{'name': 'SPAM', 'id': 'SPAM'}, {'name': 'Receipts', 'id': 'Label_1'}]}
+        gmail_service.users().labels().list.return_value.execute.return_value = labels
+
+        self.assertEqual(get_label_id(gmail_service, 'SPAM'), 'SPAM')
+        self.assertEqual(get_label_id(gmail_service, 'Receipts'), 'Label_1')
+        self.assertEqual(gmail_service.users().labels().list.return_value.execute.call_count, 1)
+
+    def test_get_label_id_refreshes_on_miss_and_creates_missing(self):
+        gmail_service = MagicMock()
+        list_execute = gmail_service.users().labels().list.return_value.execute
+        list_execute.side_effect = [
+            {'labels': [{'name': 'SPAM', 'id': 'SPAM'}]},
+            {'labels': [{'name': 'SPAM', 'id': 'SPAM'}, {'name': 'New', 'id': 'Label_2'}]},
+            {'labels': [{'name': 'SPAM', 'id': 'SPAM'}, {'name': 'New', 'id': 'Label_2'}]},
+        ]
+        gmail_service.users().labels().create.return_value.execute.return_value = {'id': 'Label_3'}
+
+        self.assertEqual(get_label_id(gmail_service, 'New'), 'Label_2')
+        self.assertEqual(get_label_id(gmail_service, 'Invitations', create_missing=True), 'Label_3')
+        self.assertEqual(get_label_id(gmail_service, 'Invitations'), 'Label_3')
+        self.assertEqual(list_execute.call_count, 3)
+
+    def test_label_cache_is_persisted(self):
+        gmail_service = MagicMock()
+        gmail_service.users().labels().list.return_value.execute.return_value = {'labels': [{'name': 'SPAM', 'id': 'SPAM'}]}
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = os.path.join(cache_dir, 'labels.json')
+            configure_label_cache(cache_file)
+            self.assertEqual(get_label_id(gmail_service, 'SPAM'), 'SPAM')
+
+            configure_label_cache(cache_file)
+            other_service = MagicMock()
+            self.assertEqual(get_label_id(other_service, 'SPAM'), 'SPAM')
+            other_service.users().labels().list.assert_not_called()
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
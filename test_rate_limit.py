@@ -0,0 +1,44 @@
+import unittest
+from rate_limit import TokenBucket
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_acquire_within_capacity_does_not_wait(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, capacity=10, clock=clock, sleep=clock.sleep)
+
+        self.assertEqual(bucket.acquire(10), 0.0)
+        self.assertEqual(clock.sleeps, [])
+
+    def test_acquire_waits_for_refill(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, capacity=10, clock=clock, sleep=clock.sleep)
+        bucket.acquire(10)
+
+        waited = bucket.acquire(5)
+
+        self.assertAlmostEqual(waited, 0.5)
+        self.assertAlmostEqual(clock.now, 0.5)
+
+    def test_acquire_larger_than_capacity_goes_into_debt(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, capacity=10, clock=clock, sleep=clock.sleep)
+
+        self.assertEqual(bucket.acquire(25), 0.0)
+        self.assertAlmostEqual(bucket.acquire(1), 1.6)
+
+if __name__ == '__main__':
+    unittest.main()
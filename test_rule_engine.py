@@ -0,0 +1,170 @@
+import random
+import unittest
+import datetime
+from metrics import MetricsRegistry
+from rule_engine import (compile_condition, compile_rule, compile_rules, escape_like, condition_to_sql, rules_to_sql, ruleset_hash, rule_versions,
+                         changed_rule_names, validate_rules, RuleIndex)
+
+class TestRuleEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.email_data = ('1', 'email1', 'test_subject', 'sender1', 'test_receiver', datetime.datetime(2023, 12, 20, 12, 30), 'message1')
+
+    def test_compile_condition(self):
+        self.assertTrue(compile_condition({'field': 'subject', 'predicate': 'contains', 'value': 'test'})(self.email_data))
+        self.assertFalse(compile_condition({'field': 'subject', 'predicate': 'does not contain', 'value': 'test'})(self.email_data))
+        self.assertTrue(compile_condition({'field': 'message', 'predicate': 'does not contain', 'value': '2'})(self.email_data))
+        self.assertTrue(compile_condition({'field': 'date', 'predicate': 'greater than', 'value': '2023-12-18'})(self.email_data))
+        self.assertFalse(compile_condition({'field': 'date', 'predicate': 'lesser than', 'value': '2023-12-18'})(self.email_data))
+
+    def test_compile_condition_accepts_string_dates(self):
+        email_data = self.email_data[:5] + ('2023-12-20 12:30:00',) + self.email_data[6:]
+        self.assertTrue(compile_condition({'field': 'date', 'predicate': 'greater than', 'value': '2023-12-18'})(email_data))
+
+    def test_compile_condition_compares_aware_dates(self):
+        email_data = self.email_data[:5] + (datetime.datetime(2023, 12, 18, 1, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=5))),) + self.email_data[6:]
+        self.assertTrue(compile_condition({'field': 'date', 'predicate': 'lesser than', 'value': '2023-12-18'})(email_data))
+
+    def test_compile_condition_uses_column_layout(self):
+        columns = ('id', 'emailid', 'sender')
+        condition = compile_condition({'field': 'sender', 'predicate': 'contains', 'value': 'sender'}, columns)
+        self.assertTrue(condition(('1', 'email1', 'sender1')))
+
+    def test_compile_condition_rejects_unknown_field_and_predicate(self):
+        with self.assertRaises(ValueError):
+            compile_condition({'field': 'cc', 'predicate': 'contains', 'value': 'x'})
+        with self.assertRaises(ValueError):
+            compile_condition({'field': 'subject', 'predicate': 'greater than', 'value': 'x'})
+
+    def test_compile_rule_collective_predicates(self):
+        conditions = [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'test'},
+            {'field': 'sender', 'predicate': 'contains', 'value': 'nobody'},
+        ]
+        all_rule = compile_rule('all', {'collective_predicate': 'All', 'conditions': conditions, 'actions': {}, 'active': 1})
+        any_rule = compile_rule('any', {'collective_predicate': 'Any', 'conditions': conditions, 'actions': {}, 'active': 1})
+
+        self.assertFalse(all_rule.matches(self.email_data))
+        self.assertTrue(any_rule.matches(self.email_data))
+        self.assertEqual(all_rule.fields, frozenset({'subject', 'sender'}))
+
+    def test_compile_rules_drops_inactive_rules(self):
+        rules_data = [
+            {'rule1': {'collective_predicate': 'All', 'conditions': [], 'actions': {'mark_as_read': True}, 'active': 1}},
+            {'rule2': {'collective_predicate': 'All', 'conditions': [], 'actions': {'mark_as_read': True}, 'active': 0}},
+        ]
+
+        compiled_rules = compile_rules(rules_data)
+
+        self.assertEqual([rule.name for rule in compiled_rules], ['rule1'])
+        self.assertEqual(compiled_rules[0].actions, {'mark_as_read': True})
+
+    def test_escape_like(self):
+        self.assertEqual(escape_like('50%_off'), '%50\\%\\_off%')
+
+    def test_condition_to_sql(self):
+        clause, params = condition_to_sql({'field': 'subject', 'predicate': 'does not contain', 'value': 'urgent'})
+        self.assertIn('NOT LIKE', repr(clause))
+        self.assertEqual(params, ['%urgent%'])
+
+        clause, params = condition_to_sql({'field': 'date', 'predicate': 'lesser than', 'value': '2023-12-01'})
+        self.assertIn('<', repr(clause))
+        self.assertEqual(params, [datetime.datetime(2023, 12, 1, tzinfo=datetime.timezone.utc)])
+
+    def test_rules_to_sql(self):
+        rules_data = [
+            {'rule1': {'collective_predicate': 'Any', 'conditions': [
+                {'field': 'sender', 'predicate': 'contains', 'value': 'a'},
+                {'field': 'subject', 'predicate': 'contains', 'value': 'b'},
+            ], 'actions': {}, 'active': 1}},
+            {'rule2': {'collective_predicate': 'All', 'conditions': [
+                {'field': 'receiver', 'predicate': 'contains', 'value': 'c'},
+            ], 'actions': {}, 'active': 0}},
+        ]
+
+        clause, params = rules_to_sql(rules_data)
+
+        self.assertIn(' OR ', repr(clause))
+        self.assertEqual(params, ['%a%', '%b%'])
+        self.assertIsNone(rules_to_sql(rules_data[1:]))
+
+    def test_ruleset_hash_ignores_inactive_rules(self):
+        rule1 = {'rule1': {'collective_predicate': 'All', 'conditions': [], 'actions': {'mark_as_read': True}, 'active': 1}}
+        rule2 = {'rule2': {'collective_predicate': 'All', 'conditions': [], 'actions': {'mark_as_read': True}, 'active': 0}}
+        rule3 = {'rule3': {'collective_predicate': 'Any', 'conditions': [], 'actions': {'mark_as_read': False}, 'active': 1}}
+
+        self.assertEqual(ruleset_hash([rule1, rule2]), ruleset_hash([rule1]))
+        self.assertNotEqual(ruleset_hash([rule1, rule3]), ruleset_hash([rule3, rule1]))
+
+    def _random_rules(self, rng, count):
+        fields = ['subject', 'sender', 'receiver', 'message']
+        rules_data = []
+        for number in range(count):
+            conditions = []
+            for _ in range(rng.randint(0, 3)):
+                if rng.random() < 0.2:
+                    conditions.append({'field': 'date', 'predicate': rng.choice(['greater than', 'lesser than']),
+                                       'value': f'2023-12-{rng.randint(1, 28):02d}'})
+                else:
+                    conditions.append({'field': rng.choice(fields), 'predicate': rng.choice(['contains', 'contains', 'does not contain']),
+                                       'value': ''.join(rng.choice('abc') for _ in range(rng.randint(1, 3)))})
+            rules_data.append({f'rule{number}': {'collective_predicate': rng.choice(['All', 'Any']), 'conditions': conditions,
+                                                 'actions': {'mark_as_read': True}, 'active': rng.choice([0, 1, 1])}})
+        return rules_data
+
+    def test_changed_rule_names(self):
+        def rule(name, value, active=1):
+            return {name: {'collective_predicate': 'All', 'active': active, 'actions': {'mark_as_read': True},
+                           'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': value}]}}
+        previous = rule_versions([rule('a', 'x'), rule('b', 'y'), rule('c', 'z'), rule('d', 'w', active=0)])
+
+        self.assertEqual(list(previous), ['a', 'b', 'c'])
+        self.assertEqual(changed_rule_names(previous, rule_versions([rule('a', 'x'), rule('b', 'changed'), rule('c', 'z')])), ['b'])
+        self.assertEqual(changed_rule_names(previous, rule_versions([rule('d', 'w'), rule('a', 'x'), rule('c', 'z')])), ['d'])
+        self.assertEqual(changed_rule_names(previous, rule_versions([rule('c', 'z'), rule('a', 'x')])), None)
+        self.assertEqual(changed_rule_names(previous, previous), [])
+
+    def test_validate_rules(self):
+        valid = {'collective_predicate': 'Any', 'active': 1, 'actions': {'mark_as_read': True},
+                 'conditions': [{'field': 'sender', 'predicate': 'contains', 'value': 'x'}]}
+        validate_rules([{'rule1': valid}, {'rule2': dict(valid, collective_predicate='Sometimes', active=0)}])
+
+        for rules_data in ({'rule1': valid},
+                           [{'rule1': valid}, {'rule1': valid}],
+                           [{'rule1': dict(valid, collective_predicate='Sometimes')}],
+                           [{'rule1': dict(valid, actions={})}],
+                           [{'rule1': dict(valid, conditions=[{'field': 'sender', 'value': 'x'}])}]):
+            with self.assertRaises(ValueError):
+                validate_rules(rules_data)
+
+    def test_rule_index_matches_compiled_rules(self):
+        rng = random.Random(3)
+        rules_data = self._random_rules(rng, 80)
+        compiled_rules = compile_rules(rules_data)
+        for min_automaton_patterns in (1, 1000):
+            rule_index = RuleIndex(rules_data, min_automaton_patterns=min_automaton_patterns)
+            for number in range(200):
+                text = lambda: ''.join(rng.choice('abcd') for _ in range(rng.randint(0, 12)))
+                email_data = (number, f'email{number}', text(), text(), text(),
+                              datetime.datetime(2023, 12, rng.randint(1, 28), tzinfo=datetime.timezone.utc), text())
+                expected = [rule.name for rule in compiled_rules if rule.matches(email_data)]
+                self.assertEqual([rule.name for rule in rule_index.matching_rules(email_data)], expected)
+
+    def test_profiled_rule_index_records_each_rule_check(self):
+        rng = random.Random(5)
+        rules_data = self._random_rules(rng, 40)
+        rule_index = RuleIndex(rules_data)
+        profiled_index = RuleIndex(rules_data)
+        histogram = MetricsRegistry().histogram('rule_check_seconds', 'Rule checks.', ['rule'])
+        profiled_index.profile_rule_checks(histogram)
+        for number in range(50):
+            text = lambda: ''.join(rng.choice('abcd') for _ in range(rng.randint(0, 12)))
+            email_data = (number, f'email{number}', text(), text(), text(),
+                          datetime.datetime(2023, 12, rng.randint(1, 28), tzinfo=datetime.timezone.utc), text())
+            self.assertEqual(profiled_index.matching_positions(email_data), rule_index.matching_positions(email_data))
+        recorded = {key[0] for key in histogram.values}
+        self.assertTrue(recorded)
+        self.assertLessEqual(recorded, {rule.name for rule in rule_index.rules})
+
+if __name__ == '__main__':
+    unittest.main()
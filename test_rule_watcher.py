@@ -0,0 +1,51 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from rule_watcher import RuleWatcher
+
+def write_rules(path, value, mtime_ns):
+    with open(path, 'w') as rules_file:
+        json.dump([{'rule1': {'collective_predicate': 'All', 'active': 1, 'actions': {'mark_as_read': True},
+                              'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': value}]}}], rules_file)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+class TestRuleWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'rules.json')
+        write_rules(self.path, 'invoice', 1_000_000_000)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_reloads_changed_file(self):
+        on_change = MagicMock()
+        watcher = RuleWatcher(self.path, on_change=on_change)
+        original = watcher.ruleset
+
+        self.assertFalse(watcher.check())
+        write_rules(self.path, 'receipt', 2_000_000_000)
+        self.assertTrue(watcher.check())
+
+        on_change.assert_called_once_with(original, watcher.ruleset)
+        self.assertNotEqual(watcher.ruleset.ruleset_hash, original.ruleset_hash)
+        self.assertEqual(watcher.ruleset.rule_index.matching_positions(('1', 'email1', 'receipt', '', '', None, '')), [0])
+
+    def test_keeps_current_rules_when_file_is_invalid(self):
+        watcher = RuleWatcher(self.path)
+        original = watcher.ruleset
+        with open(self.path, 'w') as rules_file:
+            rules_file.write('[{"rule1": ')
+
+        with self.assertLogs('rule_watcher', 'ERROR'):
+            self.assertFalse(watcher.check())
+
+        self.assertIs(watcher.ruleset, original)
+        write_rules(self.path, 'receipt', 3_000_000_000)
+        self.assertTrue(watcher.check())
+
+if __name__ == '__main__':
+    unittest.main()